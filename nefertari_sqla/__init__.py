@@ -4,7 +4,7 @@ from zope.dottedname.resolve import resolve
 
 from .documents import (
     BaseDocument, ESBaseDocument, BaseMixin,
-    get_document_cls, get_document_classes)
+    get_document_cls, get_document_classes, setup_es_mappings)
 from .serializers import JSONEncoder, ESJSONSerializer
 from .signals import ESMetaclass
 from .utils import (
@@ -63,6 +63,7 @@ __all__ = [
     'BaseMixin',
     'get_document_cls',
     'get_document_classes',
+    'setup_es_mappings',
     'relationship_fields',
     'is_relationship_field',
     'get_relationship_cls',
@@ -76,7 +77,36 @@ log = logging.getLogger(__name__)
 
 
 def includeme(config):
-    """ Include required packages. """
+    """ Include required packages and apply engine settings.
+
+    Supported settings:
+        nefertari_sqla.relationship_lazy: Default loading strategy of 'One'
+            sides of relationships. See `fields.Relationship`.
+        nefertari_sqla.index_on_commit: Whether documents are indexed in
+            bulk when transaction is committed. Defaults to true.
+        nefertari_sqla.outbox: Whether changes are written to outbox
+            table instead of being sent to ES. See `outbox.OutboxWorker`.
+        nefertari_sqla.background_indexer: Whether committed documents
+            are indexed from background threads. See
+            `indexer.setup_indexer` for indexer settings.
+    """
+    from pyramid.settings import asbool
+    from .fields import set_relationship_lazy
+    from .signals import set_index_on_commit
+    from .outbox import enable_outbox
+    from .indexer import setup_indexer
+    settings = config.registry.settings
+    lazy = settings.get('nefertari_sqla.relationship_lazy')
+    if lazy:
+        set_relationship_lazy(lazy)
+    index_on_commit = settings.get('nefertari_sqla.index_on_commit')
+    if index_on_commit is not None:
+        set_index_on_commit(asbool(index_on_commit))
+    if asbool(settings.get('nefertari_sqla.outbox', False)):
+        enable_outbox()
+    if asbool(settings.get('nefertari_sqla.background_indexer', False)):
+        setup_indexer(settings)
+
     config.include('pyramid_tm')
     config.include('pyramid_sqlalchemy')
 
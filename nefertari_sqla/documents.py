@@ -1,9 +1,22 @@
 import copy
+import decimal
+import hashlib
+import json
 import logging
+import operator
+import weakref
+from collections import OrderedDict, namedtuple
 
 import six
+from sqlalchemy import (
+    event, func, and_, or_, tuple_, bindparam, type_coerce, select, literal,
+    literal_column, UniqueConstraint, PrimaryKeyConstraint)
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.ext import baked
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import (
-    class_mapper, object_session, properties, attributes)
+    class_mapper, object_session, attributes, configure_mappers, Mapper,
+    joinedload, selectinload)
 from sqlalchemy.orm.collections import InstrumentedList
 from sqlalchemy.exc import (
     InvalidRequestError, IntegrityError, DataError)
@@ -12,13 +25,17 @@ from sqlalchemy.orm.query import Query
 from sqlalchemy.orm.properties import RelationshipProperty
 from pyramid_sqlalchemy import Session, BaseObject
 from sqlalchemy_utils.types.json import JSONType
+from zope.sqlalchemy import mark_changed
 
 from nefertari.json_httpexceptions import (
     JHTTPBadRequest, JHTTPNotFound, JHTTPConflict)
 from nefertari.utils import (
     process_fields, process_limit, _split, dictset,
     drop_reserved_params)
-from .signals import ESMetaclass, on_bulk_delete
+from .signals import (
+    ESMetaclass, on_bulk_create, on_bulk_delete, on_bulk_delete_ids,
+    has_indexed_relationships, load_raise_relationships, on_after_insert,
+    RAISE_LOADERS)
 from .fields import ListField, DictField, IntegerField
 from . import types
 
@@ -26,6 +43,28 @@ from . import types
 log = logging.getLogger(__name__)
 
 
+# Ways of calculating total number of collection results
+TOTAL_COUNT = 'count'
+TOTAL_WINDOW = 'window'
+TOTAL_SKIP = 'skip'
+TOTAL_MODES = (TOTAL_COUNT, TOTAL_WINDOW, TOTAL_SKIP)
+
+# Key of ES mapping `_meta` field fingerprint of the mapping is stored
+# under. See `setup_es_mappings`.
+ES_MAPPING_FINGERPRINT_KEY = 'nefertari_sqla_fingerprint'
+
+# Suffix of DictField param used to filter by keys existence
+HAS_KEY_SUFFIX = '__has_key'
+
+# Params of `get_item` which don't affect objects lookup
+ITEM_CONTROL_PARAMS = (
+    '_raise_on_empty', '_item_request', '_limit', '_strict',
+    '__confirmation')
+
+# Cache of compiled queries used by `get_item` for simple lookups
+item_bakery = baked.bakery()
+
+
 def get_document_cls(name):
     try:
         return BaseObject._decl_class_registry[name]
@@ -49,6 +88,58 @@ def get_document_classes():
     return document_classes
 
 
+def get_live_mapping_fingerprint(es):
+    """ Get fingerprint stored in live mapping of documents of :es:
+    `nefertari.elasticsearch.ES` instance or None if mapping or index
+    do not exist.
+    """
+    from nefertari.elasticsearch import IndexNotFoundException
+    try:
+        mappings = es.api.indices.get_mapping(
+            index=es.index_name, doc_type=es.doc_type)
+    except (IndexNotFoundException, JHTTPNotFound):
+        return None
+    for index_mappings in mappings.values():
+        mapping = index_mappings.get('mappings', {}).get(es.doc_type, {})
+        return mapping.get('_meta', {}).get(ES_MAPPING_FINGERPRINT_KEY)
+    return None
+
+
+def setup_es_mappings(model_names=None, force=False):
+    """ Put ES mappings of ES-enabled models which changed since they
+    were put last time.
+
+    May be used instead of `nefertari.elasticsearch.ES.setup_mappings`.
+    Fingerprint of a mapping is stored in its `_meta` field and mapping
+    is put only if fingerprint of live mapping differs, unless :force:
+    is True.
+
+    :param model_names: Names of models mappings of which should be
+        put. Defaults to all ES-enabled models.
+
+    Returns list of names of models mappings of which were put.
+    """
+    from nefertari.elasticsearch import ES
+    if model_names is None:
+        model_names = sorted(
+            name for name, model in get_document_classes().items()
+            if getattr(model, '_index_enabled', False))
+    updated = []
+    for model_name in model_names:
+        model_cls = get_document_cls(model_name)
+        es = ES(model_name)
+        fingerprint = model_cls.get_es_mapping_fingerprint()
+        if not force and get_live_mapping_fingerprint(es) == fingerprint:
+            continue
+        meta = {'_meta': {ES_MAPPING_FINGERPRINT_KEY: fingerprint}}
+        body = {doc_type: dict(doc_mapping, **meta) for doc_type, doc_mapping
+                in model_cls.get_es_mapping().items()}
+        es.put_mapping(body=body)
+        updated.append(model_name)
+    log.info('Put ES mappings of %s models', len(updated))
+    return updated
+
+
 def process_lists(_dict):
     for k in _dict:
         new_k, _, _t = k.partition('__')
@@ -75,6 +166,7 @@ TYPES_MAP = {
     types.Boolean: {'type': 'boolean'},
     types.LargeBinary: {'type': 'object'},
     JSONType: {'type': 'object', 'enabled': False},
+    types.JSONDict: {'type': 'object', 'enabled': False},
 
     types.LimitedNumeric: {'type': 'double'},
     types.LimitedFloat: {'type': 'double'},
@@ -90,6 +182,280 @@ TYPES_MAP = {
 }
 
 
+QUERY_FIELDS = (
+    'id', '_limit', '_page', '_sort', '_fields', '_count', '_start')
+
+
+class ModelMetadata(namedtuple('ModelMetadata', [
+        'columns', 'relationships', 'native_fields', 'native_fields_set',
+        'pk_field', 'pk_field_type', 'iterable_columns', 'unique_columns',
+        'fields_to_query', 'refresh_on_insert', 'refresh_on_update',
+        'serializers', 'es_mappings'])):
+    """ Mapper information of a model class.
+
+    Computed once per model class by `get_model_metadata` and cached
+    until mappers are configured again. Should be treated as read-only.
+
+    Attributes:
+        columns: Dict of {column_name: column}.
+        relationships: Dict of {relationship_name: RelationshipProperty}.
+        native_fields: Tuple of column and relationship names.
+        native_fields_set: Frozenset of `native_fields`.
+        pk_field: Name of primary key field.
+        pk_field_type: Type class of primary key field.
+        iterable_columns: Frozenset of names of ListField and DictField
+            columns.
+        unique_columns: Tuple of unique and primary key columns.
+        fields_to_query: Frozenset of field names that may be used
+            in queries.
+        refresh_on_insert: Tuple of names of columns values of which
+            are changed when stored and should be reloaded after insert.
+        refresh_on_update: Tuple of names of columns values of which are
+            generated when rows are updated, by `onupdate` or
+            `server_onupdate`.
+        serializers: Cache of serializers generated by `get_serializer`.
+        es_mappings: Cache of ES mappings generated by
+            `BaseMixin.get_es_mapping`.
+    """
+    __slots__ = ()
+
+
+_models_metadata = weakref.WeakKeyDictionary()
+
+
+def get_model_metadata(model_cls):
+    """ Get cached `ModelMetadata` of :model_cls:. """
+    # Does nothing unless new mappers were defined
+    configure_mappers()
+    try:
+        return _models_metadata[model_cls]
+    except KeyError:
+        pass
+
+    mapper = class_mapper(model_cls)
+    columns = {c.name: c for c in mapper.columns}
+    relationships = {r.key: r for r in mapper.relationships}
+    native_fields = tuple(columns) + tuple(relationships)
+    primary_key = mapper.primary_key[0]
+    metadata = ModelMetadata(
+        columns=columns,
+        relationships=relationships,
+        native_fields=native_fields,
+        native_fields_set=frozenset(native_fields),
+        pk_field=primary_key.name,
+        pk_field_type=primary_key.type.__class__,
+        iterable_columns=frozenset(
+            name for name, col in columns.items()
+            if isinstance(col, (ListField, DictField))),
+        unique_columns=tuple(
+            col for col in mapper.columns if col.unique or col.primary_key),
+        fields_to_query=frozenset(QUERY_FIELDS + native_fields),
+        refresh_on_insert=tuple(
+            name for name, col in columns.items()
+            if isinstance(col.type, types.Interval)),
+        refresh_on_update=tuple(
+            name for name, col in columns.items()
+            if col.onupdate is not None or col.server_onupdate is not None),
+        serializers={},
+        es_mappings={},
+    )
+    _models_metadata[model_cls] = metadata
+    return metadata
+
+
+# Python types primary key values are coerced to by `coerce_pk_value`
+PK_COERCE_TYPES = six.integer_types + (float, decimal.Decimal) + (
+    six.text_type, six.binary_type)
+
+
+def coerce_pk_value(column, value):
+    """ Coerce :value: to Python type of primary key :column: if the
+    type is one of `PK_COERCE_TYPES`.
+
+    :raises ValueError: If :value: can't be coerced.
+    """
+    column_type = column.type
+    if isinstance(column_type, TypeDecorator):
+        column_type = column_type.impl
+    try:
+        python_type = column_type.python_type
+    except NotImplementedError:
+        return value
+    if python_type in PK_COERCE_TYPES and not isinstance(value, python_type):
+        value = python_type(value)
+    return value
+
+
+def _encode_pk(pk_field):
+    def encode(value):
+        return None if value is None else getattr(value, pk_field, None)
+    return encode
+
+
+def _encode_pk_list(pk_field):
+    def encode(value):
+        return [getattr(v, pk_field, None) for v in value]
+    return encode
+
+
+def _encode_nested(_depth):
+    def encode(value):
+        return None if value is None else value.to_dict(_depth=_depth)
+    return encode
+
+
+def _encode_nested_list(_depth):
+    def encode(value):
+        return [v.to_dict(_depth=_depth) for v in value]
+    return encode
+
+
+def _encode_any(_depth):
+    """ Encode value of a column which may hold any object. """
+    def encode(value):
+        if isinstance(value, BaseMixin):
+            return getattr(value, value.pk_field(), None)
+        elif isinstance(value, InstrumentedList):
+            return [getattr(v, v.pk_field(), None) for v in value]
+        elif hasattr(value, 'to_dict'):
+            return value.to_dict(_depth=_depth)
+        return value
+    return encode
+
+
+def get_serializer(model_cls, _depth):
+    """ Get function that serializes :model_cls: instances to dict
+    with relationships nested up to :_depth: level.
+
+    Serializer is generated once per model and its nesting settings.
+    It knows in advance which fields are columns and how each
+    relationship is encoded: as primary key(s) of related objects or
+    as nested documents.
+    """
+    metadata = get_model_metadata(model_cls)
+    nested = tuple(model_cls._nested_relationships)
+    key = (_depth, nested)
+    try:
+        return metadata.serializers[key]
+    except KeyError:
+        pass
+
+    depth_reached = _depth is not None and _depth <= 0
+    child_depth = None if _depth is None else _depth - 1
+    plain_columns = []
+    encoders = []
+    for name, column in metadata.columns.items():
+        if isinstance(column.type, types.PickleType):
+            encoders.append((name, _encode_any(child_depth)))
+        else:
+            plain_columns.append(name)
+
+    for name, prop in metadata.relationships.items():
+        if name in nested and not depth_reached:
+            encode = (_encode_nested_list if prop.uselist
+                      else _encode_nested)(child_depth)
+        else:
+            rel_pk_field = prop.mapper.class_.pk_field()
+            encode = (_encode_pk_list if prop.uselist
+                      else _encode_pk)(rel_pk_field)
+        encoders.append((name, encode))
+
+    if len(plain_columns) == 1:
+        get_column = operator.attrgetter(plain_columns[0])
+
+        def get_columns(obj):
+            return (get_column(obj),)
+    else:
+        get_columns = operator.attrgetter(*plain_columns)
+    pk_field = metadata.pk_field
+
+    def serializer(obj):
+        _data = dictset(zip(plain_columns, get_columns(obj)))
+        for name, encode in encoders:
+            _data[name] = encode(getattr(obj, name, None))
+        _data['_type'] = obj._type
+        _data['_pk'] = str(getattr(obj, pk_field))
+        return _data
+
+    metadata.serializers[key] = serializer
+    return serializer
+
+
+# Graph built by `get_nesting_graph`
+_nesting_graph = None
+
+
+def get_nesting_graph():
+    """ Get graph of models documents of which contain nested documents
+    of other models.
+
+    Returns dict of {model_cls: tuple of (path, root_cls)} pairs where
+    :path: is a tuple of names of relationships which lead from
+    model_cls instances to :root_cls: instances, documents of which
+    contain nested copies of model_cls instances. Nested copies contain
+    all fields of a model, thus these documents should be reindexed when
+    model_cls instances are updated. Models which are not nested are not
+    present in the graph.
+
+    Graph is built from `_nested_relationships` and `_nesting_depth` of
+    all document classes and is cached until mappers are configured
+    again. Nested relationships are followed back using their reverse
+    properties, so they should be defined with backrefs.
+    """
+    global _nesting_graph
+    configure_mappers()
+    if _nesting_graph is not None:
+        return _nesting_graph
+
+    # {model_cls: [(reverse_name, nesting_cls), ...]}
+    edges = {}
+    max_depth = 0
+    for nesting_cls in get_document_classes().values():
+        max_depth = max(max_depth, nesting_cls._nesting_depth)
+        relationships = get_model_metadata(nesting_cls).relationships
+        for name in nesting_cls._nested_relationships:
+            prop = relationships.get(name)
+            if prop is None:
+                continue
+            for reverse in prop._reverse_property:
+                edges.setdefault(prop.mapper.class_, []).append(
+                    (reverse.key, nesting_cls))
+
+    graph = {}
+    for model_cls in edges:
+        paths = []
+        level = [((), model_cls)]
+        # Document at the end of a path of N relationships contains
+        # nested copy only if it is nested at least N levels deep
+        for length in range(1, max_depth + 1):
+            next_level = []
+            for path, cls in level:
+                for name, nesting_cls in edges.get(cls, ()):
+                    nesting_path = path + (name,)
+                    next_level.append((nesting_path, nesting_cls))
+                    if nesting_cls._nesting_depth >= length:
+                        paths.append((nesting_path, nesting_cls))
+            level = next_level
+        graph[model_cls] = tuple(paths)
+    _nesting_graph = graph
+    return graph
+
+
+@event.listens_for(Mapper, 'mapper_configured')
+def _reset_model_metadata(mapper, model_cls):
+    global _nesting_graph
+    _models_metadata.pop(model_cls, None)
+    _nesting_graph = None
+
+
+@event.listens_for(Mapper, 'after_configured')
+def _reset_models_metadata():
+    global _nesting_graph
+    # Backrefs may have been added to already configured models
+    _models_metadata.clear()
+    _nesting_graph = None
+
+
 class BaseMixin(object):
     """ Represents mixin class for models.
 
@@ -107,23 +473,44 @@ class BaseMixin(object):
         _nesting_depth: Depth of relationship field nesting in JSON.
             Defaults to 1(one) which makes only one level of relationship
             nested.
+        _index_ignored_fields: String names of fields changes of which
+            don't require documents to be reindexed when objects are
+            updated.
+        _upsert_enabled: Boolean indicating whether `get_or_create` may
+            insert objects bypassing ORM. Should be set to False by
+            models with hooks `_has_insert_hooks` doesn't detect, e.g.
+            'init' event listeners.
     """
     _public_fields = None
     _auth_fields = None
     _hidden_fields = None
     _nested_relationships = ()
     _nesting_depth = 1
+    _index_ignored_fields = ()
+    _upsert_enabled = True
 
     _type = property(lambda self: self.__class__.__name__)
 
     @classmethod
     def get_es_mapping(cls, _depth=None, types_map=None):
-        """ Generate ES mapping from model schema. """
+        """ Generate ES mapping from model schema.
+
+        Mapping is generated once per model, nesting depth and types map
+        and is cached until mappers are configured again. Returned
+        mapping should be treated as read-only.
+        """
         from nefertari.elasticsearch import ES
         if types_map is None:
             types_map = TYPES_MAP
         if _depth is None:
             _depth = cls._nesting_depth
+        metadata = get_model_metadata(cls)
+        # Types map is cached with mapping, so its id is not reused
+        key = (_depth, tuple(cls._nested_relationships), id(types_map))
+        try:
+            return metadata.es_mappings[key][1]
+        except KeyError:
+            pass
         depth_reached = _depth <= 0
 
         properties = {}
@@ -132,9 +519,8 @@ class BaseMixin(object):
                 'properties': properties
             }
         }
-        mapper = class_mapper(cls)
-        columns = {c.name: c for c in mapper.columns}
-        relationships = {r.key: r for r in mapper.relationships}
+        columns = metadata.columns
+        relationships = metadata.relationships
 
         for name, column in columns.items():
             column_type = column.type
@@ -149,7 +535,7 @@ class BaseMixin(object):
             if name in cls._nested_relationships and not depth_reached:
                 column_type = {'type': 'nested'}
                 submapping = column.mapper.class_.get_es_mapping(
-                    _depth=_depth-1)
+                    _depth=_depth-1, types_map=types_map)
                 column_type.update(list(submapping.values())[0])
             else:
                 rel_pk_field = column.mapper.class_.pk_field_type()
@@ -157,8 +543,21 @@ class BaseMixin(object):
             properties[name] = column_type
 
         properties['_pk'] = {'type': 'string'}
+        metadata.es_mappings[key] = (types_map, mapping)
         return mapping
 
+    @classmethod
+    def get_es_mapping_fingerprint(cls, types_map=None):
+        """ Get hex digest of ES mapping generated by `get_es_mapping`.
+
+        Fingerprint only changes when mapping changes, so it may be
+        compared with fingerprint stored in live mapping to tell whether
+        mapping should be put. See `setup_es_mappings`.
+        """
+        mapping = cls.get_es_mapping(types_map=types_map)
+        data = json.dumps(mapping, sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
     @classmethod
     def autogenerate_for(cls, model, set_to):
         """ Setup `after_insert` event handler.
@@ -177,17 +576,76 @@ class BaseMixin(object):
     @classmethod
     def pk_field(cls):
         """ Get a primary key field name. """
-        return class_mapper(cls).primary_key[0].name
+        return get_model_metadata(cls).pk_field
 
     @classmethod
     def pk_field_type(cls):
-        return class_mapper(cls).primary_key[0].type.__class__
+        return get_model_metadata(cls).pk_field_type
+
+    @classmethod
+    def get_eager_load_options(cls, _depth=None):
+        """ Generate query options which eagerly load relationships
+        accessed by `to_dict` called with :_depth:.
+
+        Relationships listed in `_nested_relationships` are loaded with
+        all their columns and options are generated recursively for
+        related models until nesting depth is reached. For the rest of
+        relationships only primary keys of related objects are loaded.
+        List relationships are loaded using 'selectin' loading and
+        scalar ones using 'joined' loading.
+        """
+        if _depth is None:
+            _depth = cls._nesting_depth
+        return cls._eager_load_options(_depth)
+
+    @classmethod
+    def _has_raise_loaders(cls, _depth=None):
+        """ Check if any relationship accessed by `to_dict` called with
+        :_depth: is configured with lazy='raise'.
+        """
+        if _depth is None:
+            _depth = cls._nesting_depth
+        relationships = get_model_metadata(cls).relationships
+        for name, prop in relationships.items():
+            if prop.lazy in RAISE_LOADERS:
+                return True
+            nested = name in cls._nested_relationships and _depth > 0
+            if nested and prop.mapper.class_._has_raise_loaders(_depth - 1):
+                return True
+        return False
+
+    @classmethod
+    def _eager_load_options(cls, _depth, parent=None):
+        options = []
+        relationships = get_model_metadata(cls).relationships
+        for name, prop in relationships.items():
+            if prop.lazy == 'dynamic':
+                continue
+            attr = getattr(cls, name)
+            related_cls = prop.mapper.class_
+            if parent is None:
+                loader = selectinload if prop.uselist else joinedload
+            else:
+                loader = getattr(
+                    parent, 'selectinload' if prop.uselist else 'joinedload')
+            option = loader(attr)
+
+            if name in cls._nested_relationships and _depth > 0:
+                options.append(option)
+                options += related_cls._eager_load_options(
+                    _depth - 1, parent=option)
+            else:
+                # Relationships of objects loaded this way are not
+                # accessed, thus should not be loaded immediately
+                options.append(
+                    option.load_only(related_cls.pk_field()).lazyload('*'))
+        return options
 
     @classmethod
     def check_fields_allowed(cls, fields):
         """ Check if `fields` are allowed to be used on this model. """
         fields = [f.split('__')[0] for f in fields]
-        fields_to_query = set(cls.fields_to_query())
+        fields_to_query = get_model_metadata(cls).fields_to_query
         if not set(fields).issubset(fields_to_query):
             not_allowed = set(fields) - fields_to_query
             raise JHTTPBadRequest(
@@ -247,6 +705,9 @@ class BaseMixin(object):
 
     @classmethod
     def count(cls, query_set):
+        from .utils import FieldsQuerySet
+        if isinstance(query_set, (list, FieldsQuerySet)):
+            return len(query_set)
         return query_set.count()
 
     @classmethod
@@ -264,7 +725,7 @@ class BaseMixin(object):
         query_set = Session().query(cls).filter(field_obj.in_(ids))
 
         if params:
-            params['query_set'] = query_set.from_self()
+            params['query_set'] = query_set
             query_set = cls.get_collection(**params)
 
         if first:
@@ -278,7 +739,7 @@ class BaseMixin(object):
         return query_set
 
     @classmethod
-    def _pop_iterables(cls, params):
+    def _pop_iterables(cls, params, session=None):
         """ Pop iterable fields' parameters from :params: and generate
         SQLA expressions to query the database.
 
@@ -286,27 +747,46 @@ class BaseMixin(object):
         correspond to names of List fields on model.
         If ListField uses the `postgresql.ARRAY` type, the value is
         wrapped in a list.
+
+        DictField may only be queried on PostgreSQL, where JSONB is
+        used. Dialect is determined by bind of :session:, which defaults
+        to `pyramid_sqlalchemy.Session`. Supported params are:
+            field={"a": 1}  Dict contains JSON object of the value
+            field__has_key=a,b  Dict contains all of the keys
+            field.a.b=1  Value at path "a.b" is equal to text "1"
         """
         iterables = {}
-        columns = class_mapper(cls).columns
-        columns = {c.name: c for c in columns
-                   if isinstance(c, (ListField, DictField))}
+        metadata = get_model_metadata(cls)
+        columns = {name: metadata.columns[name]
+                   for name in metadata.iterable_columns}
 
         for key, val in params.items():
-            col = columns.get(key)
+            name, _, path = key.partition('.')
+            has_key = name.endswith(HAS_KEY_SUFFIX)
+            if has_key:
+                name = name[:-len(HAS_KEY_SUFFIX)]
+            col = columns.get(name)
             if col is None:
                 continue
 
-            field_obj = getattr(cls, key)
+            field_obj = getattr(cls, name)
             is_postgres = getattr(col.type, 'is_postgresql', False)
 
             if isinstance(col, ListField):
+                if has_key or path:
+                    continue
                 val = [val] if is_postgres else val
                 expr = field_obj.contains(val)
 
             if isinstance(col, DictField):
-                raise Exception('DictField database querying is not '
-                                'supported')
+                if session is None:
+                    session = Session()
+                bind = session.get_bind(mapper=class_mapper(cls))
+                if bind.dialect.name != 'postgresql':
+                    raise Exception('DictField database querying is not '
+                                    'supported')
+                expr = cls._get_dict_expr(
+                    field_obj, val, path=path, has_key=has_key)
 
             iterables[key] = expr
 
@@ -315,6 +795,33 @@ class BaseMixin(object):
 
         return list(iterables.values()), params
 
+    @staticmethod
+    def _get_dict_expr(field_obj, val, path=None, has_key=False):
+        """ Generate SQLA expression to query JSONB :field_obj:.
+
+        :param path: Dot-separated path of value to compare with :val:.
+        :param has_key: If True, :val: is a key or a list of keys
+            which should be present in dict.
+        """
+        field_obj = type_coerce(field_obj, JSONB)
+        if has_key:
+            keys = _split(val)
+            if len(keys) == 1:
+                return field_obj.has_key(keys[0])
+            return field_obj.has_all(keys)
+        if path:
+            path = tuple(path.split('.'))
+            return field_obj[path].astext == six.text_type(val)
+        if isinstance(val, six.string_types):
+            try:
+                val = json.loads(val)
+            except ValueError as ex:
+                raise JHTTPBadRequest(
+                    'Bad DictField param value: {}'.format(ex))
+        if not isinstance(val, dict):
+            raise JHTTPBadRequest('DictField param value must be an object')
+        return field_obj.contains(val)
+
     @classmethod
     def get_collection(cls, **params):
         """ Query collection and return results.
@@ -365,9 +872,37 @@ class BaseMixin(object):
         :param bool _raise_on_empty: When True JHTTPNotFound is raised
             if query returned no results. Defaults to False in which case
             error is just logged and empty query results are returned.
+        :param str _after: Cursor returned in ``next_cursor`` metadata of
+            a previous page. When provided, keyset pagination is performed:
+            instead of OFFSET, results are filtered to follow the row
+            cursor points to in ``_sort`` + primary key order. Empty value
+            requests the first page. Can't be used with ``_start``,
+            ``_page`` or ``_total_mode='window'``. Results are fetched and
+            returned as a list and cursor of the next page is stored in
+            ``next_cursor`` metadata. Sorting fields should not contain
+            NULL values.
+        :param bool _eager_load: When True, relationships accessed when
+            serializing results with `to_dict` are loaded eagerly using
+            options generated by `get_eager_load_options`. Ignored when
+            ``_fields`` param is provided. Defaults to False.
+        :param str _total_mode: How total number of results is calculated.
+            One of:
+              * ``'count'``: Separate COUNT query is performed. Default.
+              * ``'window'``: Total is calculated with ``count(*) OVER ()``
+                window function in the same query that fetches results.
+                Results are fetched and returned as a list.
+              * ``'skip'``: Total is not calculated and is set to None.
+        :param int _stream: When provided, results are streamed from DB
+            using server-side cursor (where supported) in chunks of
+            ``_stream`` rows with `Query.yield_per` instead of being
+            fetched at once. Results returned for ``_fields`` param may
+            only be iterated once. Can't be used with ``_after`` or
+            ``_total_mode='window'``. See `stream_collection`.
 
         :returns: Query results as ``sqlalchemy.orm.query.Query`` instance.
             May be sorted, offset, limited.
+        :returns: List of objects when ``_total_mode='window'`` or
+            ``_after`` param is provided.
         :returns: Dict of {'field_name': fieldval}, when ``_fields`` param
             is provided.
         :returns: Number of query results as an int when ``_count`` param
@@ -406,9 +941,31 @@ class BaseMixin(object):
         _explain = '_explain' in params
         params.pop('_explain', None)
         _raise_on_empty = params.pop('_raise_on_empty', False)
+        _eager_load = params.pop('_eager_load', False)
+        _total_mode = params.pop('_total_mode', TOTAL_COUNT)
+        if _total_mode not in TOTAL_MODES:
+            raise JHTTPBadRequest('Bad _total_mode param: {}. Must be one '
+                                  'of: {}'.format(
+                                      _total_mode, ', '.join(TOTAL_MODES)))
+        _keyset = '_after' in params
+        _after = params.pop('_after', None)
+        if _keyset and (_start is not None or _page is not None):
+            raise JHTTPBadRequest(
+                "'_after' param can't be used with '_start' or '_page'")
+        if _keyset and _total_mode == TOTAL_WINDOW:
+            raise JHTTPBadRequest(
+                "'_after' param can't be used with '_total_mode=window'")
+        _stream = params.pop('_stream', None)
+        if _stream and (_keyset or _total_mode == TOTAL_WINDOW):
+            raise JHTTPBadRequest(
+                "'_stream' param can't be used with '_after' or "
+                "'_total_mode=window'")
 
         if query_set is None:
             query_set = Session().query(cls)
+        elif query_set._limit is not None or query_set._offset is not None:
+            # Filters can't be applied to limited query directly
+            query_set = query_set.from_self()
 
         # Remove any __ legacy instructions from this point on
         params = dictset({
@@ -416,7 +973,8 @@ class BaseMixin(object):
             if not key.startswith('__')
         })
 
-        iterables_exprs, params = cls._pop_iterables(params)
+        iterables_exprs, params = cls._pop_iterables(
+            params, session=query_set.session)
 
         params = drop_reserved_params(params)
         if _strict:
@@ -437,23 +995,66 @@ class BaseMixin(object):
             query_set = query_set.filter_by(**params)
 
             # Apply filtering by iterable expressions
-            for expr in iterables_exprs:
-                query_set = query_set.from_self().filter(expr)
+            if iterables_exprs:
+                query_set = query_set.filter(*iterables_exprs)
 
-            _total = query_set.count()
             if _count:
-                return _total
+                return query_set.count()
+
+            _total = None
+            if _total_mode == TOTAL_COUNT:
+                _total = query_set.count()
 
             # Filtering by fields has to be the first thing to do on
             # the query_set!
             query_set = cls.apply_fields(query_set, _fields)
+            if _eager_load and not _fields:
+                query_set = query_set.options(*cls.get_eager_load_options())
+            if _keyset:
+                _sort = cls._keyset_sort(_sort, _fields)
+                if _after:
+                    query_set = query_set.filter(
+                        cls._keyset_filter(_sort, _after))
             query_set = cls.apply_sort(query_set, _sort)
 
             if _limit is not None:
                 _start, _limit = process_limit(_start, _page, _limit)
-                query_set = query_set.offset(_start).limit(_limit)
+                if _keyset:
+                    # One more row is fetched to find out if next page
+                    # exists
+                    _start = None
+                    query_set = query_set.limit(_limit + 1)
+                else:
+                    query_set = query_set.offset(_start).limit(_limit)
+
+            if _stream:
+                query_set = query_set.yield_per(int(_stream))
+                query_set = query_set.execution_options(stream_results=True)
+
+            if _explain:
+                return str(query_set).replace('\n', '')
+
+            log.debug('get_collection.query_set: %s (%s)',
+                      cls.__name__, query_set)
+
+            if _keyset:
+                query_set, next_cursor = cls._fetch_keyset_page(
+                    query_set, _sort, _fields, _limit)
+                empty = not query_set
+            elif _total_mode == TOTAL_WINDOW:
+                query_set, _total = cls._fetch_with_total(
+                    query_set, _fields, _start)
+                empty = not query_set
+            elif _total_mode == TOTAL_COUNT:
+                # Offset is only applied along with limit
+                empty = not _total or (
+                    _limit is not None and (_total <= _start or not _limit))
+            else:
+                # Emptiness is only checked when it matters
+                empty = _raise_on_empty and not query_set.session.query(
+                    query_set.exists()).scalar()
 
-            if not query_set.count():
+            if empty:
                 msg = "'%s(%s)' resource not found" % (cls.__name__, params)
                 if _raise_on_empty:
                     raise JHTTPNotFound(msg)
@@ -470,67 +1071,223 @@ class BaseMixin(object):
         except (InvalidRequestError,) as ex:
             raise JHTTPBadRequest(str(ex), extra={'data': ex})
 
-        query_sql = str(query_set).replace('\n', '')
-        if _explain:
-            return query_sql
-
-        log.debug('get_collection.query_set: %s (%s)', cls.__name__, query_sql)
-
-        if _fields:
-            query_set = cls.add_field_names(query_set, _fields)
+        fetched = _keyset or _total_mode == TOTAL_WINDOW
+        if _fields and not fetched:
+            query_set = cls.add_field_names(
+                query_set, _fields, stream=bool(_stream))
 
         query_set._nefertari_meta = dict(
             total=_total,
             start=_start,
             fields=_fields)
+        if _keyset:
+            query_set._nefertari_meta['next_cursor'] = next_cursor
         return query_set
 
     @classmethod
-    def add_field_names(cls, query_set, requested_fields):
-        """ Convert list of tuples to dict with proper field keys. """
+    def stream_collection(cls, _chunk_size=1000, **params):
+        """ Query collection and yield serialized results in chunks.
+
+        Rows are streamed from DB in chunks of :_chunk_size: using
+        ``_stream`` param of `get_collection`, so memory usage doesn't
+        depend on collection size. Relationships are loaded eagerly
+        unless ``_eager_load`` param is False. Total is not calculated
+        unless ``_total_mode`` param is provided.
+
+        :param int _chunk_size: Number of results in each chunk.
+        :param params: Params accepted by `get_collection`.
+        :returns: Generator of lists of dicts.
+        """
+        params.setdefault('_total_mode', TOTAL_SKIP)
+        params.setdefault('_eager_load', True)
+        params['_stream'] = _chunk_size
+        results = cls.get_collection(**params)
+
+        chunk = []
+        for item in results:
+            if not isinstance(item, dict):
+                item = item.to_dict()
+            chunk.append(item)
+            if len(chunk) >= _chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    @classmethod
+    def _keyset_sort(cls, _sort, _fields):
+        """ Get sorting fields used for keyset pagination.
+
+        Primary key field is added to sorting fields to make order
+        deterministic. Sorting fields must be present in results to
+        generate next page cursor, thus JHTTPBadRequest is raised if
+        some of them are not included by :_fields:.
+        """
+        pk_field = cls.pk_field()
+        sort_names = [f.lstrip('-') for f in _sort]
+        if pk_field not in sort_names:
+            _sort = _sort + [pk_field]
+            sort_names.append(pk_field)
+
+        if _fields:
+            fields_only, fields_exclude = process_fields(_fields)
+            selected = set(fields_only or cls.native_fields())
+            selected = selected - set(fields_exclude or [])
+            selected.add(pk_field)
+            missing = set(sort_names) - selected
+            if missing:
+                raise JHTTPBadRequest(
+                    "Sorting fields must be included in '_fields' when "
+                    "'_after' param is used: {}".format(
+                        ', '.join(sorted(missing))))
+        return _sort
+
+    @classmethod
+    def _keyset_filter(cls, _sort, cursor):
+        """ Generate expression that filters rows following the row
+        :cursor: points to in :_sort: order.
+
+        When all fields are sorted in the same direction, row value
+        comparison ``(a, b) > (1, 2)`` is used. Otherwise comparison is
+        expanded to ``a > 1 OR (a = 1 AND b > 2)`` with operators
+        flipped for fields sorted in descending order.
+        """
+        from .utils import decode_cursor
+        try:
+            values = decode_cursor(cursor)
+        except ValueError as ex:
+            raise JHTTPBadRequest('Bad _after param: {}'.format(ex))
+        if len(values) != len(_sort):
+            raise JHTTPBadRequest(
+                'Bad _after param: cursor does not match sorting fields')
+
+        columns = [getattr(cls, f.lstrip('-')) for f in _sort]
+        descending = [f.startswith('-') for f in _sort]
+
+        if len(set(descending)) == 1:
+            if descending[0]:
+                return tuple_(*columns) < tuple_(*values)
+            return tuple_(*columns) > tuple_(*values)
+
+        clauses = []
+        for idx, column in enumerate(columns):
+            value = values[idx]
+            if descending[idx]:
+                follows = column < value
+            else:
+                follows = column > value
+            equals = [col == val for col, val in zip(
+                columns[:idx], values[:idx])]
+            clauses.append(and_(*(equals + [follows])))
+        return or_(*clauses)
+
+    @classmethod
+    def _fetch_keyset_page(cls, query_set, _sort, _fields, _limit):
+        """ Fetch page of keyset pagination.
+
+        :query_set: is expected to be limited to ``_limit + 1`` rows, extra
+        row indicating next page exists.
+
+        :returns: Tuple of (results list, next page cursor). Cursor is
+            None when there are no more results.
+        """
+        from .utils import CollectionQuerySet, encode_cursor
+        rows = query_set.all()
+        next_cursor = None
+        if _limit is not None and len(rows) > _limit:
+            rows = rows[:_limit]
+            last = rows[-1]
+            next_cursor = encode_cursor(
+                [getattr(last, f.lstrip('-')) for f in _sort])
+
+        if _fields:
+            return cls.add_field_names(query_set, _fields, rows), next_cursor
+        return CollectionQuerySet(rows), next_cursor
+
+    @classmethod
+    def _fetch_with_total(cls, query_set, _fields, _start):
+        """ Fetch results of :query_set: along with total number of
+        results ignoring limit and offset.
+
+        Total is calculated using ``count(*) OVER ()`` window function
+        which is evaluated before LIMIT/OFFSET are applied. When no rows
+        are returned for a non-zero offset, total can't be determined
+        from the results and a separate COUNT query is performed.
+
+        :returns: Tuple of (results list, total).
+        """
+        from .utils import CollectionQuerySet
+        rows = query_set.add_columns(
+            func.count().over().label('_total')).all()
+
+        if rows:
+            _total = rows[0][-1]
+        elif _start:
+            _total = query_set.limit(None).offset(None).count()
+        else:
+            _total = 0
+
+        if _fields:
+            values = [tuple(row[:-1]) for row in rows]
+            return cls.add_field_names(query_set, _fields, values), _total
+        return CollectionQuerySet(row[0] for row in rows), _total
+
+    @classmethod
+    def add_field_names(cls, query_set, requested_fields, values=None,
+                        stream=False):
+        """ Convert list of tuples to dict with proper field keys.
+
+        Rows are converted lazily, when items of returned
+        `FieldsQuerySet` are accessed.
+
+        :param values: Already fetched rows of :query_set:. When not
+            provided, :query_set: is queried for them.
+        :param bool stream: If True, converted rows are not cached and
+            results may only be iterated once.
+        """
         from .utils import FieldsQuerySet
-        fields = [col['name'] for col in query_set.column_descriptions] + [
-            '_type']
-        add_vals = (cls.__name__,)
         pk_field = cls.pk_field()
+        keys = [col['name'] for col in query_set.column_descriptions]
+        pk_index = keys.index(pk_field) if pk_field in keys else None
+        if pk_index is not None and pk_field not in requested_fields:
+            # Not requested primary key is only returned as '_pk'
+            keys[pk_index] = '_pk'
+            pk_index = None
+        keys = tuple(keys) + ('_type',)
+        add_vals = (cls.__name__,)
 
-        def _convert(val):
-            return dict(zip(fields, val+add_vals))
+        if pk_index is None:
+            def convert(row):
+                return dict(zip(keys, row + add_vals))
+        else:
+            keys += ('_pk',)
 
-        def _add_pk(obj):
-            if pk_field in obj:
-                obj['_pk'] = obj[pk_field]
-                if pk_field not in requested_fields:
-                    obj.pop(pk_field)
-            return obj
+            def convert(row):
+                return dict(zip(keys, row + add_vals + (row[pk_index],)))
 
-        values = query_set.all()
-        converted = [_add_pk(_convert(val)) for val in values]
-        return FieldsQuerySet(converted)
+        if values is None:
+            values = query_set
+        return FieldsQuerySet(values, convert, cache=not stream)
 
     @classmethod
     def has_field(cls, field):
-        return field in cls.native_fields()
+        return field in get_model_metadata(cls).native_fields_set
 
     @classmethod
     def native_fields(cls):
-        columns = list(cls._mapped_columns().keys())
-        relationships = list(cls._mapped_relationships().keys())
-        return columns + relationships
+        return list(get_model_metadata(cls).native_fields)
 
     @classmethod
     def _mapped_columns(cls):
-        return {c.name: c for c in class_mapper(cls).columns}
+        return dict(get_model_metadata(cls).columns)
 
     @classmethod
     def _mapped_relationships(cls):
-        return {c.key: c for c in class_mapper(cls).relationships}
+        return dict(get_model_metadata(cls).relationships)
 
     @classmethod
     def fields_to_query(cls):
-        query_fields = [
-            'id', '_limit', '_page', '_sort', '_fields', '_count', '_start']
-        return list(set(query_fields + cls.native_fields()))
+        return list(get_model_metadata(cls).fields_to_query)
 
     @classmethod
     def get_item(cls, **params):
@@ -539,22 +1296,156 @@ class BaseMixin(object):
         Exception raising when item is not found can be disabled
         by passing ``_raise_on_empty=False`` in params.
 
+        When relationships accessed by `to_dict` are configured with
+        lazy='raise', they are loaded along with the item.
+
         :returns: Single collection item as an instance of ``cls``.
         """
         params.setdefault('_raise_on_empty', True)
-        params['_limit'] = 1
-        params['_item_request'] = True
-        query_set = cls.get_collection(**params)
-        return query_set.first()
+        eager_load = cls._has_raise_loaders()
+        lookup = cls._get_simple_lookup(params)
+        if lookup is not None:
+            raise_on_empty = params['_raise_on_empty']
+            pk_field = cls.pk_field()
+            if list(lookup) == [pk_field]:
+                item = cls._get_item_by_pk(
+                    lookup[pk_field], raise_on_empty, eager_load)
+            else:
+                item = cls._get_item_by_lookup(
+                    lookup, raise_on_empty, eager_load)
+        else:
+            params['_limit'] = 1
+            params['_item_request'] = True
+            if eager_load:
+                params.setdefault('_eager_load', True)
+            query_set = cls.get_collection(**params)
+            if isinstance(query_set, list):
+                # Window total and keyset modes return fetched results
+                item = query_set[0] if query_set else None
+            else:
+                item = query_set.first()
+
+        if eager_load and isinstance(item, cls):
+            # Objects found in session identity map are not reloaded
+            load_raise_relationships(item)
+        return item
+
+    @classmethod
+    def _get_simple_lookup(cls, params):
+        """ Get {column_name: value} filters from `get_item` :params:
+        if they only filter by equality of plain columns values.
+
+        None is returned if :params: contain any other filters or
+        query params. Legacy '__' params are ignored, as they are by
+        `get_collection`.
+        """
+        metadata = get_model_metadata(cls)
+        lookup = {}
+        for key, value in params.items():
+            if key in ITEM_CONTROL_PARAMS or key.startswith('__'):
+                continue
+            simple = (
+                not key.startswith('_') and '__' not in key and
+                key in metadata.columns and
+                key not in metadata.iterable_columns and
+                not isinstance(value, (list, tuple, set, dict)) and
+                value != '_all')
+            if not simple:
+                return None
+            lookup[key] = value
+        return lookup or None
+
+    @classmethod
+    def _get_item_by_pk(cls, value, raise_on_empty=True, eager_load=False):
+        """ Get item by primary key :value: using `Query.get`.
+
+        Object already present in session identity map is returned without
+        querying DB. To find it there, :value: is coerced to the Python
+        type of primary key column if the latter is numeric or string.
+        When :eager_load: is True, `get_eager_load_options` are applied.
+        """
+        metadata = get_model_metadata(cls)
+        column = metadata.columns[metadata.pk_field]
+        obj = None
+        query = Session().query(cls)
+        if eager_load:
+            query = query.options(*cls.get_eager_load_options())
+        try:
+            value = coerce_pk_value(column, value)
+            obj = query.get(value)
+        except (TypeError, ValueError, DataError):
+            pass
+
+        if obj is None:
+            msg = "'%s(%s)' resource not found" % (
+                cls.__name__, {metadata.pk_field: value})
+            if raise_on_empty:
+                raise JHTTPNotFound(msg)
+            log.debug(msg)
+        return obj
+
+    @classmethod
+    def _get_item_by_lookup(cls, lookup, raise_on_empty=True,
+                            eager_load=False):
+        """ Get item filtered by equality of columns values from
+        :lookup:.
+
+        Queries are compiled once per model and set of filtered columns
+        and cached in `item_bakery`. Columns filtered by None values
+        are compared using IS NULL. When :eager_load: is True,
+        `get_eager_load_options` are applied.
+        """
+        keys = tuple(sorted(
+            key for key, value in lookup.items() if value is not None))
+        null_keys = tuple(sorted(
+            key for key, value in lookup.items() if value is None))
+        baked_query = item_bakery(lambda session: session.query(cls), cls)
+        baked_query.add_criteria(
+            lambda query: query.filter(*[
+                getattr(cls, key) == bindparam(key) for key in keys] + [
+                getattr(cls, key).is_(None) for key in null_keys]),
+            keys, null_keys)
+        if eager_load:
+            baked_query.add_criteria(
+                lambda query: query.options(*cls.get_eager_load_options()))
+        baked_query.add_criteria(lambda query: query.limit(1))
+
+        params = {key: lookup[key] for key in keys}
+        try:
+            obj = baked_query(Session()).params(**params).first()
+        except DataError as ex:
+            msg = "'{}({})' resource not found".format(cls.__name__, lookup)
+            raise JHTTPNotFound(msg, explanation=str(ex))
+
+        if obj is None:
+            msg = "'%s(%s)' resource not found" % (cls.__name__, lookup)
+            if raise_on_empty:
+                raise JHTTPNotFound(msg)
+            log.debug(msg)
+        return obj
 
     def unique_fields(self):
-        native_fields = class_mapper(self.__class__).columns
-        return [f for f in native_fields if f.unique or f.primary_key]
+        return list(get_model_metadata(self.__class__).unique_columns)
 
     @classmethod
     def get_or_create(cls, **params):
+        """ Get object matching :params: or create it from :params: and
+        :defaults: dict.
+
+        If :params: are values of unique or primary key columns, object
+        is created atomically using `_upsert`. Otherwise it is queried
+        and then created, which may fail with JHTTPConflict when the same
+        object is created concurrently.
+
+        Returns tuple of (object, created).
+        """
         defaults = params.pop('defaults', {})
         _limit = params.pop('_limit', 1)
+        conflict_columns = cls._get_conflict_columns(params, defaults)
+        if conflict_columns is not None:
+            result = cls._upsert(params, defaults, conflict_columns)
+            if result is not None:
+                return result
         query_set = cls.get_collection(_limit=_limit, **params)
         try:
             obj = query_set.one()
@@ -567,14 +1458,117 @@ class BaseMixin(object):
         except MultipleResultsFound:
             raise JHTTPBadRequest('Bad or Insufficient Params')
 
+    @classmethod
+    def _get_conflict_columns(cls, params, defaults):
+        """ Get columns of unique constraint which consists of :params:
+        fields.
+
+        Returns None if there is no such constraint or object can't be
+        inserted bypassing ORM, e.g. when :params: or :defaults: contain
+        non-column values, model has insert hooks (see
+        `_has_insert_hooks`) or `_upsert_enabled` is False.
+        """
+        columns = get_model_metadata(cls).columns
+        fields = set(params)
+        if not fields or not cls._upsert_enabled or cls._has_insert_hooks():
+            return None
+        values = list(params.items()) + list(defaults.items())
+        for name, value in values:
+            if name not in columns or isinstance(value, (list, dict)):
+                return None
+        for constraint in cls.__table__.constraints:
+            if not isinstance(
+                    constraint, (UniqueConstraint, PrimaryKeyConstraint)):
+                continue
+            if set(col.key for col in constraint.columns) == fields:
+                return list(constraint.columns)
+        return None
+
+    @classmethod
+    def _has_insert_hooks(cls):
+        """ Check whether model has hooks which are not run when rows are
+        inserted bypassing ORM.
+
+        These are 'before_insert' event listeners, validators and
+        'after_insert' listeners other than the one ES signals are set
+        up with.
+        """
+        mapper = cls.__mapper__
+        es_listeners = int(event.contains(
+            cls, 'after_insert', on_after_insert))
+        return bool(
+            mapper.dispatch.before_insert or
+            len(mapper.dispatch.after_insert) > es_listeners or
+            mapper.validators)
+
+    @classmethod
+    def _upsert(cls, params, defaults, conflict_columns):
+        """ Insert object unless row with :params: values of
+        :conflict_columns: exists and return tuple of (object, created).
+
+        On PostgreSQL row is inserted with INSERT ... ON CONFLICT DO
+        NOTHING and returned together with existing row in a single
+        statement. SQLite uses INSERT OR IGNORE followed by a query.
+        Returns None for other databases or if row is not visible yet
+        because it was inserted by concurrent transaction. Raises
+        JHTTPConflict if row conflicts with other unique constraints.
+        """
+        session = Session()
+        session.flush()
+        table = cls.__table__
+        values = dict(defaults)
+        values.update(params)
+        columns = get_model_metadata(cls).columns
+        lookup = and_(*[
+            columns[name] == value for name, value in params.items()])
+        dialect = session.get_bind(cls.__mapper__).dialect.name
+
+        try:
+            if dialect == 'postgresql':
+                inserted = pg_insert(table).values(
+                    values).on_conflict_do_nothing(
+                    index_elements=conflict_columns).returning(*table.c)
+                inserted = inserted.cte('inserted')
+                query = select([inserted, literal(True).label('_created')])
+                query = query.union_all(
+                    select([table, literal(False)]).where(lookup))
+            elif dialect == 'sqlite':
+                result = session.execute(
+                    table.insert().prefix_with('OR IGNORE').values(values))
+                created = result.rowcount == 1
+                query = select([table, literal(created).label('_created')])
+                query = query.where(lookup)
+            else:
+                return None
+
+            # Row may be inserted, so transaction should be committed
+            mark_changed(session)
+            rows = list(session.query(
+                cls, literal_column('_created')).instances(
+                session.execute(query)))
+        except (IntegrityError,) as e:
+            if 'duplicate' not in e.args[0]:
+                raise  # Other error, not duplicate
+
+            raise JHTTPConflict(
+                detail='Resource `{}` already exists.'.format(
+                    cls.__name__),
+                extra={'data': e})
+
+        if not rows:
+            return None
+        obj, created = rows[0]
+        if created:
+            on_bulk_create(cls, [getattr(obj, cls.pk_field())],
+                           session=session)
+        return obj, bool(created)
+
     def _update(self, params, **kw):
         process_bools(params)
         self.check_fields_allowed(list(params.keys()))
-        columns = {c.name: c for c in class_mapper(self.__class__).columns}
-        iter_columns = set(
-            k for k, v in columns.items()
-            if isinstance(v, (DictField, ListField)))
-        pk_field = self.pk_field()
+        metadata = get_model_metadata(self.__class__)
+        iter_columns = metadata.iterable_columns
+        pk_field = metadata.pk_field
 
         for key, new_value in params.items():
             # Can't change PK field
@@ -602,14 +1596,26 @@ class BaseMixin(object):
         and to reindex relationships. This is done explicitly because it is
         impossible to get access to deleted objects in signal handler for
         'after_bulk_delete' ORM event.
+
+        Objects of queryset are only loaded when the model is indexed and
+        their related documents have to be reindexed. Otherwise only
+        primary keys of deleted rows are fetched, using DELETE ...
+        RETURNING on PostgreSQL.
         """
         if isinstance(items, Query):
             del_queryset = cls._clean_queryset(items)
-            del_items = del_queryset.all()
-            del_count = del_queryset.delete(
-                synchronize_session=synchronize_session)
-            on_bulk_delete(cls, del_items, request)
-            return del_count
+            index_enabled = getattr(cls, '_index_enabled', False)
+            if index_enabled and has_indexed_relationships(cls):
+                del_items = del_queryset.all()
+                del_count = del_queryset.delete(
+                    synchronize_session=synchronize_session)
+                on_bulk_delete(cls, del_items, request)
+                return del_count
+            ids = cls._delete_returning_ids(
+                del_queryset, synchronize_session)
+            on_bulk_delete_ids(
+                cls, ids, request, session=del_queryset.session)
+            return len(ids)
         items_count = len(items)
         session = Session()
         for item in items:
@@ -618,6 +1624,26 @@ class BaseMixin(object):
         session.flush()
         return items_count
 
+    @classmethod
+    def _delete_returning_ids(cls, queryset, synchronize_session=False):
+        """ Delete rows of :queryset: and return their primary keys. """
+        session = queryset.session
+        pk_column = getattr(cls, cls.pk_field())
+        dialect = session.get_bind(cls.__mapper__).dialect.name
+        if dialect == 'postgresql' and synchronize_session is False:
+            # Pending changes are flushed like Query.delete() does
+            session.flush()
+            query = cls.__table__.delete().where(
+                queryset.whereclause).returning(pk_column)
+            # Session isn't flushed, so it should be marked as changed
+            # for transaction to be committed
+            mark_changed(session)
+            return [row[0] for row in session.execute(query)]
+        ids = [row[0] for row in queryset.with_entities(pk_column)]
+        if ids:
+            queryset.delete(synchronize_session=synchronize_session)
+        return ids
+
     @classmethod
     def _update_many(cls, items, params, request=None,
                      synchronize_session='fetch'):
@@ -641,6 +1667,81 @@ class BaseMixin(object):
             item.update(params, request)
         return items_count
 
+    @classmethod
+    def bulk_create(cls, items, request=None, chunk_size=1000):
+        """ Create objects from :items: dicts in bulk.
+
+        Items are grouped by sets of their keys and each group is
+        inserted in chunks of :chunk_size: rows. Values are validated
+        by column types when statements are executed. ORM events are
+        not emitted, thus `on_bulk_create` is called to index created
+        objects in bulk.
+
+        When primary keys are not provided, PostgreSQL returns them
+        from a multi-row INSERT ... RETURNING. Other databases insert
+        rows one by one to get generated primary keys.
+
+        Returns list of primary keys of created objects.
+        """
+        if not items:
+            return []
+        metadata = get_model_metadata(cls)
+        fields = set()
+        for item in items:
+            fields.update(item.keys())
+        invalid = fields - set(metadata.columns)
+        if invalid:
+            raise JHTTPBadRequest(
+                "'%s' object does not have fields: %s" % (
+                    cls.__name__, ', '.join(sorted(invalid))))
+
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault(frozenset(item), []).append(item)
+
+        session = Session()
+        session.flush()
+        # Bulk inserts don't flush the session, thus it should be marked
+        # as changed for transaction to be committed
+        mark_changed(session)
+        pk_field = metadata.pk_field
+        created = []
+        try:
+            for item_fields, group in groups.items():
+                for start in range(0, len(group), chunk_size):
+                    chunk = group[start:start + chunk_size]
+                    ids = cls._bulk_insert(
+                        session, chunk, pk_field in item_fields)
+                    on_bulk_create(cls, ids, request, session=session)
+                    created.extend(ids)
+        except (IntegrityError,) as e:
+            if 'duplicate' not in e.args[0]:
+                raise  # Other error, not duplicate
+
+            raise JHTTPConflict(
+                detail='Resource `{}` already exists.'.format(
+                    cls.__name__),
+                extra={'data': e})
+        return created
+
+    @classmethod
+    def _bulk_insert(cls, session, items, has_pk):
+        """ Insert :items: which have the same set of keys and return
+        their primary keys.
+        """
+        pk_field = cls.pk_field()
+        if has_pk:
+            session.bulk_insert_mappings(cls, items)
+            return [item[pk_field] for item in items]
+        if session.get_bind(cls.__mapper__).dialect.name == 'postgresql':
+            pk_column = cls.__table__.c[pk_field]
+            query = cls.__table__.insert().values(items).returning(
+                pk_column)
+            return [row[0] for row in session.execute(query)]
+        mappings = [dict(item) for item in items]
+        session.bulk_insert_mappings(cls, mappings, return_defaults=True)
+        return [mapping[pk_field] for mapping in mappings]
+
     @classmethod
     def _clean_queryset(cls, queryset):
         """ Clean :queryset: from explicit limit, offset, etc.
@@ -662,9 +1763,9 @@ class BaseMixin(object):
 
     @classmethod
     def get_by_ids(cls, ids, **params):
-        query_set = cls.get_collection(**params)
         cls_id = getattr(cls, cls.pk_field())
-        return query_set.from_self().filter(cls_id.in_(ids)).limit(len(ids))
+        params['query_set'] = Session().query(cls).filter(cls_id.in_(ids))
+        return cls.get_collection(**params)
 
     @classmethod
     def get_null_values(cls):
@@ -687,37 +1788,13 @@ class BaseMixin(object):
         _depth = kwargs.get('_depth')
         if _depth is None:
             _depth = self._nesting_depth
-        depth_reached = _depth is not None and _depth <= 0
-
-        _data = dictset()
-        native_fields = self.__class__.native_fields()
-        for field in native_fields:
-            value = getattr(self, field, None)
-
-            include = field in self._nested_relationships
-            if not include or depth_reached:
-                encoder = lambda v: getattr(v, v.pk_field(), None)
-            else:
-                encoder = lambda v: v.to_dict(_depth=_depth-1)
-
-            if isinstance(value, BaseMixin):
-                value = encoder(value)
-            elif isinstance(value, InstrumentedList):
-                value = [encoder(val) for val in value]
-            elif hasattr(value, 'to_dict'):
-                value = value.to_dict(_depth=_depth-1)
-
-            _data[field] = value
-        _data['_type'] = self._type
-        _data['_pk'] = str(getattr(self, self.pk_field()))
-        return _data
+        return get_serializer(self.__class__, _depth)(self)
 
     def update_iterables(self, params, attr, unique=False,
                          value_type=None, save=True,
                          request=None):
         self._request = request
-        mapper = class_mapper(self.__class__)
-        columns = {c.name: c for c in mapper.columns}
+        columns = get_model_metadata(self.__class__).columns
         is_dict = isinstance(columns.get(attr), DictField)
         is_list = isinstance(columns.get(attr), ListField)
 
@@ -797,28 +1874,44 @@ class BaseMixin(object):
           :instances: Model class instance(s) contained in field
 
         :param nested_only: Boolean, defaults to False. When True, return
-            results only contain data for models on which current model
-            and field are nested.
+            results only contain data for models documents of which
+            contain nested copies of current object, including models
+            which nest it through other models. See `get_nesting_graph`.
         """
-        iter_props = class_mapper(self.__class__).iterate_properties
-        backref_props = [p for p in iter_props
-                         if isinstance(p, properties.RelationshipProperty)]
-
-        for prop in backref_props:
+        if nested_only:
+            paths = get_nesting_graph().get(self.__class__, ())
+            for path, model_cls in paths:
+                documents = self._get_path_documents(path)
+                if documents:
+                    yield (model_cls, documents)
+            return
+
+        relationships = get_model_metadata(self.__class__).relationships
+        for prop in relationships.values():
             value = getattr(self, prop.key)
             # Do not index empty values
             if not value:
                 continue
             if not isinstance(value, list):
                 value = [value]
-            model_cls = value[0].__class__
+            yield (value[0].__class__, value)
 
-            if nested_only:
-                backref = prop.back_populates
-                if backref and backref not in model_cls._nested_relationships:
+    def _get_path_documents(self, path):
+        """ Get list of objects related to current object through
+        relationships named in :path:.
+        """
+        documents = [self]
+        for name in path:
+            related = OrderedDict()
+            for document in documents:
+                value = getattr(document, name)
+                if value is None:
                     continue
-
-            yield (model_cls, value)
+                if not isinstance(value, list):
+                    value = [value]
+                related.update((obj, None) for obj in value)
+            documents = list(related)
+        return documents
 
     def _is_modified(self):
         """ Determine if instance is modified.
@@ -1,6 +1,6 @@
+from sqlalchemy import event
 from sqlalchemy.orm import backref, relationship
-from sqlalchemy.schema import Column, ForeignKey
-from sqlalchemy_utils.types.json import JSONType
+from sqlalchemy.schema import DDL, Column, ForeignKey
 
 # Since SQLAlchemy 1.0.0
 # from sqlalchemy.types import MatchType
@@ -23,6 +23,7 @@ from .types import (
     Time,
     Choice,
     ChoiceArray,
+    JSONDict,
 )
 
 
@@ -264,8 +265,31 @@ class UnicodeTextField(StringField):
     _sqla_type_cls = LimitedUnicodeText
 
 
-class DictField(BaseField):
-    _sqla_type_cls = JSONType
+class GinIndexMixin(object):
+    """ Mixin for fields which may be indexed with GIN index on
+    PostgreSQL.
+
+    Index is created when field is initialized with `gin_index=True`.
+    It is created after the table using DDL statement which is only
+    executed on PostgreSQL, as other databases don't support GIN.
+    """
+    def __init__(self, *args, **kwargs):
+        super(GinIndexMixin, self).__init__(*args, **kwargs)
+        self.gin_index = self._kwargs_backup.get('gin_index', False)
+
+    def _set_parent(self, table):
+        super(GinIndexMixin, self)._set_parent(table)
+        if not self.gin_index:
+            return
+        ddl = DDL(
+            'CREATE INDEX "ix_%(table)s_{0}_gin" ON %(fullname)s '
+            'USING gin ("{0}")'.format(self.name))
+        event.listen(
+            table, 'after_create', ddl.execute_if(dialect='postgresql'))
+
+
+class DictField(GinIndexMixin, BaseField):
+    _sqla_type_cls = JSONDict
     _type_unchanged_kwargs = ()
 
     def process_type_args(self, kwargs):
@@ -275,7 +299,7 @@ class DictField(BaseField):
         return type_args, type_kw, cleaned_kw
 
 
-class ListField(BaseField):
+class ListField(GinIndexMixin, BaseField):
     _sqla_type_cls = ChoiceArray
     _type_unchanged_kwargs = (
         'as_tuple', 'dimensions', 'zero_indexes', 'choices')
@@ -447,6 +471,28 @@ class ForeignKeyField(BaseSchemaItemField):
         return super(ForeignKeyField, self)._generate_schema_item(cleaned_kw)
 
 
+# Loading strategies that may be used as a default for relationships
+RELATIONSHIP_LAZY_CHOICES = ('immediate', 'select', 'selectin', 'raise')
+
+# Default loading strategy of 'One' sides of relationships. Change it
+# with `set_relationship_lazy`
+RELATIONSHIP_LAZY = 'immediate'
+
+
+def set_relationship_lazy(lazy):
+    """ Set default loading strategy of 'One' sides of relationships
+    created by `Relationship` afterwards.
+
+    :param lazy: One of `RELATIONSHIP_LAZY_CHOICES`.
+    """
+    global RELATIONSHIP_LAZY
+    if lazy not in RELATIONSHIP_LAZY_CHOICES:
+        raise ValueError(
+            'Invalid relationship loading strategy `{}`. Must be one '
+            'of: {}'.format(lazy, ', '.join(RELATIONSHIP_LAZY_CHOICES)))
+    RELATIONSHIP_LAZY = lazy
+
+
 relationship_kwargs = {
     'secondary', 'primaryjoin', 'secondaryjoin',
     'foreign_keys', 'uselist', 'order_by',
@@ -472,10 +518,18 @@ def Relationship(**kwargs):
     and makes a call like:
         relationship(..., ..., backref=backref(...))
 
-    :lazy: setting is set to 'immediate' on the 'One' side of One2One or
-    One2Many relationships. This is done both for relationship itself
-    and backref so ORM 'after_update' events are fired when relationship
-    is updated. For backref 'uselist' is assumed to be False by default.
+    Unless provided explicitly, :lazy: setting of the 'One' side of
+    One2One or One2Many relationships is set to `RELATIONSHIP_LAZY`,
+    which defaults to 'immediate'. This is done both for relationship
+    itself and backref. For backref 'uselist' is assumed to be False by
+    default. Use `set_relationship_lazy` or
+    'nefertari_sqla.relationship_lazy' setting to change the default
+    to 'select', 'selectin' or 'raise'.
+
+    Loading strategy does not affect ES reindexing of objects that were
+    previously related to an updated object: they are found using
+    history of foreign key columns. Relationships configured with 'raise'
+    are loaded explicitly when objects are indexed.
 
     From SQLAlchemy docs: immediate - items should be loaded as the parents
     are loaded, using a separate SELECT statement, or identity map fetch for
@@ -504,11 +558,11 @@ def Relationship(**kwargs):
 
     rel_document = rel_kw.pop('document')
     if 'uselist' in rel_kw and not rel_kw['uselist']:
-        rel_kw['lazy'] = 'immediate'
+        rel_kw.setdefault('lazy', RELATIONSHIP_LAZY)
 
     if backref_kw:
         if not backref_kw.get('uselist'):
-            backref_kw['lazy'] = 'immediate'
+            backref_kw.setdefault('lazy', RELATIONSHIP_LAZY)
         backref_name = backref_kw.pop('name')
         rel_kw['backref'] = backref(backref_name, **backref_kw)
 
@@ -0,0 +1,233 @@
+""" In-process background indexer.
+
+`BackgroundIndexer` accepts index/delete actions of committed
+transactions and sends them to ES from a pool of worker threads, so
+requests don't wait for ES to acknowledge changes. Set it with
+`signals.set_indexer` or 'nefertari_sqla.background_indexer' setting.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import six
+
+from .signals import OP_DELETE, OP_UPDATE, es_bulk, set_indexer
+
+
+log = logging.getLogger(__name__)
+
+
+class BackgroundIndexer(object):
+    """ Index documents in bulk using a pool of worker threads.
+
+    Submitted actions are kept in a bounded queue keyed by model name
+    and primary key, so repeated changes of the same document are
+    coalesced and only the last one is sent. Partial updates are merged
+    into queued actions. Workers send queued actions
+    once `flush_size` actions are queued or the oldest of them waited for
+    `flush_interval` seconds. Actions of a document being sent are not
+    sent by other workers until it is finished, which preserves order of
+    changes.
+
+    Pyramid requests are not passed to background threads, thus
+    request-specific ES options, like index refresh, are not applied.
+
+    :param bulk: Callable which sends list of (op, model_name, document)
+        actions to ES. Defaults to `signals.es_bulk`.
+    :param workers: Number of worker threads.
+    :param max_queue_size: Max number of queued documents. `submit`
+        blocks until there is enough space in the queue.
+    :param flush_size: Max number of actions sent at once.
+    :param flush_interval: Max number of seconds actions wait in queue.
+    """
+    def __init__(self, bulk=es_bulk, workers=1, max_queue_size=10000,
+                 flush_size=500, flush_interval=1.0):
+        self.bulk = bulk
+        self.max_queue_size = max_queue_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._queue = OrderedDict()
+        self._queued_at = {}
+        self._in_flight = set()
+        self._flushing = False
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._stats = {
+            'submitted': 0,
+            'coalesced': 0,
+            'sent': 0,
+            'failed': 0,
+            'flushes': 0,
+            'last_flush_latency': None,
+            'max_flush_latency': None,
+        }
+        self._flush_latency_total = 0.0
+        self._threads = []
+        for index in range(workers):
+            thread = threading.Thread(
+                target=self._run,
+                name='nefertari-sqla-indexer-{}'.format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, actions):
+        """ Queue (op, model_name, document) :actions:.
+
+        Blocks while queue is full.
+        """
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError('Indexer is shut down')
+            for op, model_name, document in actions:
+                obj_id = document if op == OP_DELETE else document['_pk']
+                key = (model_name, six.text_type(obj_id))
+                if key in self._queue:
+                    self._stats['coalesced'] += 1
+                    queued_op, _, queued = self._queue[key]
+                    if op == OP_UPDATE:
+                        # Partial update can't replace queued action
+                        if queued_op == OP_DELETE:
+                            continue
+                        op, document = queued_op, dict(queued, **document)
+                    self._queue[key] = (op, model_name, document)
+                    continue
+                while len(self._queue) >= self.max_queue_size:
+                    self._condition.wait()
+                self._queue[key] = (op, model_name, document)
+                self._queued_at[key] = time.time()
+                self._stats['submitted'] += 1
+            self._condition.notify_all()
+
+    def _take_actions(self):
+        """ Wait for actions which should be sent and take them from the
+        queue.
+
+        Returns tuple of (keys, actions) or None if indexer is stopped.
+        """
+        with self._condition:
+            while True:
+                ready = [key for key in self._queue
+                         if key not in self._in_flight]
+                if ready:
+                    oldest = self._queued_at[ready[0]]
+                    due = (self._flushing or self._stopped or
+                           len(ready) >= self.flush_size or
+                           time.time() - oldest >= self.flush_interval)
+                    if due:
+                        keys = ready[:self.flush_size]
+                        actions = [self._queue.pop(key) for key in keys]
+                        for key in keys:
+                            del self._queued_at[key]
+                        self._in_flight.update(keys)
+                        self._condition.notify_all()
+                        return keys, actions
+                    timeout = oldest + self.flush_interval - time.time()
+                elif self._stopped:
+                    return None
+                else:
+                    timeout = None
+                self._condition.wait(timeout)
+
+    def _run(self):
+        while True:
+            taken = self._take_actions()
+            if taken is None:
+                return
+            keys, actions = taken
+            started = time.time()
+            try:
+                self.bulk(actions)
+            except Exception:
+                failed = True
+                log.exception('Failed to index %s documents', len(actions))
+            else:
+                failed = False
+            latency = time.time() - started
+            with self._condition:
+                self._in_flight.difference_update(keys)
+                stats = self._stats
+                stats['failed' if failed else 'sent'] += len(actions)
+                stats['flushes'] += 1
+                stats['last_flush_latency'] = latency
+                stats['max_flush_latency'] = max(
+                    latency, stats['max_flush_latency'] or 0)
+                self._flush_latency_total += latency
+                self._condition.notify_all()
+
+    @property
+    def queue_depth(self):
+        """ Number of queued documents. """
+        with self._condition:
+            return len(self._queue)
+
+    def stats(self):
+        """ Get dict of indexer statistics.
+
+        Includes queue depth, number of submitted, coalesced, sent and
+        failed actions and latencies of `bulk` calls in seconds.
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._queue)
+            stats['in_flight'] = len(self._in_flight)
+            stats['avg_flush_latency'] = (
+                self._flush_latency_total / stats['flushes']
+                if stats['flushes'] else None)
+            return stats
+
+    def flush(self, timeout=None):
+        """ Send all queued actions and wait until they are sent.
+
+        Returns False if :timeout: expired before that.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            self._flushing = True
+            self._condition.notify_all()
+            try:
+                while self._queue or self._in_flight:
+                    if deadline is None:
+                        self._condition.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                return True
+            finally:
+                self._flushing = False
+
+    def shutdown(self, timeout=None):
+        """ Send queued actions and stop worker threads. """
+        with self._condition:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+def setup_indexer(settings):
+    """ Create `BackgroundIndexer` configured by :settings: and set it
+    using `signals.set_indexer`.
+
+    Supported settings:
+        nefertari_sqla.background_indexer.workers
+        nefertari_sqla.background_indexer.max_queue_size
+        nefertari_sqla.background_indexer.flush_size
+        nefertari_sqla.background_indexer.flush_interval
+    """
+    prefix = 'nefertari_sqla.background_indexer.'
+    options = {}
+    for name, type_ in (('workers', int), ('max_queue_size', int),
+                        ('flush_size', int), ('flush_interval', float)):
+        if prefix + name in settings:
+            options[name] = type_(settings[prefix + name])
+    indexer = BackgroundIndexer(**options)
+    set_indexer(indexer)
+    atexit.register(indexer.shutdown)
+    return indexer
@@ -0,0 +1,274 @@
+""" Bulk loader of large amounts of rows.
+
+On PostgreSQL rows are streamed into model table using
+`COPY ... FROM STDIN`, other databases insert them in batches using
+executemany. Values are validated by column types before they are
+loaded, and loaded rows are reindexed by primary key range afterwards.
+"""
+import binascii
+import datetime
+import io
+import json
+import logging
+
+import six
+from sqlalchemy import func
+from sqlalchemy.orm import Session as BaseSession
+from sqlalchemy.types import TypeDecorator
+from pyramid_sqlalchemy import Session
+from zope.sqlalchemy import mark_changed
+
+from .documents import get_model_metadata
+from .reindex import reindex_range
+
+
+log = logging.getLogger(__name__)
+
+
+# Characters escaped in values of COPY text format
+COPY_ESCAPES = (
+    ('\\', '\\\\'),
+    ('\t', '\\t'),
+    ('\n', '\\n'),
+    ('\r', '\\r'),
+)
+
+COPY_NULL = '\\N'
+
+
+def format_copy_scalar(value):
+    """ Format :value: as text PostgreSQL parses to a column value. """
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, dict):
+        return json.dumps(value)
+    if isinstance(value, datetime.timedelta):
+        return '{} seconds'.format(value.total_seconds())
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, six.binary_type):
+        return '\\x' + binascii.hexlify(value).decode('ascii')
+    return six.text_type(value)
+
+
+def format_copy_array(value):
+    """ Format list :value: as PostgreSQL array literal. """
+    items = []
+    for item in value:
+        if item is None:
+            items.append('NULL')
+            continue
+        item = format_copy_scalar(item)
+        item = item.replace('\\', '\\\\').replace('"', '\\"')
+        items.append('"{}"'.format(item))
+    return '{' + ','.join(items) + '}'
+
+
+def format_copy_value(value):
+    """ Format :value: as a field of COPY text format. """
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, (list, tuple)):
+        value = format_copy_array(value)
+    else:
+        value = format_copy_scalar(value)
+    for char, escaped in COPY_ESCAPES:
+        value = value.replace(char, escaped)
+    return value
+
+
+def iter_chunks(rows, chunk_size):
+    """ Split :rows: iterable into lists of :chunk_size: rows. """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BulkLoader(object):
+    """ Load rows into table of :model_cls:.
+
+    Rows are dicts of {field_name: value}. Fields of the first row are
+    loaded unless :fields: are provided; missing values are loaded as
+    NULLs. Python-side column defaults are applied to fields which are
+    not loaded. ORM events are not emitted for loaded rows.
+
+    Primary key range of loaded rows is tracked, thus models should have
+    integer primary keys, either provided in rows or generated by DB.
+
+    :param model_cls: Model class.
+    :param fields: Names of fields to load.
+    :param session: Session rows are loaded in. Defaults to
+        `pyramid_sqlalchemy.Session`.
+    :param chunk_size: Number of rows validated and sent to DB at once.
+    """
+    def __init__(self, model_cls, fields=None, session=None,
+                 chunk_size=10000):
+        if session is None:
+            session = Session()
+        self.model_cls = model_cls
+        self.fields = fields
+        self.session = session
+        self.chunk_size = chunk_size
+        self.metadata = get_model_metadata(model_cls)
+        self.table = model_cls.__table__
+        self.dialect = session.get_bind(model_cls.__mapper__).dialect
+
+    @property
+    def is_postgresql(self):
+        return self.dialect.name == 'postgresql'
+
+    def get_defaults(self, fields):
+        """ Get dict of Python-side defaults of columns which are not in
+        :fields:. Values are generated by `get_default_values`.
+        """
+        defaults = {}
+        for name, column in self.metadata.columns.items():
+            default = column.default
+            if name in fields or default is None:
+                continue
+            if default.is_callable or default.is_scalar:
+                defaults[name] = default
+        return defaults
+
+    @staticmethod
+    def get_default_values(default, count):
+        """ Get list of :count: values of column :default:.
+
+        Callable defaults are called for each row, like they are when
+        rows are inserted one by one.
+        """
+        if default.is_callable:
+            return [default.arg(None) for _ in range(count)]
+        return [default.arg] * count
+
+    def validate(self, fields, columns):
+        """ Validate and process :columns: values lists of :fields:
+        using `process_bind_param` of column types.
+
+        Values are processed column by column, so type lookups are done
+        once per chunk. Returns list of processed values lists.
+        """
+        processed = []
+        for name, values in zip(fields, columns):
+            column_type = self.metadata.columns[name].type
+            process = getattr(column_type, 'process_bind_param', None)
+            if (process is None or type(column_type).process_bind_param is
+                    TypeDecorator.process_bind_param):
+                processed.append(values)
+                continue
+            try:
+                processed.append([
+                    process(value, self.dialect) for value in values])
+            except ValueError as ex:
+                raise ValueError('Field `{}`: {}'.format(name, ex))
+        return processed
+
+    def copy_chunk(self, fields, columns):
+        """ Load :columns: of processed values using COPY. """
+        preparer = self.dialect.identifier_preparer
+        statement = 'COPY {} ({}) FROM STDIN'.format(
+            preparer.format_table(self.table),
+            ', '.join(preparer.quote(self.table.c[name].name)
+                      for name in fields))
+        data = io.StringIO()
+        for row in zip(*columns):
+            data.write(u'\t'.join(
+                format_copy_value(value) for value in row))
+            data.write(u'\n')
+        data.seek(0)
+        connection = self.session.connection()
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(statement, data)
+        finally:
+            cursor.close()
+
+    def insert_chunk(self, fields, rows):
+        """ Insert :rows: dicts using executemany. """
+        self.session.execute(self.table.insert(), rows)
+
+    def get_max_pk(self):
+        pk_column = getattr(self.model_cls, self.metadata.pk_field)
+        return self.session.query(func.max(pk_column)).scalar()
+
+    def load_chunk(self, fields, defaults, chunk):
+        columns = [[row.get(name) for row in chunk] for name in fields]
+        columns += [self.get_default_values(default, len(chunk))
+                    for default in defaults.values()]
+        fields = list(fields) + list(defaults)
+        processed = self.validate(fields, columns)
+        if self.is_postgresql:
+            self.copy_chunk(fields, processed)
+        else:
+            rows = [dict(zip(fields, row)) for row in zip(*columns)]
+            self.insert_chunk(fields, rows)
+
+    def load(self, rows):
+        """ Load :rows: iterable in chunks.
+
+        Returns tuple of (count, lower, upper) where :count: is number of
+        loaded rows and (:lower:, :upper:] is primary key range they
+        were loaded to. Range is suitable for `reindex.reindex_range`.
+        """
+        self.session.flush()
+        # Rows are loaded bypassing session, thus it should be marked
+        # as changed for transaction to be committed
+        mark_changed(self.session)
+        pk_field = self.metadata.pk_field
+        fields = self.fields
+        defaults = None
+        max_pk = self.get_max_pk()
+        lower = upper = None
+        count = 0
+        for chunk in iter_chunks(rows, self.chunk_size):
+            if fields is None:
+                fields = list(chunk[0].keys())
+            if defaults is None:
+                defaults = self.get_defaults(fields)
+            if pk_field in fields:
+                pks = [row[pk_field] for row in chunk]
+                lower = min(pks) - 1 if lower is None else min(
+                    lower, min(pks) - 1)
+                upper = max(pks) if upper is None else max(upper, max(pks))
+            self.load_chunk(fields, defaults, chunk)
+            count += len(chunk)
+            log.debug('Loaded %s rows of `%s`', count,
+                      self.model_cls.__name__)
+
+        if fields is not None and pk_field not in fields:
+            lower = max_pk
+            upper = self.get_max_pk()
+        return count, lower, upper
+
+
+def bulk_load(model_cls, rows, fields=None, session=None,
+              chunk_size=10000, reindex=True, batch_size=1000):
+    """ Load :rows: into table of :model_cls: using `BulkLoader` and
+    reindex loaded rows if model is indexed in ES.
+
+    Loaded rows are reindexed in batches of :batch_size: documents
+    before transaction is committed. They are queried by a separate
+    session which uses connection of :session:, so objects of
+    :session: are not affected. Pass :reindex: False to load rows only
+    and reindex returned range with `reindex.reindex_range` once
+    transaction is committed.
+
+    Returns tuple of (count, lower, upper). See `BulkLoader.load`.
+    """
+    loader = BulkLoader(
+        model_cls, fields=fields, session=session, chunk_size=chunk_size)
+    count, lower, upper = loader.load(rows)
+    if reindex and count and getattr(model_cls, '_index_enabled', False):
+        reindex_session = BaseSession(bind=loader.session.connection())
+        try:
+            reindex_range(
+                model_cls, lower, upper, session=reindex_session,
+                batch_size=batch_size)
+        finally:
+            reindex_session.close()
+    return count, lower, upper
@@ -0,0 +1,242 @@
+""" Transactional outbox for ES synchronization.
+
+When outbox is enabled, changes of `ESMetaclass` models are not sent to
+ES from request threads. Instead (model, pk, op) rows are written to
+outbox table in the same transaction as changes themselves, and
+`OutboxWorker` indexes them in bulk afterwards. Thus documents are
+indexed even if ES is not available when transaction is committed.
+"""
+import json
+import logging
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+
+import six
+from sqlalchemy import (
+    Table, Column, Integer, Unicode, UnicodeText, DateTime)
+from sqlalchemy.orm import sessionmaker
+from pyramid_sqlalchemy import BaseObject
+
+from .signals import (
+    IndexBatch, OP_INDEX, OP_DELETE, load_for_indexing, es_bulk)
+
+
+log = logging.getLogger(__name__)
+
+
+OUTBOX_TABLE_NAME = 'nefertari_es_outbox'
+
+# Whether changes are written to outbox table. See `enable_outbox`.
+OUTBOX_ENABLED = False
+
+
+def get_outbox_table(metadata=None):
+    """ Get outbox table defining it in :metadata: if it's not defined
+    yet.
+
+    Table is only defined once outbox is used, so it is not created for
+    applications which don't use it.
+
+    :param metadata: Instance of `sqlalchemy.MetaData`. Defaults to
+        metadata of `pyramid_sqlalchemy.BaseObject`.
+    """
+    if metadata is None:
+        metadata = BaseObject.metadata
+    if OUTBOX_TABLE_NAME in metadata.tables:
+        return metadata.tables[OUTBOX_TABLE_NAME]
+    return Table(
+        OUTBOX_TABLE_NAME, metadata,
+        Column('id', Integer, primary_key=True, autoincrement=True),
+        Column('model', Unicode(255), nullable=False),
+        Column('pk', UnicodeText, nullable=False),
+        Column('op', Unicode(10), nullable=False),
+        Column('created_at', DateTime, default=datetime.utcnow),
+    )
+
+
+def enable_outbox(enabled=True):
+    """ Enable or disable writing changes to outbox table.
+
+    Should be called before DB tables are created, so outbox table
+    is created as well.
+    """
+    global OUTBOX_ENABLED
+    OUTBOX_ENABLED = bool(enabled)
+    if OUTBOX_ENABLED:
+        get_outbox_table()
+
+
+def encode_pk(value):
+    """ Encode primary key :value: to be stored in outbox table. """
+    if not isinstance(value, six.integer_types + (float,)):
+        value = six.text_type(value)
+    return json.dumps(value)
+
+
+def decode_pk(value):
+    return json.loads(value)
+
+
+class OutboxBatch(IndexBatch):
+    """ `IndexBatch` which writes collected changes to outbox table
+    instead of sending them to ES.
+
+    Rows are inserted after each flush using connection of the session,
+    so they are committed or rolled back together with the changes.
+    """
+    def prepare(self, obj):
+        return OP_INDEX
+
+    def update(self, model_name, obj_id, fields, request=None):
+        # Documents are loaded by worker, so they are reindexed fully
+        key = (model_name, obj_id)
+        deleted = key in self.documents and self.documents[key] is None
+        if key not in self.objects and not deleted:
+            self.documents[key] = OP_INDEX
+
+    def collected(self, session):
+        if not self.documents:
+            return
+        rows = [{
+            'model': model_name,
+            'pk': encode_pk(obj_id),
+            'op': OP_DELETE if op is None else op,
+        } for (model_name, obj_id), op in self.documents.items()]
+        session.execute(get_outbox_table().insert(), rows)
+        self.documents = OrderedDict()
+
+
+class OutboxWorker(object):
+    """ Index changes written to outbox table.
+
+    Rows are processed in chunks in the order they were written. Changes
+    of the same document within a chunk are coalesced, so only the last
+    operation is sent. Documents are loaded from DB when chunk is
+    processed, thus repeated processing of the same rows is idempotent.
+    Rows are deleted only after `bulk` succeeds.
+
+    :param bind: Engine or connection used to read outbox table and to
+        load documents.
+    :param bulk: Callable which sends list of actions to ES. Defaults to
+        `es_bulk`.
+    :param chunk_size: Max number of outbox rows processed at once.
+    :param max_retries: Number of times failed `bulk` call is retried.
+    :param retry_delay: Delay in seconds before the first retry. Delay is
+        doubled after each retry.
+    """
+    def __init__(self, bind, bulk=es_bulk, chunk_size=500, max_retries=3,
+                 retry_delay=1.0):
+        self.session_factory = sessionmaker(bind=bind)
+        self.bulk = bulk
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+    def get_actions(self, session, rows):
+        """ Coalesce outbox :rows: and build actions to be sent to ES.
+
+        Documents which should be indexed but don't exist anymore are
+        deleted.
+        """
+        from .documents import get_document_cls
+        changes = OrderedDict()
+        for row in rows:
+            key = (row.model, row.pk)
+            changes.pop(key, None)
+            changes[key] = row.op
+
+        to_load = defaultdict(list)
+        for (model_name, pk), op in changes.items():
+            if op == OP_INDEX:
+                to_load[model_name].append(pk)
+
+        loaded = {}
+        for model_name, pks in to_load.items():
+            model_cls = get_document_cls(model_name)
+            pk_field = model_cls.pk_field()
+            pk_column = getattr(model_cls, pk_field)
+            query = session.query(model_cls).filter(
+                pk_column.in_([decode_pk(pk) for pk in pks]))
+            for obj in query:
+                load_for_indexing(obj)
+                pk = encode_pk(getattr(obj, pk_field))
+                loaded[(model_name, pk)] = obj.to_dict()
+
+        actions = []
+        for (model_name, pk), op in changes.items():
+            document = loaded.get((model_name, pk))
+            if op == OP_INDEX and document is not None:
+                actions.append((OP_INDEX, model_name, document))
+            else:
+                actions.append((OP_DELETE, model_name, decode_pk(pk)))
+        return actions
+
+    def send(self, actions):
+        """ Call `bulk` with :actions: retrying it on failure. """
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.bulk(actions)
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                log.warning(
+                    'Failed to send outbox actions, retrying in %s s',
+                    delay, exc_info=True)
+                time.sleep(delay)
+                delay *= 2
+
+    def process_chunk(self):
+        """ Process a chunk of outbox rows.
+
+        Returns number of processed rows.
+        """
+        table = get_outbox_table()
+        session = self.session_factory()
+        try:
+            query = table.select().order_by(table.c.id).limit(
+                self.chunk_size).with_for_update(skip_locked=True)
+            rows = session.execute(query).fetchall()
+            if not rows:
+                session.rollback()
+                return 0
+            self.send(self.get_actions(session, rows))
+            session.execute(table.delete().where(
+                table.c.id.in_([row.id for row in rows])))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        log.debug('Processed %s outbox rows', len(rows))
+        return len(rows)
+
+    def drain(self):
+        """ Process outbox rows until outbox is empty.
+
+        Returns number of processed rows.
+        """
+        total = 0
+        while True:
+            processed = self.process_chunk()
+            total += processed
+            if processed < self.chunk_size:
+                return total
+
+    def run(self, poll_interval=1.0, stop_event=None):
+        """ Drain outbox every :poll_interval: seconds until
+        :stop_event: is set.
+
+        :param stop_event: `threading.Event` instance.
+        """
+        while stop_event is None or not stop_event.is_set():
+            try:
+                self.drain()
+            except Exception:
+                log.exception('Failed to process outbox')
+            if stop_event is None:
+                time.sleep(poll_interval)
+            else:
+                stop_event.wait(poll_interval)
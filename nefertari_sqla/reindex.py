@@ -0,0 +1,288 @@
+""" Rebuild ES index from database.
+
+Tables are split into primary key ranges which are indexed in parallel
+by a pool of processes. Completed ranges are stored in a checkpoint file,
+so an interrupted reindex may be resumed.
+
+Usage:
+    nefertari_sqla.reindex -c config.ini [--models Story,User]
+        [--processes 4] [--chunk 10000] [--checkpoint reindex.json]
+"""
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+from pyramid_sqlalchemy import Session
+
+from .documents import get_document_cls, get_document_classes
+from .signals import OP_INDEX, es_bulk, load_for_indexing
+
+
+log = logging.getLogger(__name__)
+
+
+def get_pk_ranges(session, model_cls, chunk_size):
+    """ Split table of :model_cls: into primary key ranges each of
+    which contains at most :chunk_size: rows.
+
+    Returns list of (lower, upper) tuples where :lower: is an exclusive
+    and :upper: is an inclusive boundary. None means no boundary.
+    Boundaries are found using index on primary key column.
+    """
+    pk_column = getattr(model_cls, model_cls.pk_field())
+    ranges = []
+    lower = None
+    while True:
+        query = session.query(pk_column).order_by(pk_column)
+        if lower is not None:
+            query = query.filter(pk_column > lower)
+        upper = query.offset(chunk_size - 1).limit(1).scalar()
+        if upper is None:
+            ranges.append((lower, None))
+            return ranges
+        ranges.append((lower, upper))
+        lower = upper
+
+
+def reindex_range(model_cls, lower, upper, session=None, batch_size=1000,
+                  bulk=None):
+    """ Index documents of :model_cls: with primary keys in range
+    (:lower:, :upper:].
+
+    Rows are streamed using `Query.yield_per` and indexed in batches of
+    :batch_size: documents. Relationships accessed by `to_dict` are
+    loaded eagerly.
+
+    :param bulk: Callable documents are sent with. Defaults to
+        `signals.es_bulk`.
+
+    Returns number of indexed documents.
+    """
+    if session is None:
+        session = Session()
+    if bulk is None:
+        bulk = es_bulk
+    pk_column = getattr(model_cls, model_cls.pk_field())
+    query = session.query(model_cls).order_by(pk_column)
+    if lower is not None:
+        query = query.filter(pk_column > lower)
+    if upper is not None:
+        query = query.filter(pk_column <= upper)
+    query = query.options(*model_cls.get_eager_load_options())
+    query = query.execution_options(stream_results=True)
+
+    model_name = model_cls.__name__
+    count = 0
+    actions = []
+    for obj in query.yield_per(batch_size):
+        load_for_indexing(obj)
+        actions.append((OP_INDEX, model_name, obj.to_dict()))
+        if len(actions) >= batch_size:
+            bulk(actions)
+            count += len(actions)
+            actions = []
+            session.expunge_all()
+    if actions:
+        bulk(actions)
+        count += len(actions)
+    session.expunge_all()
+    return count
+
+
+def _reindex_task(task):
+    """ Reindex range described by :task: in a worker process. """
+    model_name, index, lower, upper, batch_size = task
+    model_cls = get_document_cls(model_name)
+    try:
+        count = reindex_range(model_cls, lower, upper, batch_size=batch_size)
+    finally:
+        Session.remove()
+    return model_name, index, count
+
+
+class Checkpoint(object):
+    """ Ranges of models and indexes of ranges which are already
+    reindexed, stored in JSON file at :path:.
+
+    Data is written to a temporary file which then replaces :path:, so
+    checkpoint is not corrupted if the process is killed.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.data = json.load(checkpoint_file)
+
+    def get_ranges(self, model_name):
+        model_data = self.data.get(model_name)
+        if model_data is None:
+            return None
+        return [tuple(pk_range) for pk_range in model_data['ranges']]
+
+    def set_ranges(self, model_name, ranges):
+        self.data[model_name] = {'ranges': ranges, 'done': []}
+        self.save()
+
+    def get_done(self, model_name):
+        return set(self.data.get(model_name, {}).get('done', []))
+
+    def mark_done(self, model_name, index):
+        self.data[model_name]['done'].append(index)
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(self.data, checkpoint_file, default=str)
+        os.rename(tmp_path, self.path)
+
+
+class Reindexer(object):
+    """ Reindex documents of models in parallel.
+
+    :param model_names: Names of models to reindex. Defaults to all
+        ES-enabled models.
+    :param chunk_size: Max number of rows in a primary key range.
+    :param processes: Number of worker processes. If 1, ranges are
+        reindexed in the current process.
+    :param checkpoint: Path to checkpoint file.
+    :param batch_size: Number of documents sent to ES at once.
+    :param initializer: Callable run in each worker process before
+        reindexing. Should setup DB and ES connections.
+    :param initargs: Arguments of :initializer:.
+    """
+    def __init__(self, model_names=None, chunk_size=10000, processes=1,
+                 checkpoint=None, batch_size=1000, initializer=None,
+                 initargs=()):
+        if model_names is None:
+            model_names = sorted(
+                name for name, model in get_document_classes().items()
+                if getattr(model, '_index_enabled', False))
+        self.model_names = model_names
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.checkpoint = Checkpoint(checkpoint)
+        self.batch_size = batch_size
+        self.initializer = initializer
+        self.initargs = initargs
+
+    def get_tasks(self):
+        """ Split models into ranges which are not reindexed yet. """
+        session = Session()
+        tasks = []
+        for model_name in self.model_names:
+            ranges = self.checkpoint.get_ranges(model_name)
+            if ranges is None:
+                model_cls = get_document_cls(model_name)
+                ranges = get_pk_ranges(session, model_cls, self.chunk_size)
+                self.checkpoint.set_ranges(model_name, ranges)
+            done = self.checkpoint.get_done(model_name)
+            log.info('Model `%s`: %s ranges, %s already reindexed',
+                     model_name, len(ranges), len(done))
+            for index, (lower, upper) in enumerate(ranges):
+                if index not in done:
+                    tasks.append(
+                        (model_name, index, lower, upper, self.batch_size))
+        return tasks
+
+    def run(self):
+        """ Reindex models. Returns number of indexed documents. """
+        tasks = self.get_tasks()
+        if self.processes > 1:
+            pool = multiprocessing.Pool(
+                self.processes, self.initializer, self.initargs)
+            try:
+                results = pool.imap_unordered(_reindex_task, tasks)
+                return self.process_results(results, len(tasks))
+            finally:
+                pool.close()
+                pool.join()
+        results = (_reindex_task(task) for task in tasks)
+        return self.process_results(results, len(tasks))
+
+    def process_results(self, results, tasks_count):
+        total = 0
+        started = time.time()
+        for completed, (model_name, index, count) in enumerate(results, 1):
+            self.checkpoint.mark_done(model_name, index)
+            total += count
+            elapsed = time.time() - started
+            log.info(
+                'Reindexed range %s of `%s` (%s documents). '
+                'Ranges: %s/%s, documents: %s, %.1f documents/s',
+                index, model_name, count, completed, tasks_count, total,
+                total / elapsed if elapsed else 0)
+        return total
+
+
+def bootstrap_app(config_uri):
+    """ Bootstrap application configured by :config_uri: and setup
+    engine and ES. Used as worker processes initializer.
+    """
+    from pyramid.paster import bootstrap
+    from pyramid.config import Configurator
+    from nefertari.utils import dictset
+    from nefertari.elasticsearch import ES
+
+    # Prevent ES.setup_mappings running on bootstrap
+    mappings_setup = getattr(ES, '_mappings_setup', False)
+    try:
+        ES._mappings_setup = True
+        env = bootstrap(config_uri)
+    finally:
+        ES._mappings_setup = mappings_setup
+
+    registry = env['registry']
+    config = Configurator(settings=registry.settings)
+    config.include('nefertari.engine')
+    ES.setup(dictset(registry.settings))
+
+
+def main(argv=sys.argv):
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(message)s')
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '-c', '--config', help='config.ini (required)', required=True)
+    parser.add_argument(
+        '--models',
+        help='Comma-separated list of model names to reindex. '
+             'Defaults to all ES-enabled models')
+    parser.add_argument(
+        '--processes', type=int, default=multiprocessing.cpu_count(),
+        help='Number of worker processes')
+    parser.add_argument(
+        '--chunk', type=int, default=10000,
+        help='Number of rows in a primary key range')
+    parser.add_argument(
+        '--batch', type=int, default=1000,
+        help='Number of documents sent to ES at once')
+    parser.add_argument(
+        '--checkpoint',
+        help='Path to checkpoint file used to resume reindex')
+    options = parser.parse_args(argv[1:])
+
+    bootstrap_app(options.config)
+    model_names = None
+    if options.models:
+        model_names = [
+            name.strip() for name in options.models.split(',')
+            if name.strip()]
+    reindexer = Reindexer(
+        model_names=model_names,
+        chunk_size=options.chunk,
+        processes=options.processes,
+        checkpoint=options.checkpoint,
+        batch_size=options.batch,
+        initializer=bootstrap_app,
+        initargs=(options.config,))
+    total = reindexer.run()
+    log.info('Reindexed %s documents', total)
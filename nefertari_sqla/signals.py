@@ -1,8 +1,14 @@
+import copy
 import logging
+from collections import OrderedDict, defaultdict
+from functools import partial
 
+import six
 from sqlalchemy import event
 from sqlalchemy.ext.declarative import DeclarativeMeta
-from sqlalchemy.orm import object_session, class_mapper, attributes
+from sqlalchemy.orm import (
+    object_session, attributes, class_mapper, sessionmaker)
+from sqlalchemy.orm.interfaces import MANYTOONE
 from pyramid_sqlalchemy import Session
 
 from nefertari.utils import to_dicts
@@ -10,56 +16,698 @@ from nefertari.utils import to_dicts
 log = logging.getLogger(__name__)
 
 
+# Relationship loading strategies which don't allow lazy loading
+RAISE_LOADERS = ('raise', 'raise_on_sql')
+
+# Whether changed documents are sent to ES in bulk when session
+# transaction is committed instead of being indexed one by one while
+# session is flushed. See `set_index_on_commit`.
+INDEX_ON_COMMIT = True
+
+# Key under which `IndexBatch` is stored in `Session.info`
+INDEX_BATCH_KEY = 'nefertari_sqla.index_batch'
+
+# Key under which `IndexBatch` of objects inserted in a flush is stored
+# in `Session.info` when documents are not indexed on commit
+INSERTED_BATCH_KEY = 'nefertari_sqla.inserted_batch'
+
+# Key under which copies of `IndexBatch` made when savepoints begin are
+# stored in `Session.info`
+INDEX_SAVEPOINTS_KEY = 'nefertari_sqla.index_savepoints'
+
+# Operations of actions sent to ES. See `es_bulk`.
+OP_INDEX = 'index'
+OP_DELETE = 'delete'
+OP_UPDATE = 'update'
+
+# Number of objects updated in bulk which are fetched at once to be
+# reindexed
+BULK_UPDATE_CHUNK_SIZE = 1000
+
+# Background indexer committed documents are submitted to. See
+# `set_indexer`.
+INDEXER = None
+
+
+def set_index_on_commit(value):
+    """ Set whether documents are indexed when session transaction
+    is committed.
+
+    When disabled, documents are indexed while session is flushed, which
+    means documents changed in transactions which are rolled back later
+    stay indexed.
+    """
+    global INDEX_ON_COMMIT
+    INDEX_ON_COMMIT = bool(value)
+
+
+def set_indexer(indexer):
+    """ Set background indexer documents changed in committed
+    transactions are submitted to.
+
+    :param indexer: Instance of `indexer.BackgroundIndexer` or None to
+        send documents to ES when transaction is committed.
+    """
+    global INDEXER
+    INDEXER = indexer
+
+
+class PartialDocument(dict):
+    """ Changed fields of a document which is updated partially. """
+
+
+class IndexBatch(object):
+    """ Documents changed in session transaction, which are sent to ES
+    in bulk when transaction is committed.
+
+    Objects are collected while session is flushed and are serialized
+    after flush is finished. Documents are keyed by model name and
+    primary key, thus each document is indexed or deleted at most once
+    per transaction.
+    """
+    def __init__(self):
+        self.request = None
+        # {(model_name, pk): (obj, with_refs, nested_only)}
+        self.objects = OrderedDict()
+        # {nested_only: set of objects related documents of which
+        # should be reindexed}
+        self.relations = defaultdict(set)
+        # {(model_name, pk): document or None if deleted}
+        self.documents = OrderedDict()
+        # Keys of objects inserted since last flush
+        self.inserted = set()
+
+    def _set_request(self, request):
+        if request is not None:
+            self.request = request
+
+    def copy(self):
+        """ Copy batch, so changes of the copy don't affect it. """
+        batch = copy.copy(self)
+        batch.objects = OrderedDict(self.objects)
+        batch.relations = defaultdict(set, {
+            nested_only: set(items)
+            for nested_only, items in self.relations.items()})
+        # Documents may be updated with partial documents in place
+        batch.documents = OrderedDict(
+            (key, copy.copy(document))
+            for key, document in self.documents.items())
+        batch.inserted = set(self.inserted)
+        return batch
+
+    @staticmethod
+    def _get_key(obj):
+        return (obj.__class__.__name__, getattr(obj, obj.pk_field()))
+
+    def add_object(self, obj, with_refs=True, nested_only=False,
+                   request=None, inserted=False):
+        """ Schedule :obj: to be indexed.
+
+        If :with_refs: is True, documents related to :obj: are reindexed
+        as well. If :inserted: is True, :obj: attributes are expired
+        using `expire_inserted` before it is serialized.
+        """
+        self._set_request(request)
+        key = self._get_key(obj)
+        if key in self.documents and self.documents[key] is None:
+            return
+        if inserted:
+            self.inserted.add(key)
+        if key in self.objects:
+            _, prev_with_refs, prev_nested_only = self.objects[key]
+            with_refs = with_refs or prev_with_refs
+            nested_only = nested_only and prev_nested_only
+        self.objects[key] = (obj, with_refs, nested_only)
+
+    def add_relations(self, objects, nested_only=False, request=None):
+        """ Schedule documents related to :objects: to be reindexed. """
+        self._set_request(request)
+        self.relations[nested_only].update(objects)
+
+    def delete(self, model_name, ids, request=None):
+        """ Schedule documents with :ids: to be deleted. """
+        self._set_request(request)
+        for obj_id in ids:
+            key = (model_name, obj_id)
+            self.objects.pop(key, None)
+            self.documents[key] = None
+
+    def update(self, model_name, obj_id, fields, request=None):
+        """ Schedule document to be updated with :fields: dict.
+
+        Fields are merged into document if it's already scheduled to be
+        indexed or updated.
+        """
+        self._set_request(request)
+        key = (model_name, obj_id)
+        if key in self.objects:
+            return
+        document = self.documents.get(key, PartialDocument())
+        if document is None:
+            return
+        document.update(fields)
+        self.documents[key] = document
+
+    def prepare(self, obj):
+        """ Get document of :obj: to be sent to ES. """
+        load_for_indexing(obj)
+        return obj.to_dict()
+
+    def collected(self, session):
+        """ Called once documents of objects flushed in :session: are
+        prepared.
+        """
+
+    def serialize(self, session):
+        """ Prepare documents of scheduled objects and their related
+        documents.
+        """
+        related = defaultdict(set)
+        objects, self.objects = self.objects, OrderedDict()
+        inserted, self.inserted = self.inserted, set()
+        for key, (obj, with_refs, nested_only) in objects.items():
+            if key in inserted:
+                expire_inserted(obj)
+            self.documents[key] = self.prepare(obj)
+            if with_refs:
+                self.relations[nested_only].add(obj)
+
+        relations, self.relations = self.relations, defaultdict(set)
+        for nested_only, items in relations.items():
+            for item in items:
+                item_relations = item.get_related_documents(
+                    nested_only=nested_only)
+                for model_cls, documents in item_relations:
+                    if getattr(model_cls, '_index_enabled', False):
+                        related[model_cls].update(documents)
+
+        for model_cls, documents in related.items():
+            for document in documents:
+                key = self._get_key(document)
+                if key in self.documents and self.documents[key] is None:
+                    continue
+                self.documents[key] = self.prepare(document)
+        self.collected(session)
+
+    def get_actions(self):
+        """ Get list of (op, model_name, document) actions for scheduled
+        documents. See `es_bulk`.
+        """
+        actions = []
+        for (model_name, obj_id), document in self.documents.items():
+            if document is None:
+                actions.append((OP_DELETE, model_name, obj_id))
+            elif isinstance(document, PartialDocument):
+                actions.append((OP_UPDATE, model_name, dict(document)))
+            else:
+                actions.append((OP_INDEX, model_name, document))
+        return actions
+
+    def send(self):
+        """ Index and delete scheduled documents in bulk.
+
+        If background indexer is set using `set_indexer`, documents are
+        submitted to it instead.
+        """
+        actions = self.get_actions()
+        self.documents = OrderedDict()
+        if not actions:
+            return
+        if INDEXER is not None:
+            INDEXER.submit(actions)
+        else:
+            es_bulk(actions, request=self.request)
+
+
+def es_bulk(actions, request=None, session=None):
+    """ Send :actions: to ES using `nefertari.elasticsearch.ES`.
+
+    Documents which can't be partially updated because they don't exist
+    in ES yet are indexed in full using `index_missing_documents`.
+
+    :param actions: List of (op, model_name, document) tuples where
+        document is a document dict for 'index' op, a primary key for
+        'delete' op and a dict of changed fields and '_pk' for 'update'
+        op.
+    :param request: Pyramid Request instance.
+    :param session: Session used to load missing documents.
+    """
+    from elasticsearch.helpers import BulkIndexError
+    from nefertari.elasticsearch import ES
+    to_index = defaultdict(list)
+    to_delete = defaultdict(list)
+    to_update = defaultdict(list)
+    for op, model_name, document in actions:
+        if op == OP_DELETE:
+            to_delete[model_name].append(document)
+        elif op == OP_UPDATE:
+            to_update[model_name].append(document)
+        else:
+            to_index[model_name].append(document)
+
+    for model_name, ids in to_delete.items():
+        ES(model_name).delete(ids, request=request)
+    for model_name, documents in to_index.items():
+        ES(model_name).index(documents, request=request)
+    for model_name, documents in to_update.items():
+        es = ES(model_name)
+        # ES.index can't send partial documents, thus update actions
+        # are built here
+        documents_actions = [{
+            '_op_type': OP_UPDATE,
+            '_index': es.index_name,
+            '_type': es.doc_type,
+            '_id': document['_pk'],
+            'doc': document,
+        } for document in documents]
+        missing, errors = [], []
+        es.process_chunks(
+            documents=documents_actions,
+            operation=partial(
+                _bulk_update, request=request, missing=missing,
+                errors=errors))
+        if missing:
+            index_missing_documents(
+                model_name, missing, request=request, session=session)
+        if errors:
+            raise BulkIndexError(
+                '{} document(s) failed to update.'.format(len(errors)),
+                errors)
+
+
+def _bulk_update(documents_actions, request, missing, errors):
+    """ Send partial update :documents_actions: to ES.
+
+    Ids of documents which don't exist are added to :missing: list and
+    other errors are added to :errors: list.
+    """
+    from elasticsearch.helpers import BulkIndexError
+    from nefertari.elasticsearch import _bulk_body
+    try:
+        _bulk_body(documents_actions, request=request)
+    except BulkIndexError as ex:
+        for error in ex.errors:
+            info = error.get(OP_UPDATE, {})
+            if info.get('status') == 404:
+                missing.append(info['_id'])
+            else:
+                errors.append(error)
+
+
+def index_missing_documents(model_name, ids, request=None, session=None):
+    """ Index documents of :model_name: with :ids: in full.
+
+    Used when documents can't be partially updated because they are not
+    indexed yet, e.g. when they are indexed in background. Objects are
+    loaded with :session: or, if it's not provided, with a new session,
+    as documents are usually sent after transaction is committed.
+    """
+    from nefertari.elasticsearch import ES
+    from .documents import (
+        get_document_cls, get_model_metadata, coerce_pk_value)
+    model_cls = get_document_cls(model_name)
+    metadata = get_model_metadata(model_cls)
+    pk_column = metadata.columns[metadata.pk_field]
+    ids = [coerce_pk_value(pk_column, pk) for pk in ids]
+    own_session = session is None
+    if own_session:
+        bind = Session().get_bind(mapper=class_mapper(model_cls))
+        session = sessionmaker(bind=bind)()
+    try:
+        query = session.query(model_cls).filter(
+            getattr(model_cls, metadata.pk_field).in_(ids)).options(
+            *model_cls.get_eager_load_options())
+        objects = query.all()
+        for obj in objects:
+            load_for_indexing(obj)
+        documents = to_dicts(objects)
+    finally:
+        if own_session:
+            session.close()
+    if documents:
+        ES(model_name).index(documents, request=request)
+
+
+def get_index_batch(session):
+    """ Get `IndexBatch` of :session: or None if documents are indexed
+    immediately.
+
+    When outbox is enabled, `outbox.OutboxBatch` is used instead.
+    """
+    from . import outbox
+    if session is None:
+        return None
+    if outbox.OUTBOX_ENABLED:
+        batch_cls = outbox.OutboxBatch
+    elif INDEX_ON_COMMIT:
+        batch_cls = IndexBatch
+    else:
+        return None
+    if INDEX_BATCH_KEY not in session.info:
+        session.info[INDEX_BATCH_KEY] = batch_cls()
+    return session.info[INDEX_BATCH_KEY]
+
+
+def load_raise_relationships(obj, _depth=None):
+    """ Load relationships of :obj: configured with lazy='raise' which
+    are accessed when :obj: is serialized with `to_dict`.
+
+    Relationships are queried using `Query.with_parent`, which does not
+    invoke relationship loader, and loaded values are set as committed
+    values of :obj:. Objects of nested relationships are processed
+    recursively until :_depth: is reached.
+    """
+    from .documents import get_model_metadata
+    session = object_session(obj)
+    if session is None:
+        return
+    model_cls = obj.__class__
+    if _depth is None:
+        _depth = model_cls._nesting_depth
+    state = attributes.instance_state(obj)
+    relationships = get_model_metadata(model_cls).relationships
+
+    for name, prop in relationships.items():
+        if name not in state.dict and prop.lazy in RAISE_LOADERS:
+            query = session.query(prop.mapper.class_).with_parent(obj, name)
+            value = query.all() if prop.uselist else query.first()
+            attributes.set_committed_value(obj, name, value)
+
+        if name in model_cls._nested_relationships and _depth > 0:
+            value = state.dict.get(name)
+            if value is None:
+                continue
+            for related in (value if prop.uselist else [value]):
+                load_raise_relationships(related, _depth - 1)
+
+
+def load_for_indexing(obj, with_refs=False, **kwargs):
+    """ Make sure relationships of :obj: and, if :with_refs: is True,
+    of its related documents can be accessed when they are indexed.
+
+    :param kwargs: Arguments passed to :obj: `get_related_documents`.
+    """
+    load_raise_relationships(obj)
+    if with_refs:
+        for model_cls, documents in obj.get_related_documents(**kwargs):
+            for document in documents:
+                load_raise_relationships(document)
+
+
 def index_object(obj, with_refs=True, **kwargs):
+    batch = get_index_batch(object_session(obj))
+    if batch is not None:
+        batch.add_object(obj, with_refs=with_refs, **kwargs)
+        return
+
     from nefertari.elasticsearch import ES
+    load_for_indexing(
+        obj, with_refs=with_refs,
+        nested_only=kwargs.get('nested_only', False))
     es = ES(obj.__class__.__name__)
     es.index(obj.to_dict(), **kwargs)
     if with_refs:
         es.index_relations(obj, **kwargs)
 
 
+def get_changed_fields(target):
+    """ Get set of names of :target: attributes changed since it was
+    loaded or flushed.
+    """
+    state = attributes.instance_state(target)
+    return set(name for name in state.committed_state
+               if state.attrs[name].history.has_changes())
+
+
+def update_document(obj, document, request=None):
+    """ Update document of :obj: with fields of :document: dict. """
+    model_name = obj.__class__.__name__
+    obj_id = getattr(obj, obj.pk_field())
+    document['_pk'] = str(obj_id)
+    batch = get_index_batch(object_session(obj))
+    if batch is not None:
+        batch.update(model_name, obj_id, document, request=request)
+        return
+    es_bulk([(OP_UPDATE, model_name, document)], request=request,
+            session=object_session(obj))
+
+
+def get_previously_related(target):
+    """ Get objects :target: was related to through many-to-one
+    relationships before it was updated.
+
+    Previously related objects are found using history of foreign key
+    columns, thus they are found regardless of relationships loading
+    strategy.
+    """
+    from .documents import get_model_metadata
+    state = attributes.instance_state(target)
+    mapper = state.mapper
+    session = object_session(target)
+    relationships = get_model_metadata(target.__class__).relationships
+    related = []
+
+    for prop in relationships.values():
+        if prop.direction is not MANYTOONE:
+            continue
+        old_values = {}
+        for local, remote in prop.local_remote_pairs:
+            key = mapper.get_property_by_column(local).key
+            deleted = state.attrs[key].history.deleted
+            if deleted and deleted[0] is not None:
+                old_values[remote] = deleted[0]
+        if len(old_values) != len(prop.local_remote_pairs):
+            continue
+
+        related_mapper = prop.mapper
+        query = session.query(related_mapper.class_)
+        if set(old_values) == set(related_mapper.primary_key):
+            obj = query.get(tuple(
+                old_values[col] for col in related_mapper.primary_key))
+        else:
+            obj = query.filter(*[
+                col == val for col, val in old_values.items()]).first()
+        if obj is not None:
+            related.append(obj)
+    return related
+
+
+def expire_inserted(target):
+    """ Expire attributes of just inserted :target: which values may
+    differ from values stored in DB.
+
+    These are columns values of which are processed when stored and
+    empty relationships which weren't changed, thus may be populated by
+    back references. Columns with server defaults are expired by
+    SQLAlchemy itself.
+    """
+    from .documents import get_model_metadata
+    metadata = get_model_metadata(target.__class__)
+    state = attributes.instance_state(target)
+    names = list(metadata.refresh_on_insert)
+    for name in metadata.relationships:
+        if name in state.dict and not state.dict[name]:
+            if not state.attrs[name].history.has_changes():
+                names.append(name)
+    if names:
+        object_session(target).expire(target, attribute_names=names)
+
+
 def on_after_insert(mapper, connection, target):
-    # Reload `target` to get access to back references and processed
-    # fields values
+    # In-session `target` is indexed instead of being reloaded. Only
+    # attributes needed to get access to back references and processed
+    # fields values are expired once `target` is persistent.
     request = getattr(target, '_request', None)
-    model_cls = target.__class__
-    pk_field = target.pk_field()
-    reloaded = model_cls.get_item(
-        **{pk_field: getattr(target, pk_field)})
-    index_object(reloaded, request=request)
+    session = object_session(target)
+    batch = get_index_batch(session)
+    if batch is None:
+        # Relationships of pending `target` can't be loaded, so it is
+        # indexed once flush is finished
+        batch = session.info.setdefault(INSERTED_BATCH_KEY, IndexBatch())
+    batch.add_object(target, request=request, inserted=True)
 
 
 def on_after_update(mapper, connection, target):
     request = getattr(target, '_request', None)
-    from .documents import BaseDocument
+    from .documents import BaseDocument, get_model_metadata
 
-    # Reindex old one-to-one related object
+    # Reindex objects `target` was related to before update
     committed_state = attributes.instance_state(target).committed_state
-    for field, value in committed_state.items():
-        if isinstance(value, BaseDocument):
+    previous = [value for value in committed_state.values()
+                if isinstance(value, BaseDocument)]
+    previous += [obj for obj in get_previously_related(target)
+                 if obj not in previous]
+    for value in previous:
+        if getattr(value, '_index_enabled', False):
             obj_session = object_session(value)
             # Make sure object is not updated yet
             if not obj_session.is_modified(value):
                 obj_session.expire(value)
-            index_object(value, with_refs=False,
-                         request=request)
+            index_object(value, with_refs=False, request=request)
+
+    model_cls = target.__class__
+    metadata = get_model_metadata(model_cls)
+    changed = get_changed_fields(target)
+    if changed:
+        # UPDATE generates values of these columns as well
+        changed.update(metadata.refresh_on_update)
+    fields = changed.difference(model_cls._index_ignored_fields)
+    if changed and not fields:
+        return
+    # Values of processed fields are only known once they are reloaded
+    partial = (fields and fields.isdisjoint(metadata.refresh_on_insert) and
+               is_partially_updatable(model_cls, fields))
+    if partial:
+        # Values generated by DB are expired, thus they are loaded here
+        document = {name: getattr(target, name) for name in fields}
+        update_document(target, document, request=request)
+        return
 
     # Reload `target` to get access to processed fields values
-    columns = [c.name for c in class_mapper(target.__class__).columns]
+    columns = list(metadata.columns)
     object_session(target).expire(target, attribute_names=columns)
     index_object(target, request=request, nested_only=True)
 
 
 def on_after_delete(mapper, connection, target):
-    from nefertari.elasticsearch import ES
     request = getattr(target, '_request', None)
     model_cls = target.__class__
-    es = ES(model_cls.__name__)
     obj_id = getattr(target, model_cls.pk_field())
+    load_for_indexing(target, with_refs=True)
+
+    batch = get_index_batch(object_session(target))
+    if batch is not None:
+        batch.delete(model_cls.__name__, [obj_id], request=request)
+        # Related documents are collected now, as relationships of
+        # deleted object can't be loaded after flush
+        for related_cls, documents in target.get_related_documents():
+            if getattr(related_cls, '_index_enabled', False):
+                for document in documents:
+                    batch.add_object(
+                        document, with_refs=False, request=request)
+        return
+
+    from nefertari.elasticsearch import ES
+    es = ES(model_cls.__name__)
     es.delete(obj_id, request=request)
     es.index_relations(target, request=request)
 
 
+def get_bulk_updated_fields(update_context):
+    """ Get set of names of fields updated by bulk UPDATE. """
+    values = update_context.values
+    if hasattr(values, 'items'):
+        values = values.items()
+    fields = set()
+    for key, _ in values:
+        if not isinstance(key, six.string_types):
+            key = key.key
+        fields.add(key)
+    return fields
+
+
+def get_bulk_updated_ids(update_context):
+    """ Get primary keys of rows updated by bulk UPDATE.
+
+    Rows matched before UPDATE are only known when 'fetch' session
+    synchronization is used. Otherwise rows are queried by UPDATE
+    criteria after they were updated.
+    """
+    model_cls = update_context.mapper.entity
+    matched_rows = getattr(update_context, 'matched_rows', None)
+    if matched_rows is not None:
+        return [row[0] for row in matched_rows]
+    pk_column = getattr(model_cls, model_cls.pk_field())
+    return [row[0] for row in
+            update_context.query.with_entities(pk_column)]
+
+
+def is_partially_updatable(model_cls, fields):
+    """ Check whether documents of :model_cls: may be updated in ES
+    with values of changed :fields: only.
+
+    This is not possible when changed fields are foreign keys or fields
+    which are serialized specially, or when documents are nested in
+    documents of related models.
+    """
+    from .documents import get_model_metadata, get_nesting_graph
+    from .types import PickleType
+    metadata = get_model_metadata(model_cls)
+    for name in fields:
+        column = metadata.columns.get(name)
+        if column is None or isinstance(column.type, PickleType):
+            return False
+    for prop in metadata.relationships.values():
+        if fields.intersection(col.key for col in prop.local_columns):
+            return False
+    nesting = get_nesting_graph().get(model_cls, ())
+    return not any(getattr(root_cls, '_index_enabled', False)
+                   for _, root_cls in nesting)
+
+
+def update_documents(model_cls, ids, fields, session, request=None):
+    """ Update :fields: of documents of :model_cls: with :ids: in ES.
+
+    Values are fetched in chunks, without loading objects.
+    """
+    pk_field = model_cls.pk_field()
+    fields = sorted(fields)
+    columns = [getattr(model_cls, name) for name in fields]
+    pk_column = getattr(model_cls, pk_field)
+    model_name = model_cls.__name__
+    batch = get_index_batch(session)
+    for start in range(0, len(ids), BULK_UPDATE_CHUNK_SIZE):
+        chunk = ids[start:start + BULK_UPDATE_CHUNK_SIZE]
+        query = session.query(pk_column, *columns).filter(
+            pk_column.in_(chunk))
+        actions = []
+        for row in query:
+            document = dict(zip(fields, row[1:]))
+            document['_pk'] = str(row[0])
+            if batch is not None:
+                batch.update(model_name, row[0], document, request=request)
+            else:
+                actions.append((OP_UPDATE, model_name, document))
+        if actions:
+            es_bulk(actions, request=request, session=session)
+    if batch is not None:
+        batch.serialize(session)
+
+
+def reindex_documents(model_cls, ids, session, request=None):
+    """ Reindex documents of :model_cls: with :ids: and documents they
+    are nested in.
+
+    Objects are loaded in chunks with relationships accessed by
+    `to_dict` loaded eagerly.
+    """
+    pk_column = getattr(model_cls, model_cls.pk_field())
+    options = model_cls.get_eager_load_options()
+    batch = get_index_batch(session)
+    for start in range(0, len(ids), BULK_UPDATE_CHUNK_SIZE):
+        chunk = ids[start:start + BULK_UPDATE_CHUNK_SIZE]
+        query = session.query(model_cls).filter(
+            pk_column.in_(chunk)).options(*options)
+        objects = query.all()
+        if batch is not None:
+            for obj in objects:
+                batch.add_object(
+                    obj, with_refs=True, nested_only=True, request=request)
+            # Session may not be flushed before commit
+            batch.serialize(session)
+            continue
+
+        for obj in objects:
+            load_for_indexing(obj, with_refs=True, nested_only=True)
+
+        from nefertari.elasticsearch import ES
+        es = ES(source=model_cls.__name__)
+        es.index(to_dicts(objects), request=request)
+
+        # Reindex relationships
+        es.bulk_index_relations(objects, request=request, nested_only=True)
+
+
 def on_bulk_update(update_context):
     request = getattr(
         update_context.query, '_request', None)
@@ -67,17 +715,99 @@ def on_bulk_update(update_context):
     if not getattr(model_cls, '_index_enabled', False):
         return
 
-    objects = update_context.query.all()
-    if not objects:
+    from .documents import get_model_metadata
+    fields = get_bulk_updated_fields(update_context)
+    # UPDATE generates values of these columns as well
+    fields.update(get_model_metadata(model_cls).refresh_on_update)
+    fields.difference_update(model_cls._index_ignored_fields)
+    if not fields:
+        return
+    ids = get_bulk_updated_ids(update_context)
+    if not ids:
+        return
+
+    session = update_context.session
+    if is_partially_updatable(model_cls, fields):
+        update_documents(model_cls, ids, fields, session, request=request)
+    else:
+        reindex_documents(model_cls, ids, session, request=request)
+
+
+def on_bulk_create(model_cls, ids, request=None, session=None):
+    """ Index documents of :model_cls: with primary keys :ids: created
+    with `BaseMixin.bulk_create` and reindex their relationships.
+
+    Called explicitly because objects inserted in bulk don't emit
+    'after_insert' ORM events.
+    """
+    if not getattr(model_cls, '_index_enabled', False) or not ids:
+        return
+    if session is None:
+        session = Session()
+    from .documents import get_model_metadata
+    pk_column = getattr(model_cls, model_cls.pk_field())
+    objects = session.query(model_cls).filter(pk_column.in_(ids)).options(
+        *model_cls.get_eager_load_options()).all()
+
+    # Relationships of related objects which are already loaded don't
+    # include created objects
+    related = set()
+    for obj in objects:
+        for _, documents in obj.get_related_documents():
+            related.update(documents)
+    for document in related:
+        relationships = get_model_metadata(document.__class__).relationships
+        names = [name for name, prop in relationships.items()
+                 if prop.mapper.class_ is model_cls]
+        session.expire(document, attribute_names=names)
+
+    batch = get_index_batch(session)
+    if batch is not None:
+        for obj in objects:
+            batch.add_object(obj, request=request)
+        batch.serialize(session)
         return
 
+    for obj in objects:
+        load_for_indexing(obj, with_refs=True)
+
     from nefertari.elasticsearch import ES
     es = ES(source=model_cls.__name__)
-    documents = to_dicts(objects)
-    es.index(documents, request=request)
+    es.index(to_dicts(objects), request=request)
 
     # Reindex relationships
-    es.bulk_index_relations(objects, request=request, nested_only=True)
+    es.bulk_index_relations(objects, request=request)
+
+
+def has_indexed_relationships(model_cls):
+    """ Check whether documents related to :model_cls: objects are
+    indexed, thus should be reindexed when objects change.
+    """
+    from .documents import get_model_metadata
+    relationships = get_model_metadata(model_cls).relationships
+    return any(getattr(prop.mapper.class_, '_index_enabled', False)
+               for prop in relationships.values())
+
+
+def on_bulk_delete_ids(model_cls, ids, request=None, session=None):
+    """ Delete documents of :model_cls: with primary keys :ids: deleted
+    in bulk.
+
+    Used instead of `on_bulk_delete` when objects aren't loaded because
+    there are no related documents to reindex.
+    """
+    if not getattr(model_cls, '_index_enabled', False) or not ids:
+        return
+    if session is None:
+        session = Session()
+    batch = get_index_batch(session)
+    if batch is not None:
+        batch.delete(model_cls.__name__, ids, request=request)
+        batch.serialize(session)
+        return
+
+    from nefertari.elasticsearch import ES
+    ES(source=model_cls.__name__).delete(ids, request=request)
 
 
 def on_bulk_delete(model_cls, objects, request):
@@ -86,6 +816,16 @@ def on_bulk_delete(model_cls, objects, request):
 
     pk_field = model_cls.pk_field()
     ids = [getattr(obj, pk_field) for obj in objects]
+    for obj in objects:
+        load_for_indexing(obj, with_refs=True)
+
+    session = object_session(objects[0]) if objects else None
+    batch = get_index_batch(session)
+    if batch is not None:
+        batch.delete(model_cls.__name__, ids, request=request)
+        batch.add_relations(objects, request=request)
+        batch.serialize(session)
+        return
 
     from nefertari.elasticsearch import ES
     es = ES(source=model_cls.__name__)
@@ -102,7 +842,61 @@ def setup_es_signals_for(source_cls):
     log.info('setup_sqla_es_signals_for: %r' % source_cls)
 
 
+def on_after_flush_postexec(session, flush_context):
+    inserted = session.info.pop(INSERTED_BATCH_KEY, None)
+    if inserted is not None:
+        inserted.serialize(session)
+        es_bulk(inserted.get_actions(), request=inserted.request)
+    batch = session.info.get(INDEX_BATCH_KEY)
+    if batch is not None:
+        batch.serialize(session)
+
+
+def on_after_transaction_create(session, transaction):
+    # Copy of the batch is restored if savepoint is rolled back
+    if transaction.nested:
+        batch = session.info.get(INDEX_BATCH_KEY)
+        savepoints = session.info.setdefault(INDEX_SAVEPOINTS_KEY, {})
+        savepoints[transaction] = None if batch is None else batch.copy()
+
+
+def on_after_commit(session):
+    transaction = session.transaction
+    if transaction is not None and transaction.nested:
+        # Changes of released savepoint are sent with the outermost
+        # transaction
+        session.info.get(INDEX_SAVEPOINTS_KEY, {}).pop(transaction, None)
+        return
+    batch = session.info.pop(INDEX_BATCH_KEY, None)
+    if batch is not None:
+        batch.send()
+
+
+def on_after_transaction_end(session, transaction):
+    # Inserted objects are left here only if flush failed
+    session.info.pop(INSERTED_BATCH_KEY, None)
+    # Batch is sent in `on_after_commit`, so here it is only left when
+    # the outermost transaction is rolled back or closed
+    if transaction.parent is None:
+        session.info.pop(INDEX_BATCH_KEY, None)
+        session.info.pop(INDEX_SAVEPOINTS_KEY, None)
+        return
+    savepoints = session.info.get(INDEX_SAVEPOINTS_KEY, {})
+    if transaction.nested and transaction in savepoints:
+        # Savepoint is rolled back
+        batch = savepoints.pop(transaction)
+        if batch is None:
+            session.info.pop(INDEX_BATCH_KEY, None)
+        else:
+            session.info[INDEX_BATCH_KEY] = batch
+
+
 event.listen(Session, 'after_bulk_update', on_bulk_update)
+event.listen(Session, 'after_flush_postexec', on_after_flush_postexec)
+event.listen(Session, 'after_transaction_create',
+             on_after_transaction_create)
+event.listen(Session, 'after_commit', on_after_commit)
+event.listen(Session, 'after_transaction_end', on_after_transaction_end)
 
 
 class ESMetaclass(DeclarativeMeta):
@@ -53,3 +53,64 @@ def db_session(request):
         return Session
 
     return creator
+
+
+@pytest.fixture
+def transaction_manager(request):
+    """ Start new zope transaction and abort it after the test.
+
+    Use it in tests which commit transaction, so changes of sessions
+    joined by previous tests are not committed.
+    """
+    import transaction
+    transaction.abort()
+    request.addfinalizer(transaction.abort)
+    return transaction
+
+
+def create_models(prefix):
+    """ Create ES-enabled parent and child models, names of which start
+    with :prefix:. Parent documents nest children.
+    """
+    from .. import fields, documents as docs
+    parent_name = prefix + 'Parent'
+    child_name = prefix + 'Child'
+    parent_cls = type(parent_name, (docs.ESBaseDocument,), {
+        '__tablename__': parent_name.lower(),
+        '_nested_relationships': ['children'],
+        'id': fields.IdField(primary_key=True),
+        'name': fields.StringField(),
+        'children': fields.Relationship(
+            document=child_name, backref_name='parent'),
+    })
+    child_cls = type(child_name, (docs.ESBaseDocument,), {
+        '__tablename__': child_name.lower(),
+        'id': fields.IdField(primary_key=True),
+        'parent_id': fields.ForeignKeyField(
+            ref_document=parent_name,
+            ref_column=parent_name.lower() + '.id',
+            ref_column_type=fields.IdField),
+    })
+    return parent_cls, child_cls
+
+
+class FakeBulk(object):
+    """ Callable which records actions sent to ES.
+
+    :param failures: Number of first calls which fail.
+    :param block: If True, calls wait until `release` event is set.
+    """
+    def __init__(self, failures=0, block=False):
+        import threading
+        self.failures = failures
+        self.calls = []
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def __call__(self, actions, request=None):
+        self.release.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise Exception('ES is not available')
+        self.calls.append(actions)
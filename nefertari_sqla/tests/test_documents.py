@@ -5,12 +5,12 @@ from nefertari.utils.dictset import dictset
 from nefertari.json_httpexceptions import (
     JHTTPBadRequest, JHTTPNotFound, JHTTPConflict)
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
-from sqlalchemy.orm.collections import InstrumentedList
 from sqlalchemy.exc import IntegrityError
 
 from .. import documents as docs
 from .. import fields
-from .fixtures import memory_db, db_session, simple_model
+from .fixtures import (
+    memory_db, db_session, simple_model, transaction_manager)
 
 
 class TestDocumentHelpers(object):
@@ -44,6 +44,35 @@ class TestDocumentHelpers(object):
         expected = 'SQLAlchemy model `foo` does not exist'
         assert str(ex.value) == expected
 
+    @patch('nefertari.elasticsearch.ES')
+    def test_setup_es_mappings(self, mock_es, memory_db):
+        class MappedModel(docs.ESBaseDocument):
+            __tablename__ = 'mapped_model'
+            id = fields.IdField(primary_key=True)
+        memory_db()
+        mock_es.src2type.side_effect = lambda name: name
+        es = mock_es.return_value
+        es.doc_type = 'MappedModel'
+        fingerprint = MappedModel.get_es_mapping_fingerprint()
+
+        es.api.indices.get_mapping.return_value = {}
+        assert docs.setup_es_mappings(['MappedModel']) == ['MappedModel']
+        mock_es.assert_called_with('MappedModel')
+        body = es.put_mapping.call_args[1]['body']
+        assert body['MappedModel']['_meta'] == {
+            docs.ES_MAPPING_FINGERPRINT_KEY: fingerprint}
+        assert body['MappedModel']['properties'] == (
+            MappedModel.get_es_mapping()['MappedModel']['properties'])
+        assert '_meta' not in MappedModel.get_es_mapping()['MappedModel']
+        es.put_mapping.reset_mock()
+
+        es.api.indices.get_mapping.return_value = {'index': {'mappings': {
+            'MappedModel': {'_meta': body['MappedModel']['_meta']}}}}
+        assert docs.setup_es_mappings(['MappedModel']) == []
+        assert not es.put_mapping.called
+        assert docs.setup_es_mappings(['MappedModel'], force=True) == [
+            'MappedModel']
+
     def test_process_lists(self):
         test_dict = dictset(
             id__in='1,   2, 3',
@@ -129,6 +158,51 @@ class TestBaseMixin(object):
             }
         }
 
+    def test_get_es_mapping_cached(self, memory_db):
+        class CachedMapChild(docs.BaseDocument):
+            __tablename__ = 'cached_map_child'
+            id = fields.IdField(primary_key=True)
+            parent_id = fields.ForeignKeyField(
+                ref_document='CachedMapParent',
+                ref_column='cached_map_parent.id',
+                ref_column_type=fields.IdField)
+
+        class CachedMapParent(docs.BaseDocument):
+            __tablename__ = 'cached_map_parent'
+            _nested_relationships = ('children',)
+            id = fields.IdField(primary_key=True)
+            children = fields.Relationship(
+                document='CachedMapChild', backref_name='parent')
+        memory_db()
+
+        mapping = CachedMapParent.get_es_mapping()
+        assert CachedMapParent.get_es_mapping() is mapping
+        assert mapping['CachedMapParent']['properties']['children'][
+            'type'] == 'nested'
+        flat = CachedMapParent.get_es_mapping(_depth=0)
+        assert flat['CachedMapParent']['properties']['children'] == {
+            'type': 'long'}
+
+        # Types map is used for nested documents too
+        types_map = dict(docs.TYPES_MAP)
+        types_map[fields.IdField._sqla_type_cls] = {'type': 'integer'}
+        custom = CachedMapParent.get_es_mapping(types_map=types_map)
+        assert custom is not mapping
+        children = custom['CachedMapParent']['properties']['children']
+        assert children['properties']['id'] == {'type': 'integer'}
+
+        fingerprint = CachedMapParent.get_es_mapping_fingerprint()
+        assert len(fingerprint) == 40
+        assert CachedMapParent.get_es_mapping_fingerprint() == fingerprint
+        assert CachedMapParent.get_es_mapping_fingerprint(
+            types_map=types_map) != fingerprint
+
+        # Cache is reset when mappers are configured
+        docs._reset_models_metadata()
+        assert CachedMapParent.get_es_mapping() is not mapping
+        assert CachedMapParent.get_es_mapping() == mapping
+        assert CachedMapParent.get_es_mapping_fingerprint() == fingerprint
+
     def test_pk_field(self, memory_db):
         class MyModel(docs.BaseDocument):
             __tablename__ = 'mymodel'
@@ -272,7 +346,7 @@ class TestBaseMixin(object):
         simple_model.id.in_.assert_called_once_with(['4', '5'])
         query_set = mock_sess().query().filter()
         mock_get.assert_called_once_with(
-            query_set=query_set.from_self(),
+            query_set=query_set,
             foo='bar')
         assert result == mock_get()
 
@@ -297,6 +371,48 @@ class TestBaseMixin(object):
         expected = 'DictField database querying is not supported'
         assert str(ex.value) == expected
 
+    def test_pop_iterables_dict_postgresql(self, memory_db):
+        from sqlalchemy.dialects import postgresql
+
+        class MyModel(docs.BaseDocument):
+            __tablename__ = 'mymodel'
+            id = fields.IdField(primary_key=True)
+            settings = fields.DictField()
+        memory_db()
+        session = Mock()
+        session.get_bind().dialect.name = 'postgresql'
+        # Dialect is not known by type until it is used in a statement
+        assert not getattr(MyModel.settings.type, 'is_postgresql', False)
+
+        def compile(expr):
+            compiled = expr.compile(dialect=postgresql.dialect())
+            return str(compiled), list(compiled.params.values())
+
+        params = {
+            'settings': '{"a": 1}',
+            'settings__has_key': 'b',
+            'settings.c.d': 2,
+            'id': 1,
+        }
+        iterables, params = MyModel._pop_iterables(params, session)
+        assert params == {'id': 1}
+        assert sorted(compile(expr) for expr in iterables) == [
+            ('(mymodel.settings #>> %(param_1)s) = %(param_2)s',
+             [('c', 'd'), '2']),
+            ('mymodel.settings ? %(param_1)s', ['b']),
+            ('mymodel.settings @> %(param_1)s', [{'a': 1}]),
+        ]
+
+        iterables, _ = MyModel._pop_iterables(
+            {'settings__has_key': 'a,b'}, session)
+        assert compile(iterables[0]) == (
+            'mymodel.settings ?& %(param_1)s', [['a', 'b']])
+
+        with pytest.raises(JHTTPBadRequest):
+            MyModel._pop_iterables({'settings': 'foo'}, session)
+        with pytest.raises(JHTTPBadRequest):
+            MyModel._pop_iterables({'settings': '[1]'}, session)
+
     def test_add_field_names_no_pk_requested(
             self, memory_db, simple_model):
         from sqlalchemy.orm.query import Query
@@ -324,14 +440,24 @@ class TestBaseMixin(object):
             'id': 1
         }]
 
-    @patch.object(docs.BaseMixin, 'native_fields')
-    def test_has_field(self, mock_fields):
-        mock_fields.return_value = ['foo', 'bar']
-        assert docs.BaseMixin.has_field('foo')
-        assert not docs.BaseMixin.has_field('bazz')
+    def test_add_field_names_no_pk_selected(
+            self, memory_db, simple_model):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        queryset = simple_model.get_collection(_limit=1)
+        queryset = queryset.with_entities(simple_model.name)
+        objects = simple_model.add_field_names(queryset, ['name'])
+        assert objects == [{'_type': 'MyModel', 'name': 'foo'}]
+
+    def test_has_field(self, simple_model, memory_db):
+        memory_db()
+        assert simple_model.has_field('name')
+        assert not simple_model.has_field('bazz')
 
+    @patch.object(docs.BaseMixin, '_has_raise_loaders', return_value=False)
+    @patch.object(docs.BaseMixin, '_get_simple_lookup', return_value=None)
     @patch.object(docs.BaseMixin, 'get_collection')
-    def test_get_item(self, mock_get_coll):
+    def test_get_item(self, mock_get_coll, mock_lookup, mock_raise):
         queryset = Mock()
         mock_get_coll.return_value = queryset
         resource = docs.BaseMixin.get_item(foo='bar')
@@ -341,6 +467,127 @@ class TestBaseMixin(object):
         mock_get_coll().first.assert_called_once_with()
         assert resource == mock_get_coll().first()
 
+    def test_get_item_fetched_results(self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        item = simple_model.get_item(
+            name='foo', _total_mode='window')
+        assert item.id == 1
+        item = simple_model.get_item(
+            name='bar', _total_mode='window', _raise_on_empty=False)
+        assert item is None
+
+    def test_get_simple_lookup(self, simple_model, memory_db):
+        memory_db()
+        lookup = simple_model._get_simple_lookup
+        assert lookup({'name': 'foo', '_raise_on_empty': False}) == {
+            'name': 'foo'}
+        assert lookup({'_raise_on_empty': True}) is None
+        assert lookup({'name': 'foo', '__raise': True}) == {'name': 'foo'}
+        assert lookup({'name': 'foo', '_fields': ['id']}) is None
+        assert lookup({'name__in': 'foo,bar'}) is None
+        assert lookup({'name': ['foo']}) is None
+        assert lookup({'name': '_all'}) is None
+        assert lookup({'bazz': 1}) is None
+
+    def test_get_item_by_lookup(self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        simple_model(id=2, name='bar').save()
+
+        with patch.object(simple_model, 'get_collection') as mock_coll:
+            assert simple_model.get_item(name='bar').id == 2
+            assert simple_model.get_item(id=1, name='foo').id == 1
+            assert simple_model.get_item(
+                name='baz', _raise_on_empty=False) is None
+            with pytest.raises(JHTTPNotFound):
+                simple_model.get_item(name='baz')
+        assert not mock_coll.called
+        assert len(docs.item_bakery.cache) >= 2
+
+    def test_get_item_by_lookup_none(self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        simple_model(id=2).save()
+
+        assert simple_model.get_item(name=None).id == 2
+        assert simple_model.get_item(id=2, name=None).id == 2
+        assert simple_model.get_item(
+            id=1, name=None, _raise_on_empty=False) is None
+        assert simple_model.get_item(id=1, name='foo').id == 1
+
+    def test_get_item_by_pk(self, simple_model, memory_db):
+        from sqlalchemy import event
+        connection = memory_db()
+        obj = simple_model(id=1, name='foo').save()
+        obj.name
+
+        statements = []
+        event.listen(
+            connection, 'before_cursor_execute',
+            lambda conn, cursor, statement, *args: statements.append(
+                statement))
+        with patch.object(simple_model, 'get_collection') as mock_coll:
+            assert simple_model.get_item(id='1') is obj
+            assert simple_model.get_item(id=1) is obj
+            assert not statements
+            assert simple_model.get_item(
+                id='2', _raise_on_empty=False) is None
+            assert len(statements) == 1
+            with pytest.raises(JHTTPNotFound):
+                simple_model.get_item(id='foo')
+            # Item views of nefertari pass legacy '__raise' param
+            del statements[:]
+            assert simple_model.get_item(__raise=True, id='1') is obj
+            assert not statements
+        assert not mock_coll.called
+
+    @patch.object(fields, 'RELATIONSHIP_LAZY', 'raise')
+    def test_get_item_raise_loaders(self, memory_db):
+        from pyramid_sqlalchemy import Session
+
+        class LazyParent(docs.BaseDocument):
+            __tablename__ = 'lazyparent'
+            id = fields.IdField(primary_key=True)
+            name = fields.StringField()
+            children = fields.Relationship(
+                document='LazyChild', backref_name='parent')
+
+        class LazyChild(docs.BaseDocument):
+            __tablename__ = 'lazychild'
+            id = fields.IdField(primary_key=True)
+            name = fields.StringField()
+            parent_id = fields.ForeignKeyField(
+                ref_document='LazyParent', ref_column='lazyparent.id',
+                ref_column_type=fields.IdField)
+        memory_db()
+        assert LazyChild._has_raise_loaders()
+        assert LazyChild.parent.property.lazy == 'raise'
+        assert not LazyParent._has_raise_loaders()
+
+        LazyParent(id=1).save()
+        child = LazyChild(id=2, name='foo', parent_id=1).save()
+        # Found in identity map
+        assert LazyChild.get_item(id=2).to_dict()['parent'] == 1
+
+        Session().expunge_all()
+        assert LazyChild.get_item(id=2).to_dict()['parent'] == 1
+        Session().expunge_all()
+        assert LazyChild.get_item(name='foo').to_dict()['parent'] == 1
+        Session().expunge_all()
+        child = LazyChild.get_item(id=2, _total_mode='skip')
+        assert child.to_dict()['parent'] == 1
+
+    def test_coerce_pk_value(self, simple_model, memory_db):
+        memory_db()
+        column = simple_model.__table__.c.id
+        assert docs.coerce_pk_value(column, '1') == 1
+        assert docs.coerce_pk_value(column, 1) == 1
+        with pytest.raises(ValueError):
+            docs.coerce_pk_value(column, 'foo')
+        column = simple_model.__table__.c.name
+        assert docs.coerce_pk_value(column, 1) == '1'
+
     def test_native_fields(self, simple_model, memory_db):
         memory_db()
         assert sorted(simple_model.native_fields()) == [
@@ -351,14 +598,63 @@ class TestBaseMixin(object):
         cols = simple_model._mapped_columns().keys()
         assert sorted(cols) == ['id', 'name']
 
-    @patch.object(docs, 'class_mapper')
-    def test_mapped_relationships(
-            self, mock_mapper, simple_model, memory_db):
+    def test_mapped_relationships(self, memory_db):
+        class MappedChild(docs.BaseDocument):
+            __tablename__ = 'mappedchild'
+            id = fields.IdField(primary_key=True)
+            parent_id = fields.ForeignKeyField(
+                ref_document='MappedParent', ref_column='mappedparent.id',
+                ref_column_type=fields.IdField)
+
+        class MappedParent(docs.BaseDocument):
+            __tablename__ = 'mappedparent'
+            id = fields.IdField(primary_key=True)
+            children = fields.Relationship(
+                document='MappedChild', backref_name='parent')
         memory_db()
-        rels = [Mock(key='foo')]
-        mock_mapper.return_value = Mock(relationships=rels)
-        cols = simple_model._mapped_relationships()
-        assert cols == {'foo': rels[0]}
+        rels = MappedParent._mapped_relationships()
+        assert list(rels.keys()) == ['children']
+        assert rels['children'] is MappedParent.children.property
+
+    def test_get_model_metadata_cached(self, memory_db):
+        class MyModel(docs.BaseDocument):
+            __tablename__ = 'mymodel'
+            id = fields.IdField(primary_key=True)
+            name = fields.StringField(unique=True)
+            groups = fields.ListField(item_type=fields.StringField)
+            settings = fields.DictField()
+        memory_db()
+        metadata = docs.get_model_metadata(MyModel)
+        assert docs.get_model_metadata(MyModel) is metadata
+        assert metadata.pk_field == 'id'
+        assert metadata.pk_field_type is fields.IdField._sqla_type_cls
+        assert metadata.iterable_columns == frozenset(['groups', 'settings'])
+        assert metadata.unique_columns == (MyModel.id, MyModel.name)
+        assert 'name' in metadata.fields_to_query
+        assert '_limit' in metadata.fields_to_query
+
+        # Returned values can't change the cache
+        MyModel.native_fields().append('foo')
+        MyModel._mapped_columns().pop('name')
+        assert 'foo' not in MyModel.native_fields()
+        assert 'name' in MyModel._mapped_columns()
+
+    def test_get_model_metadata_reset_on_new_backref(self, memory_db):
+        class LateParent(docs.BaseDocument):
+            __tablename__ = 'lateparent'
+            id = fields.IdField(primary_key=True)
+        assert LateParent.native_fields() == ['id']
+
+        class LateChild(docs.BaseDocument):
+            __tablename__ = 'latechild'
+            id = fields.IdField(primary_key=True)
+            parent_id = fields.ForeignKeyField(
+                ref_document='LateParent', ref_column='lateparent.id',
+                ref_column_type=fields.IdField)
+            parent = fields.Relationship(
+                document='LateParent', backref_name='children')
+        memory_db()
+        assert sorted(LateParent.native_fields()) == ['children', 'id']
 
     def test_fields_to_query(self, simple_model, memory_db):
         memory_db()
@@ -415,6 +711,180 @@ class TestBaseMixin(object):
         assert one.id == 7
         assert one.name == 'q'
 
+    def test_get_conflict_columns(self, memory_db):
+        from sqlalchemy import UniqueConstraint
+
+        class ConflictModel(docs.BaseDocument):
+            __tablename__ = 'conflictmodel'
+            __table_args__ = (UniqueConstraint('first', 'last'),)
+            id = fields.IdField(primary_key=True)
+            email = fields.StringField(unique=True)
+            first = fields.StringField()
+            last = fields.StringField()
+            settings = fields.DictField()
+        memory_db()
+        get_columns = ConflictModel._get_conflict_columns
+        assert get_columns({'id': 1}, {}) == [ConflictModel.__table__.c.id]
+        assert get_columns({'email': 'a'}, {'first': 'b'}) == [
+            ConflictModel.__table__.c.email]
+        assert len(get_columns({'first': 'a', 'last': 'b'}, {})) == 2
+        assert get_columns({'first': 'a'}, {}) is None
+        assert get_columns({'email': 'a', 'first': 'b'}, {}) is None
+        assert get_columns({'email': 'a'}, {'foo': 1}) is None
+        assert get_columns({'email': 'a'}, {'settings': {}}) is None
+        assert get_columns({}, {}) is None
+
+    def test_get_or_create_upsert(self, memory_db, transaction_manager):
+        class UpsertModel(docs.BaseDocument):
+            __tablename__ = 'upsertmodel'
+            id = fields.IdField(primary_key=True)
+            email = fields.StringField(unique=True)
+            name = fields.StringField()
+        memory_db()
+
+        with patch.object(docs.BaseMixin, 'get_collection') as get_coll:
+            obj, created = UpsertModel.get_or_create(
+                email='a', defaults={'name': 'foo'})
+            assert created
+            assert (obj.email, obj.name) == ('a', 'foo')
+            obj2, created = UpsertModel.get_or_create(
+                email='a', defaults={'name': 'bar'})
+            assert not created
+            assert obj2 is obj
+            assert obj2.name == 'foo'
+            assert not get_coll.called
+        transaction_manager.commit()
+        assert UpsertModel.get_collection(_count=True) == 1
+
+    def test_get_or_create_insert_hooks(
+            self, memory_db, transaction_manager):
+        from sqlalchemy import event
+        from sqlalchemy.orm import validates
+
+        class HookProfile(docs.BaseDocument):
+            __tablename__ = 'hookprofile'
+            id = fields.IdField(primary_key=True)
+            user_id = fields.IdField()
+
+        class HookUser(docs.ESBaseDocument):
+            __tablename__ = 'hookuser'
+            id = fields.IdField(primary_key=True)
+            email = fields.StringField(unique=True)
+
+        class HookValidated(docs.BaseDocument):
+            __tablename__ = 'hookvalidated'
+            id = fields.IdField(primary_key=True)
+            email = fields.StringField(unique=True)
+
+            @validates('email')
+            def validate_email(self, key, value):
+                return value.lower()
+
+        memory_db()
+        assert not HookProfile._has_insert_hooks()
+        assert not HookUser._has_insert_hooks()
+        assert HookValidated._has_insert_hooks()
+
+        @event.listens_for(HookUser, 'after_insert')
+        def create_profile(mapper, connection, target):
+            connection.execute(
+                HookProfile.__table__.insert(), user_id=target.id)
+        assert HookUser._has_insert_hooks()
+        with patch('nefertari.elasticsearch.ES'):
+            user, created = HookUser.get_or_create(email='a')
+            transaction_manager.commit()
+        assert created
+        assert HookProfile.get_collection(_count=True) == 1
+
+        get_columns = HookProfile._get_conflict_columns
+        assert get_columns({'id': 1}, {}) == [HookProfile.__table__.c.id]
+        HookProfile._upsert_enabled = False
+        assert get_columns({'id': 1}, {}) is None
+
+    @patch.object(docs.BaseMixin, '_upsert')
+    def test_get_or_create_upsert_not_supported(
+            self, mock_upsert, simple_model, memory_db):
+        memory_db()
+        mock_upsert.return_value = None
+        obj, created = simple_model.get_or_create(
+            id=1, defaults={'name': 'foo'})
+        assert created
+        assert obj.name == 'foo'
+        params, _, columns = mock_upsert.call_args[0]
+        assert params == {'id': 1}
+        assert columns == [simple_model.__table__.c.id]
+
+    @patch.object(docs, 'on_bulk_create')
+    @patch.object(docs, 'Session')
+    def test_upsert_postgresql(self, mock_sess, mock_on_create, memory_db):
+        from sqlalchemy.dialects import postgresql
+
+        class UpsertPGModel(docs.BaseDocument):
+            __tablename__ = 'upsertpgmodel'
+            id = fields.IdField(primary_key=True)
+            email = fields.StringField(unique=True)
+        memory_db()
+        session = mock_sess()
+        session.get_bind().dialect = postgresql.dialect()
+        obj = UpsertPGModel(id=1, email='a')
+        session.query().instances.return_value = iter([(obj, True)])
+        result = UpsertPGModel._upsert(
+            {'email': 'a'}, {}, [UpsertPGModel.__table__.c.email])
+        assert result == (obj, True)
+        query = session.execute.call_args[0][0]
+        assert str(query.compile(dialect=postgresql.dialect())) == (
+            'WITH inserted AS \n'
+            '(INSERT INTO upsertpgmodel (email) VALUES (%(email)s) '
+            'ON CONFLICT (email) DO NOTHING '
+            'RETURNING upsertpgmodel.id, upsertpgmodel.email)\n '
+            'SELECT inserted.id, inserted.email, %(param_1)s AS _created '
+            '\nFROM inserted UNION ALL '
+            'SELECT upsertpgmodel.id, upsertpgmodel.email, '
+            '%(param_2)s AS anon_1 \nFROM upsertpgmodel '
+            '\nWHERE upsertpgmodel.email = %(email_1)s')
+        mock_on_create.assert_called_once_with(
+            UpsertPGModel, [1], session=session)
+
+        # Existing row is returned
+        mock_on_create.reset_mock()
+        session.query().instances.return_value = iter([(obj, False)])
+        result = UpsertPGModel._upsert(
+            {'email': 'a'}, {}, [UpsertPGModel.__table__.c.email])
+        assert result == (obj, False)
+        assert not mock_on_create.called
+
+        # Row inserted by concurrent transaction is not visible
+        session.query().instances.return_value = iter([])
+        assert UpsertPGModel._upsert(
+            {'email': 'a'}, {}, [UpsertPGModel.__table__.c.email]) is None
+
+    @patch.object(docs, 'Session')
+    def test_upsert_postgresql_conflict(self, mock_sess, memory_db):
+        from sqlalchemy.dialects import postgresql
+        from sqlalchemy.exc import IntegrityError
+
+        class UpsertConflictModel(docs.BaseDocument):
+            __tablename__ = 'upsertconflictmodel'
+            id = fields.IdField(primary_key=True)
+            email = fields.StringField(unique=True)
+            name = fields.StringField(unique=True)
+        memory_db()
+        session = mock_sess()
+        session.get_bind().dialect = postgresql.dialect()
+        session.execute.side_effect = IntegrityError(
+            'INSERT', {}, Exception('duplicate key value violates unique '
+                                    'constraint "name_key"'))
+        with pytest.raises(JHTTPConflict):
+            UpsertConflictModel._upsert(
+                {'email': 'a'}, {'name': 'foo'},
+                [UpsertConflictModel.__table__.c.email])
+
+        session.execute.side_effect = IntegrityError(
+            'INSERT', {}, Exception('null value in column "id"'))
+        with pytest.raises(IntegrityError):
+            UpsertConflictModel._upsert(
+                {'email': 'a'}, {}, [UpsertConflictModel.__table__.c.email])
+
     def test_underscore_update(self, memory_db):
         class MyModel(docs.BaseDocument):
             __tablename__ = 'mymodel'
@@ -439,10 +909,12 @@ class TestBaseMixin(object):
         assert mock_session().delete.call_count == 1
         mock_session().flush.assert_called_once_with()
 
+    @patch.object(docs.BaseMixin, '_index_enabled', True, create=True)
+    @patch.object(docs, 'has_indexed_relationships', return_value=True)
     @patch.object(docs, 'on_bulk_delete')
     @patch.object(docs.BaseMixin, '_clean_queryset')
     def test_underscore_delete_many_query(
-            self, mock_clean, mock_on_bulk):
+            self, mock_clean, mock_on_bulk, mock_has_indexed):
         from sqlalchemy.orm.query import Query
         items = Query('asd')
         clean_items = Query("ASD")
@@ -457,6 +929,123 @@ class TestBaseMixin(object):
             docs.BaseMixin, [1, 2, 3], None)
         assert count == clean_items.delete()
 
+    @patch.object(docs, 'has_indexed_relationships', return_value=True)
+    @patch.object(docs, 'on_bulk_delete_ids')
+    @patch.object(docs.BaseMixin, '_delete_returning_ids')
+    @patch.object(docs.BaseMixin, '_clean_queryset')
+    def test_underscore_delete_many_query_not_indexed(
+            self, mock_clean, mock_delete_ids, mock_on_bulk,
+            mock_has_indexed):
+        from sqlalchemy.orm.query import Query
+        clean_items = Query('ASD')
+        clean_items.all = Mock()
+        mock_clean.return_value = clean_items
+        mock_delete_ids.return_value = [1, 2]
+        count = docs.BaseMixin._delete_many(Query('asd'))
+        assert count == 2
+        assert not clean_items.all.called
+        mock_delete_ids.assert_called_once_with(clean_items, False)
+        mock_on_bulk.assert_called_once_with(
+            docs.BaseMixin, [1, 2], None, session=clean_items.session)
+
+    @patch.object(docs, 'on_bulk_delete_ids')
+    def test_underscore_delete_many_query_ids(
+            self, mock_on_bulk, memory_db, transaction_manager):
+        class DeleteParent(docs.BaseDocument):
+            __tablename__ = 'deleteparent'
+            id = fields.IdField(primary_key=True)
+            children = fields.Relationship(
+                document='DeleteChild', backref_name='parent')
+
+        class DeleteChild(docs.BaseDocument):
+            __tablename__ = 'deletechild'
+            id = fields.IdField(primary_key=True)
+            name = fields.StringField()
+            parent_id = fields.ForeignKeyField(
+                ref_document='DeleteParent', ref_column='deleteparent.id',
+                ref_column_type=fields.IdField)
+        memory_db()
+        for pk in range(1, 5):
+            DeleteChild(id=pk, name='a' if pk % 2 else 'b').save()
+        transaction_manager.commit()
+
+        from pyramid_sqlalchemy import Session
+        query = DeleteChild.get_collection(name='a', _limit=10)
+        count = DeleteChild._delete_many(query)
+        assert count == 2
+        assert not Session().identity_map
+        mock_on_bulk.assert_called_once_with(
+            DeleteChild, [1, 3], None, session=Session())
+        transaction_manager.commit()
+        assert [obj.id for obj in DeleteChild.get_collection(
+            _sort=['id'])] == [2, 4]
+
+    @patch.object(docs, 'mark_changed')
+    def test_delete_returning_ids_postgresql(self, mock_mark, simple_model,
+                                             memory_db):
+        from sqlalchemy.dialects import postgresql
+        memory_db()
+        queryset = Mock()
+        queryset.whereclause = simple_model.name == 'foo'
+        queryset.session.get_bind().dialect = postgresql.dialect()
+        queryset.session.execute.return_value = [(1,), (2,)]
+        ids = simple_model._delete_returning_ids(queryset)
+        assert ids == [1, 2]
+        query = queryset.session.execute.call_args[0][0]
+        assert str(query.compile(dialect=postgresql.dialect())) == (
+            'DELETE FROM mymodel WHERE mymodel.name = %(name_1)s '
+            'RETURNING mymodel.id')
+        assert not queryset.delete.called
+        queryset.session.flush.assert_called_once_with()
+        mock_mark.assert_called_once_with(queryset.session)
+
+    def test_bulk_create(self, memory_db):
+        class BulkModel(docs.BaseDocument):
+            __tablename__ = 'bulkmodel'
+            id = fields.IdField(primary_key=True)
+            name = fields.StringField(max_length=3)
+            settings = fields.DictField()
+        memory_db()
+        assert BulkModel.bulk_create([]) == []
+        ids = BulkModel.bulk_create(
+            [{'id': 5, 'name': 'foo'}, {'name': 'bar'}, {'name': 'baz'}],
+            chunk_size=1)
+        assert ids == [5, 6, 7]
+        objects = BulkModel.get_collection(_sort=['id'])
+        assert [(obj.id, obj.name, obj.settings) for obj in objects] == [
+            (5, 'foo', {}), (6, 'bar', {}), (7, 'baz', {})]
+
+        with pytest.raises(JHTTPBadRequest) as ex:
+            BulkModel.bulk_create([{'name': 'foo', 'foo': 1}])
+        assert 'does not have fields: foo' in str(ex.value)
+        with pytest.raises(Exception) as ex:
+            BulkModel.bulk_create([{'name': 'foobar'}])
+        assert 'Value length must be less than 3' in str(ex.value)
+
+    @patch.object(docs, 'on_bulk_create')
+    @patch.object(docs, 'Session')
+    def test_bulk_create_postgresql(self, mock_sess, mock_on_create,
+                                    memory_db):
+        from sqlalchemy.dialects import postgresql
+
+        class BulkPGModel(docs.BaseDocument):
+            __tablename__ = 'bulkpgmodel'
+            id = fields.IdField(primary_key=True)
+            name = fields.StringField()
+        memory_db()
+        session = mock_sess()
+        session.get_bind().dialect = postgresql.dialect()
+        session.execute.return_value = [(1,), (2,)]
+        ids = BulkPGModel.bulk_create([{'name': 'foo'}, {'name': 'bar'}])
+        assert ids == [1, 2]
+        assert not session.bulk_insert_mappings.called
+        query = session.execute.call_args[0][0]
+        assert str(query.compile(dialect=postgresql.dialect())) == (
+            'INSERT INTO bulkpgmodel (name) VALUES '
+            '(%(name_m0)s), (%(name_m1)s) RETURNING bulkpgmodel.id')
+        mock_on_create.assert_called_once_with(
+            BulkPGModel, [1, 2], None, session=session)
+
     def test_underscore_update_many(self):
         item = Mock()
         assert docs.BaseMixin._update_many([item], {'foo': 'bar'}) == 1
@@ -481,18 +1070,32 @@ class TestBaseMixin(object):
         obj.id = 3
         assert str(obj) == '<MyModel: id=3>'
 
+    @patch.object(docs, 'Session')
     @patch.object(docs.BaseMixin, 'get_collection')
-    def test_get_by_ids(self, mock_coll, memory_db):
+    def test_get_by_ids(self, mock_coll, mock_sess, memory_db):
         class MyModel(docs.BaseDocument):
             __tablename__ = 'mymodel'
             name = fields.StringField(primary_key=True)
         memory_db()
         MyModel.name = Mock()
-        MyModel.get_by_ids([1, 2, 3], foo='bar')
-        mock_coll.assert_called_once_with(foo='bar')
+        result = MyModel.get_by_ids([1, 2, 3], foo='bar')
+        mock_sess().query.assert_called_with(MyModel)
         MyModel.name.in_.assert_called_once_with([1, 2, 3])
-        assert mock_coll().from_self().filter.call_count == 1
-        mock_coll().from_self().filter().limit.assert_called_once_with(3)
+        mock_sess().query().filter.assert_called_once_with(
+            MyModel.name.in_())
+        mock_coll.assert_called_once_with(
+            foo='bar', query_set=mock_sess().query().filter())
+        assert result == mock_coll()
+
+    def test_get_by_ids_flat_query(self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        simple_model(id=2, name='bar').save()
+        simple_model(id=3, name='baz').save()
+        query_set = simple_model.get_by_ids(
+            [1, 3], _limit=10, _sort=['id'])
+        assert 'FROM (SELECT' not in str(query_set)
+        assert [obj.id for obj in query_set] == [1, 3]
 
     def test_get_null_values(self, memory_db):
         class MyModel1(docs.BaseDocument):
@@ -520,47 +1123,88 @@ class TestBaseMixin(object):
         }
 
     def test_to_dict(self, memory_db):
-        class MyModel(docs.BaseDocument):
-            __tablename__ = 'mymodel'
-            _nested_relationships = ['other_obj3']
+        class SerChild(docs.BaseDocument):
+            __tablename__ = 'serchild'
             id = fields.IdField(primary_key=True)
-            other_obj = fields.StringField()
-            other_obj2 = fields.StringField()
-            other_obj3 = fields.StringField()
+            parent_id = fields.ForeignKeyField(
+                ref_document='SerParent', ref_column='serparent.id',
+                ref_column_type=fields.IdField)
+
+        class SerProfile(docs.BaseDocument):
+            __tablename__ = 'serprofile'
+            id = fields.IdField(primary_key=True)
+            parent_id = fields.ForeignKeyField(
+                ref_document='SerParent', ref_column='serparent.id',
+                ref_column_type=fields.IdField)
+
+        class SerParent(docs.BaseDocument):
+            __tablename__ = 'serparent'
+            _nested_relationships = ['profile']
+            id = fields.IdField(primary_key=True)
+            name = fields.StringField()
+            extra = fields.PickleField()
+            children = fields.Relationship(
+                document='SerChild', backref_name='parent')
+            profile = fields.Relationship(
+                document='SerProfile', backref_name='parent',
+                uselist=False)
         memory_db()
-        myobj1 = MyModel(id=1)
-        myobj1.other_obj = MyModel(id=2)
-        myobj1.other_obj2 = InstrumentedList([MyModel(id=3)])
-        myobj1.other_obj3 = MyModel(id=4)
+        parent = SerParent(id=1, name='foo')
+        parent.children = [SerChild(id=2), SerChild(id=3)]
+        parent.profile = SerProfile(id=4)
+        parent.extra = SerChild(id=5)
 
-        result = myobj1.to_dict()
+        result = parent.to_dict()
         assert list(sorted(result.keys())) == [
-            '_pk', '_type', 'id', 'other_obj',
-            'other_obj2', 'other_obj3']
-        assert result['_type'] == 'MyModel'
+            '_pk', '_type', 'children', 'extra', 'id', 'name', 'profile']
+        assert result['_type'] == 'SerParent'
         assert result['id'] == 1
         assert result['_pk'] == '1'
-        # Not nester one-to-one
-        assert result['other_obj'] == 2
-        # Not nester many-to-one
-        assert result['other_obj2'] == [3]
+        assert result['name'] == 'foo'
+        # Not nested one-to-many
+        assert result['children'] == [2, 3]
+        # Object stored in a column
+        assert result['extra'] == 5
         # Nested one-to-one
-        assert isinstance(result['other_obj3'], dict)
-        assert result['other_obj3']['_type'] == 'MyModel'
-        assert result['other_obj3']['id'] == 4
+        assert isinstance(result['profile'], dict)
+        assert result['profile']['_type'] == 'SerProfile'
+        assert result['profile']['id'] == 4
+        # Nesting depth reached
+        assert result['profile']['parent'] == 1
+
+        child = parent.children[0]
+        assert child.to_dict()['parent'] == 1
+        assert SerChild(id=6).to_dict()['parent'] is None
 
     def test_to_dict_depth(self, memory_db):
-        class MyModel(docs.BaseDocument):
-            __tablename__ = 'mymodel'
-            _nested_relationships = ['other_obj']
+        class DepthProfile(docs.BaseDocument):
+            __tablename__ = 'depthprofile'
             id = fields.IdField(primary_key=True)
-            other_obj = fields.StringField()
+            parent_id = fields.ForeignKeyField(
+                ref_document='DepthParent', ref_column='depthparent.id',
+                ref_column_type=fields.IdField)
+
+        class DepthParent(docs.BaseDocument):
+            __tablename__ = 'depthparent'
+            _nested_relationships = ['profile']
+            id = fields.IdField(primary_key=True)
+            profile = fields.Relationship(
+                document='DepthProfile', backref_name='parent',
+                uselist=False)
         memory_db()
-        myobj1 = MyModel(id=1)
-        myobj1.other_obj = MyModel(id=2)
+        parent = DepthParent(id=1)
+        parent.profile = DepthProfile(id=4)
 
-        result = myobj1.to_dict(_depth=0)
-        assert result['other_obj'] == 2
+        result = parent.to_dict(_depth=0)
+        assert result['profile'] == 4
+
+    def test_get_serializer_cached(self, simple_model, memory_db):
+        memory_db()
+        serializer = docs.get_serializer(simple_model, 1)
+        assert docs.get_serializer(simple_model, 1) is serializer
+        assert docs.get_serializer(simple_model, 0) is not serializer
+        assert serializer(simple_model(id=1, name='foo')) == {
+            '_pk': '1', '_type': 'MyModel', 'id': 1, 'name': 'foo'}
 
     @patch.object(docs, 'object_session')
     def test_update_iterables_dict(self, obj_session, memory_db):
@@ -678,6 +1322,69 @@ class TestBaseMixin(object):
         result = [v for v in child.get_related_documents(nested_only=True)]
         assert len(result) == 0
 
+    def test_get_nesting_graph(self, memory_db):
+
+        class GraphItem(docs.BaseDocument):
+            __tablename__ = 'graph_item'
+            id = fields.IdField(primary_key=True)
+            list_id = fields.ForeignKeyField(
+                ref_document='GraphList', ref_column='graph_list.id',
+                ref_column_type=fields.IdField)
+            tag_id = fields.ForeignKeyField(
+                ref_document='GraphTag', ref_column='graph_tag.id',
+                ref_column_type=fields.IdField)
+
+        class GraphList(docs.BaseDocument):
+            __tablename__ = 'graph_list'
+            _nested_relationships = ('items',)
+            id = fields.IdField(primary_key=True)
+            board_id = fields.ForeignKeyField(
+                ref_document='GraphBoard', ref_column='graph_board.id',
+                ref_column_type=fields.IdField)
+            items = fields.Relationship(
+                document='GraphItem', backref_name='list')
+
+        class GraphBoard(docs.BaseDocument):
+            __tablename__ = 'graph_board'
+            _nested_relationships = ('lists',)
+            _nesting_depth = 2
+            id = fields.IdField(primary_key=True)
+            lists = fields.Relationship(
+                document='GraphList', backref_name='board')
+
+        class GraphTag(docs.BaseDocument):
+            __tablename__ = 'graph_tag'
+            id = fields.IdField(primary_key=True)
+            items = fields.Relationship(
+                document='GraphItem', backref_name='tag')
+
+        memory_db()
+        graph = docs.get_nesting_graph()
+        assert graph[GraphItem] == (
+            (('list',), GraphList),
+            (('list', 'board'), GraphBoard),
+        )
+        assert graph[GraphList] == ((('board',), GraphBoard),)
+        assert GraphBoard not in graph
+        assert GraphTag not in graph
+        assert docs.get_nesting_graph() is graph
+
+        board = GraphBoard(id=1)
+        lists = [GraphList(id=1, board=board), GraphList(id=2, board=board)]
+        tag = GraphTag(id=1)
+        item = GraphItem(id=1, list=lists[0], tag=tag)
+        result = list(item.get_related_documents(nested_only=True))
+        assert result == [(GraphList, [lists[0]]), (GraphBoard, [board])]
+        result = list(item.get_related_documents())
+        assert sorted(cls.__name__ for cls, _ in result) == [
+            'GraphList', 'GraphTag']
+
+        # Board documents only contain lists with their items ids
+        GraphBoard._nesting_depth = 1
+        docs._reset_models_metadata()
+        assert docs.get_nesting_graph()[GraphItem] == (
+            (('list',), GraphList),)
+
     def test_is_modified_id_not_persistent(self, memory_db, simple_model):
         memory_db()
         obj = simple_model()
@@ -786,6 +1493,20 @@ class TestGetCollection(object):
         assert queryset2.count() == 1
         assert queryset2.first().id == 2
 
+    def test_input_queryset_limited(self, memory_db):
+        class MyModel(docs.BaseDocument):
+            __tablename__ = 'mymodel'
+            id = fields.IdField(primary_key=True)
+            name = fields.StringField()
+        memory_db()
+        MyModel(id=1, name='foo').save()
+        MyModel(id=2, name='boo').save()
+        MyModel(id=3, name='boo').save()
+        limited = docs.Session().query(MyModel).order_by(MyModel.id).limit(2)
+        queryset = MyModel.get_collection(
+            _limit=50, name='boo', query_set=limited)
+        assert [obj.id for obj in queryset] == [2]
+
     def test_sort_param(self, simple_model, memory_db):
         memory_db()
 
@@ -883,3 +1604,266 @@ class TestGetCollection(object):
         assert queryset._nefertari_meta['total'] == 1
         assert queryset._nefertari_meta['start'] == 0
         assert queryset._nefertari_meta['fields'] == []
+
+    def test_total_mode_invalid(self, simple_model, memory_db):
+        memory_db()
+        with pytest.raises(JHTTPBadRequest) as ex:
+            simple_model.get_collection(_limit=1, _total_mode='foo')
+        assert 'Bad _total_mode param' in str(ex.value)
+
+    def test_total_mode_count(self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        simple_model(id=2, name='bar').save()
+        with patch.object(docs.Query, 'count') as mock_count:
+            mock_count.return_value = 2
+            queryset = simple_model.get_collection(_limit=1, _start=1)
+        mock_count.assert_called_once_with()
+        assert queryset._nefertari_meta['total'] == 2
+        assert [obj.id for obj in queryset] == [2]
+
+    def test_total_mode_count_start_without_limit(
+            self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        queryset = simple_model.get_collection(
+            _start='1', _raise_on_empty=True)
+        assert [obj.id for obj in queryset] == [1]
+
+    def test_total_mode_window(self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        simple_model(id=2, name='bar').save()
+        simple_model(id=3, name='bar').save()
+        result = simple_model.get_collection(
+            _limit=2, _sort=['id'], _total_mode='window')
+        assert isinstance(result, list)
+        assert [obj.id for obj in result] == [1, 2]
+        assert result._nefertari_meta['total'] == 3
+        assert docs.BaseMixin.count(result) == 2
+
+        result = simple_model.get_collection(
+            _limit=2, _start=5, _total_mode='window')
+        assert result == []
+        assert result._nefertari_meta['total'] == 3
+
+    def test_total_mode_window_fields(self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        result = simple_model.get_collection(
+            _limit=2, _fields=['name'], _total_mode='window')
+        assert result == [{'_pk': 1, '_type': 'MyModel', 'name': 'foo'}]
+        assert result._nefertari_meta['total'] == 1
+
+    def test_total_mode_skip(self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        result = simple_model.get_collection(_limit=1, _total_mode='skip')
+        assert result._nefertari_meta['total'] is None
+        assert result.first().id == 1
+
+        with pytest.raises(JHTTPNotFound):
+            simple_model.get_collection(
+                _limit=1, _start=1, _total_mode='skip',
+                _raise_on_empty=True)
+
+    def test_keyset_pagination(self, simple_model, memory_db):
+        memory_db()
+        for id_, name in [(1, 'b'), (2, 'a'), (3, 'b'), (4, 'a')]:
+            simple_model(id=id_, name=name).save()
+
+        result = simple_model.get_collection(
+            _limit=3, _sort=['name'], _after='')
+        assert [obj.id for obj in result] == [2, 4, 1]
+        assert result._nefertari_meta['total'] == 4
+        assert result._nefertari_meta['start'] is None
+        cursor = result._nefertari_meta['next_cursor']
+        assert cursor
+
+        result = simple_model.get_collection(
+            _limit=3, _sort=['name'], _after=cursor)
+        assert [obj.id for obj in result] == [3]
+        assert result._nefertari_meta['next_cursor'] is None
+
+    def test_keyset_pagination_mixed_directions(
+            self, simple_model, memory_db):
+        memory_db()
+        for id_, name in [(1, 'b'), (2, 'a'), (3, 'b'), (4, 'a')]:
+            simple_model(id=id_, name=name).save()
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            result = simple_model.get_collection(
+                _limit=1, _sort=['-name'], _after=cursor)
+            ids += [obj.id for obj in result]
+            cursor = result._nefertari_meta['next_cursor']
+        assert ids == [1, 3, 2, 4]
+
+    def test_keyset_pagination_fields(self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        simple_model(id=2, name='bar').save()
+        result = simple_model.get_collection(
+            _limit=1, _fields=['name'], _sort=['name'], _after='')
+        assert result == [{'_pk': 2, '_type': 'MyModel', 'name': 'bar'}]
+        result = simple_model.get_collection(
+            _limit=1, _fields=['name'], _sort=['name'],
+            _after=result._nefertari_meta['next_cursor'])
+        assert result == [{'_pk': 1, '_type': 'MyModel', 'name': 'foo'}]
+
+        with pytest.raises(JHTTPBadRequest) as ex:
+            simple_model.get_collection(
+                _limit=1, _fields=['id'], _sort=['name'], _after='')
+        assert 'Sorting fields must be included' in str(ex.value)
+
+    def test_keyset_pagination_bad_params(self, simple_model, memory_db):
+        memory_db()
+        with pytest.raises(JHTTPBadRequest):
+            simple_model.get_collection(_limit=1, _start=1, _after='')
+        with pytest.raises(JHTTPBadRequest):
+            simple_model.get_collection(
+                _limit=1, _total_mode='window', _after='')
+        with pytest.raises(JHTTPBadRequest) as ex:
+            simple_model.get_collection(_limit=1, _after='foo')
+        assert 'Bad _after param' in str(ex.value)
+
+    def test_cursor_encoding(self):
+        import datetime
+        import decimal
+        from ..utils import encode_cursor, decode_cursor
+        values = [
+            1, 'foo', None,
+            datetime.datetime(2015, 1, 2, 3, 4, 5, 6),
+            datetime.date(2015, 1, 2),
+            decimal.Decimal('1.5'),
+        ]
+        assert decode_cursor(encode_cursor(values)) == values
+
+    def _define_eager_models(self):
+        class EagerTag(docs.BaseDocument):
+            __tablename__ = 'eagertag'
+            id = fields.IdField(primary_key=True)
+            profile_id = fields.ForeignKeyField(
+                ref_document='EagerProfile', ref_column='eagerprofile.id',
+                ref_column_type=fields.IdField)
+
+        class EagerProfile(docs.BaseDocument):
+            __tablename__ = 'eagerprofile'
+            _nested_relationships = ['tags']
+            id = fields.IdField(primary_key=True)
+            parent_id = fields.ForeignKeyField(
+                ref_document='EagerParent', ref_column='eagerparent.id',
+                ref_column_type=fields.IdField)
+            tags = fields.Relationship(
+                document='EagerTag', backref_name='profile')
+
+        class EagerChild(docs.BaseDocument):
+            __tablename__ = 'eagerchild'
+            id = fields.IdField(primary_key=True)
+            parent_id = fields.ForeignKeyField(
+                ref_document='EagerParent', ref_column='eagerparent.id',
+                ref_column_type=fields.IdField)
+
+        class EagerParent(docs.BaseDocument):
+            __tablename__ = 'eagerparent'
+            _nested_relationships = ['profile']
+            _nesting_depth = 2
+            id = fields.IdField(primary_key=True)
+            children = fields.Relationship(
+                document='EagerChild', backref_name='parent')
+            profile = fields.Relationship(
+                document='EagerProfile', backref_name='parent',
+                uselist=False, backref_uselist=False)
+        return EagerParent, EagerProfile, EagerChild, EagerTag
+
+    def test_eager_load(self, memory_db):
+        from pyramid_sqlalchemy import Session
+        from sqlalchemy import event
+        Parent, Profile, Child, Tag = self._define_eager_models()
+        connection = memory_db()
+        for id_ in range(1, 4):
+            parent = Parent(id=id_)
+            parent.children = [Child(id=id_ * 10), Child(id=id_ * 10 + 1)]
+            parent.profile = Profile(id=id_, tags=[Tag(id=id_)])
+            parent.save()
+        Session().expunge_all()
+
+        options = Parent.get_eager_load_options()
+        assert len(options) == 5
+
+        statements = []
+        event.listen(
+            connection, 'before_cursor_execute',
+            lambda conn, cursor, stmt, *a: statements.append(stmt))
+        queryset = Parent.get_collection(
+            _eager_load=True, _total_mode='skip', _sort=['id'])
+        data = [obj.to_dict() for obj in queryset]
+
+        # Parents with joined profiles, children, profiles' tags
+        assert len(statements) == 3
+        assert data[0]['children'] == [10, 11]
+        assert data[0]['profile']['_type'] == 'EagerProfile'
+        assert data[0]['profile']['tags'][0]['_type'] == 'EagerTag'
+
+    def test_fields_param_lazy(self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        simple_model(id=2, name='bar').save()
+
+        result = simple_model.get_collection(
+            _limit=2, _fields=['name'], _sort=['id'])
+        assert result._cache == []
+        assert result[0] == {'_type': 'MyModel', '_pk': 1, 'name': 'foo'}
+        assert len(result._cache) == 1
+        assert len(result) == 2
+        assert [item['name'] for item in result] == ['foo', 'bar']
+        assert result[-1]['name'] == 'bar'
+        assert result[:1] == [result[0]]
+        assert simple_model.count(result) == 2
+
+    def test_stream_param(self, simple_model, memory_db):
+        memory_db()
+        simple_model(id=1, name='foo').save()
+        simple_model(id=2, name='bar').save()
+
+        result = simple_model.get_collection(_stream=1, _sort=['id'])
+        assert result._yield_per == 1
+        assert [obj.id for obj in result] == [1, 2]
+
+        result = simple_model.get_collection(
+            _stream=1, _fields=['name'], _sort=['id'])
+        assert [item['name'] for item in result] == ['foo', 'bar']
+        assert list(result) == []
+        with pytest.raises(TypeError):
+            len(result)
+
+        with pytest.raises(JHTTPBadRequest):
+            simple_model.get_collection(_stream=1, _total_mode='window')
+
+    def test_stream_collection(self, memory_db):
+        class StreamParent(docs.BaseDocument):
+            __tablename__ = 'streamparent'
+            _nested_relationships = ['children']
+            id = fields.IdField(primary_key=True)
+            children = fields.Relationship(
+                document='StreamChild', backref_name='parent')
+
+        class StreamChild(docs.BaseDocument):
+            __tablename__ = 'streamchild'
+            id = fields.IdField(primary_key=True)
+            parent_id = fields.ForeignKeyField(
+                ref_document='StreamParent', ref_column='streamparent.id',
+                ref_column_type=fields.IdField)
+        memory_db()
+        for pk in range(1, 6):
+            StreamParent(id=pk, children=[StreamChild(id=pk)]).save()
+
+        chunks = list(StreamParent.stream_collection(
+            _chunk_size=2, _sort=['id']))
+        assert [[item['id'] for item in chunk] for chunk in chunks] == [
+            [1, 2], [3, 4], [5]]
+        assert chunks[0][0]['children'][0]['id'] == 1
+
+        chunks = list(StreamParent.stream_collection(
+            _chunk_size=3, _fields=['id'], _sort=['-id'], id=5))
+        assert chunks == [[{'_type': 'StreamParent', '_pk': 5, 'id': 5}]]
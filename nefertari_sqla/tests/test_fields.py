@@ -0,0 +1,85 @@
+import pytest
+from mock import patch
+
+from .. import fields
+
+
+class TestRelationship(object):
+
+    def test_default_lazy(self):
+        rel = fields.Relationship(
+            document='Foo', uselist=False, backref_name='bar')
+        assert rel.lazy == 'immediate'
+        assert rel.backref[1]['lazy'] == 'immediate'
+
+    def test_list_sides_not_changed(self):
+        rel = fields.Relationship(
+            document='Foo', backref_name='bar', backref_uselist=True)
+        assert rel.lazy == 'select'
+        assert 'lazy' not in rel.backref[1]
+
+    def test_explicit_lazy(self):
+        rel = fields.Relationship(
+            document='Foo', uselist=False, lazy='selectin',
+            backref_name='bar', backref_lazy='raise')
+        assert rel.lazy == 'selectin'
+        assert rel.backref[1]['lazy'] == 'raise'
+
+    @patch.object(fields, 'RELATIONSHIP_LAZY', 'immediate')
+    def test_set_relationship_lazy(self):
+        fields.set_relationship_lazy('select')
+        rel = fields.Relationship(
+            document='Foo', uselist=False, backref_name='bar')
+        assert rel.lazy == 'select'
+        assert rel.backref[1]['lazy'] == 'select'
+
+    def test_set_relationship_lazy_invalid(self):
+        with pytest.raises(ValueError) as ex:
+            fields.set_relationship_lazy('foo')
+        assert 'Invalid relationship loading strategy' in str(ex.value)
+
+
+class TestGinIndex(object):
+
+    def _get_ddl(self, table):
+        from sqlalchemy import create_engine
+        statements = []
+
+        def executor(sql, *args, **kwargs):
+            statements.append(str(sql.compile(dialect=engine.dialect)))
+        engine = create_engine(
+            'postgresql://', strategy='mock', executor=executor)
+        table.metadata.create_all(engine, checkfirst=False)
+        return statements
+
+    def _get_table(self, **kwargs):
+        from sqlalchemy import MetaData, Table
+        return Table(
+            'mytable', MetaData(),
+            fields.IdField(name='id', primary_key=True),
+            fields.DictField(name='settings', **kwargs),
+            fields.ListField(
+                name='groups', item_type=fields.StringField, **kwargs))
+
+    def test_gin_index_created(self):
+        statements = self._get_ddl(self._get_table(gin_index=True))
+        assert statements[1:] == [
+            'CREATE INDEX "ix_mytable_settings_gin" ON mytable '
+            'USING gin ("settings")',
+            'CREATE INDEX "ix_mytable_groups_gin" ON mytable '
+            'USING gin ("groups")',
+        ]
+
+    def test_gin_index_not_created_by_default(self):
+        table = self._get_table()
+        assert not table.c.settings.gin_index
+        assert len(self._get_ddl(table)) == 1
+
+    def test_gin_index_not_postgresql(self):
+        from sqlalchemy import create_engine
+        table = self._get_table(gin_index=True)
+        engine = create_engine('sqlite://')
+        table.metadata.create_all(engine)
+        assert engine.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        ).fetchall() == []
@@ -0,0 +1,170 @@
+import threading
+
+from mock import patch
+
+from .. import indexer
+from .. import signals
+from .fixtures import FakeBulk
+
+
+def doc(pk, **kwargs):
+    kwargs.update({'_pk': str(pk), '_type': 'Story'})
+    return kwargs
+
+
+class TestBackgroundIndexer(object):
+
+    def test_coalesced_and_flushed(self):
+        bulk = FakeBulk()
+        bg = indexer.BackgroundIndexer(bulk=bulk, flush_interval=60)
+        try:
+            bg.submit([
+                ('index', 'Story', doc(1, name='a')),
+                ('index', 'Story', doc(2, name='b')),
+            ])
+            bg.submit([
+                ('index', 'Story', doc(1, name='c')),
+                ('delete', 'Story', 2),
+            ])
+            assert bg.queue_depth == 2
+            assert bg.flush(timeout=5)
+        finally:
+            bg.shutdown(timeout=5)
+        assert bulk.calls == [[
+            ('index', 'Story', doc(1, name='c')),
+            ('delete', 'Story', 2),
+        ]]
+        stats = bg.stats()
+        assert stats['queue_depth'] == 0
+        assert stats['submitted'] == 2
+        assert stats['coalesced'] == 2
+        assert stats['sent'] == 2
+        assert stats['flushes'] == 1
+        assert stats['avg_flush_latency'] is not None
+
+    def test_partial_updates_merged(self):
+        bulk = FakeBulk()
+        bg = indexer.BackgroundIndexer(bulk=bulk, flush_interval=60)
+        try:
+            bg.submit([
+                ('index', 'Story', doc(1, name='a', status='new')),
+                ('update', 'Story', {'_pk': '2', 'status': 'old'}),
+                ('delete', 'Story', 3),
+            ])
+            bg.submit([
+                ('update', 'Story', {'_pk': '1', 'status': 'old'}),
+                ('update', 'Story', {'_pk': '2', 'name': 'b'}),
+                ('update', 'Story', {'_pk': '3', 'name': 'c'}),
+            ])
+            assert bg.flush(timeout=5)
+        finally:
+            bg.shutdown(timeout=5)
+        assert bulk.calls == [[
+            ('index', 'Story', doc(1, name='a', status='old')),
+            ('update', 'Story', {'_pk': '2', 'status': 'old', 'name': 'b'}),
+            ('delete', 'Story', 3),
+        ]]
+
+    def test_flushed_by_size(self):
+        bulk = FakeBulk()
+        bg = indexer.BackgroundIndexer(
+            bulk=bulk, flush_size=2, flush_interval=60)
+        try:
+            bg.submit([('index', 'Story', doc(pk)) for pk in range(5)])
+            bg.flush(timeout=5)
+        finally:
+            bg.shutdown(timeout=5)
+        assert [len(call) for call in bulk.calls] == [2, 2, 1]
+
+    def test_flushed_by_time(self):
+        bulk = FakeBulk()
+        bg = indexer.BackgroundIndexer(bulk=bulk, flush_interval=0.01)
+        try:
+            bg.submit([('index', 'Story', doc(1))])
+            for _ in range(500):
+                if bulk.calls:
+                    break
+                threading.Event().wait(0.01)
+        finally:
+            bg.shutdown(timeout=5)
+        assert bulk.calls == [[('index', 'Story', doc(1))]]
+
+    def test_in_flight_document_not_sent_concurrently(self):
+        bulk = FakeBulk(block=True)
+        bg = indexer.BackgroundIndexer(
+            bulk=bulk, workers=2, flush_interval=0)
+        try:
+            bg.submit([('index', 'Story', doc(1, name='a'))])
+            for _ in range(500):
+                if bg.stats()['in_flight']:
+                    break
+                threading.Event().wait(0.01)
+            bg.submit([('index', 'Story', doc(1, name='b'))])
+            threading.Event().wait(0.05)
+            assert bg.queue_depth == 1
+            bulk.release.set()
+            assert bg.flush(timeout=5)
+        finally:
+            bg.shutdown(timeout=5)
+        assert bulk.calls == [
+            [('index', 'Story', doc(1, name='a'))],
+            [('index', 'Story', doc(1, name='b'))],
+        ]
+
+    def test_failed_bulk(self):
+        bg = indexer.BackgroundIndexer(
+            bulk=FakeBulk(failures=1), flush_interval=60)
+        try:
+            bg.submit([('index', 'Story', doc(1))])
+            assert bg.flush(timeout=5)
+        finally:
+            bg.shutdown(timeout=5)
+        assert bg.stats()['failed'] == 1
+        assert bg.stats()['sent'] == 0
+
+    def test_shutdown_sends_queued(self):
+        bulk = FakeBulk()
+        bg = indexer.BackgroundIndexer(bulk=bulk, flush_interval=60)
+        bg.submit([('index', 'Story', doc(1))])
+        bg.shutdown(timeout=5)
+        assert bulk.calls == [[('index', 'Story', doc(1))]]
+        try:
+            bg.submit([('index', 'Story', doc(2))])
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('RuntimeError not raised')
+
+    @patch.object(indexer, 'atexit')
+    def test_setup_indexer(self, mock_atexit):
+        bg = indexer.setup_indexer({
+            'nefertari_sqla.background_indexer.workers': '2',
+            'nefertari_sqla.background_indexer.flush_interval': '0.5',
+        })
+        try:
+            assert signals.INDEXER is bg
+            assert len(bg._threads) == 2
+            assert bg.flush_interval == 0.5
+            mock_atexit.register.assert_called_once_with(bg.shutdown)
+        finally:
+            signals.set_indexer(None)
+            bg.shutdown(timeout=5)
+
+    def test_index_batch_submits_to_indexer(self):
+        bulk = FakeBulk()
+        bg = indexer.BackgroundIndexer(bulk=bulk, flush_interval=60)
+        signals.set_indexer(bg)
+        try:
+            batch = signals.IndexBatch()
+            batch.documents[('Story', 1)] = doc(1)
+            batch.documents[('Story', 2)] = None
+            batch.send()
+            assert not batch.documents
+            bg.flush(timeout=5)
+        finally:
+            signals.set_indexer(None)
+            bg.shutdown(timeout=5)
+        assert bulk.calls == [[
+            ('index', 'Story', doc(1)),
+            ('delete', 'Story', 2),
+        ]]
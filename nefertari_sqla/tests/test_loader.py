@@ -0,0 +1,118 @@
+import datetime
+
+import pytest
+from mock import Mock, patch
+
+from .. import documents as docs
+from .. import fields
+from .. import loader
+from .fixtures import memory_db, transaction_manager
+
+
+def create_model(name, base=docs.ESBaseDocument):
+    return type(name, (base,), {
+        '__tablename__': name.lower(),
+        'id': fields.IdField(primary_key=True),
+        'name': fields.StringField(max_length=5),
+        'status': fields.ChoiceField(choices=['a', 'b'], default='a'),
+        'settings': fields.DictField(),
+    })
+
+
+class TestCopyFormat(object):
+
+    def test_format_copy_value(self):
+        assert loader.format_copy_value(None) == '\\N'
+        assert loader.format_copy_value(True) == 't'
+        assert loader.format_copy_value(1) == '1'
+        assert loader.format_copy_value('a\tb\\c\n') == 'a\\tb\\\\c\\n'
+        assert loader.format_copy_value({'a': 1}) == '{"a": 1}'
+        assert loader.format_copy_value(
+            datetime.timedelta(minutes=1)) == '60.0 seconds'
+        assert loader.format_copy_value(
+            datetime.date(2015, 1, 2)) == '2015-01-02'
+        assert loader.format_copy_value(b'\x01\xff') == '\\\\x01ff'
+
+    def test_format_copy_array(self):
+        assert loader.format_copy_value(['a', 'b"c', None]) == (
+            '{"a","b\\\\"c",NULL}')
+
+    def test_iter_chunks(self):
+        assert list(loader.iter_chunks(iter(range(5)), 2)) == [
+            [0, 1], [2, 3], [4]]
+
+
+class TestBulkLoader(object):
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_bulk_load(self, mock_es, memory_db, transaction_manager):
+        LoadedDoc = create_model('LoadedDoc')
+        memory_db()
+        LoadedDoc(id=1, name='x').save()
+
+        result = loader.bulk_load(
+            LoadedDoc, ({'name': str(i)} for i in range(5)),
+            chunk_size=2, batch_size=3)
+        assert result == (5, 1, 6)
+        indexed = [[document['id'] for document in call[0][0]]
+                   for call in mock_es().index.call_args_list]
+        assert indexed == [[2, 3, 4], [5, 6]]
+
+        objects = LoadedDoc.get_collection(_sort=['id'])
+        assert [(obj.id, obj.name, obj.status, obj.settings)
+                for obj in objects][1:3] == [
+            (2, '0', 'a', {}), (3, '1', 'a', {})]
+
+    def test_bulk_load_pks(self, memory_db, transaction_manager):
+        LoadedPk = create_model('LoadedPk', base=docs.BaseDocument)
+        memory_db()
+        result = loader.bulk_load(
+            LoadedPk, [{'id': 10, 'name': 'a'}, {'id': 4, 'name': 'b'}])
+        assert result == (2, 3, 10)
+        assert LoadedPk.get_collection(_count=True) == 2
+
+    def test_callable_defaults(self, memory_db, transaction_manager):
+        import uuid
+        LoadedUuid = type('LoadedUuid', (docs.BaseDocument,), {
+            '__tablename__': 'loadeduuid',
+            'id': fields.StringField(
+                primary_key=True, default=lambda: uuid.uuid4().hex),
+            'name': fields.StringField(),
+        })
+        memory_db()
+        bulk_loader = loader.BulkLoader(LoadedUuid, fields=['name'])
+        bulk_loader.load([{'name': 'a'}, {'name': 'b'}, {'name': 'c'}])
+        ids = [obj.id for obj in LoadedUuid.get_collection()]
+        assert len(set(ids)) == 3
+
+    def test_validation(self, memory_db, transaction_manager):
+        LoadedInvalid = create_model('LoadedInvalid', base=docs.BaseDocument)
+        memory_db()
+        with pytest.raises(ValueError) as ex:
+            loader.bulk_load(LoadedInvalid, [{'name': 'foobar'}])
+        assert 'Field `name`' in str(ex.value)
+        with pytest.raises(ValueError) as ex:
+            loader.bulk_load(LoadedInvalid, [{'status': 'c'}])
+        assert 'Field `status`' in str(ex.value)
+
+    def test_copy_postgresql(self, memory_db):
+        from sqlalchemy.dialects import postgresql
+        LoadedCopy = create_model('LoadedCopy', base=docs.BaseDocument)
+        memory_db()
+        session = Mock()
+        session.get_bind().dialect = postgresql.dialect()
+        bulk_loader = loader.BulkLoader(
+            LoadedCopy, fields=['id', 'name', 'settings'], session=session)
+        bulk_loader.load_chunk(
+            ['id', 'name', 'settings'], bulk_loader.get_defaults(
+                ['id', 'name', 'settings']),
+            [{'id': 1, 'name': 'a\tb', 'settings': {'a': 1}},
+             {'id': 2}])
+        cursor = session.connection().connection.cursor()
+        statement, data = cursor.copy_expert.call_args[0]
+        assert statement == (
+            'COPY loadedcopy (id, name, settings, status) FROM STDIN')
+        assert data.getvalue() == (
+            '1\ta\\tb\t{"a": 1}\ta\n'
+            '2\t\\N\t\\N\ta\n')
+        assert cursor.close.called
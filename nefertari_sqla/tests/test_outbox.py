@@ -0,0 +1,159 @@
+import pytest
+from mock import patch
+
+from .. import documents as docs
+from .. import fields
+from .. import outbox
+from .fixtures import (
+    memory_db, transaction_manager, create_models, FakeBulk)
+
+
+@pytest.fixture
+def enabled_outbox(request):
+    outbox.enable_outbox()
+    request.addfinalizer(lambda: outbox.enable_outbox(False))
+
+
+def get_rows(connection):
+    table = outbox.get_outbox_table()
+    query = table.select().order_by(table.c.id)
+    return [(row.model, row.pk, row.op)
+            for row in connection.execute(query)]
+
+
+class TestOutbox(object):
+
+    def test_pk_encoding(self):
+        assert outbox.encode_pk(1) == '1'
+        assert outbox.encode_pk('1') == '"1"'
+        assert outbox.decode_pk(outbox.encode_pk(1)) == 1
+        assert outbox.decode_pk(outbox.encode_pk(u'a')) == u'a'
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_changes_written_to_outbox(
+            self, mock_es, enabled_outbox, memory_db, transaction_manager):
+        OutParent, OutChild = create_models('Out')
+        connection = memory_db()
+
+        parent = OutParent(id=1, name='foo').save()
+        OutChild(id=2, parent=parent).save()
+        transaction_manager.commit()
+
+        assert not mock_es.called
+        assert get_rows(connection) == [
+            ('OutParent', '1', 'index'),
+            ('OutParent', '1', 'index'),
+            ('OutChild', '2', 'index'),
+        ]
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_bulk_update_written_to_outbox(
+            self, mock_es, enabled_outbox, memory_db, transaction_manager):
+        from pyramid_sqlalchemy import Session
+        BulkOutParent, BulkOutChild = create_models('BulkOut')
+        connection = memory_db()
+        BulkOutParent(id=1, name='foo').save()
+        transaction_manager.commit()
+
+        query = Session().query(BulkOutParent)
+        BulkOutParent._update_many(query, {'name': 'bar'})
+        transaction_manager.commit()
+        assert not mock_es.called
+        assert get_rows(connection)[-1] == ('BulkOutParent', '1', 'index')
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_bulk_delete_written_to_outbox(
+            self, mock_es, enabled_outbox, memory_db, transaction_manager):
+        from pyramid_sqlalchemy import Session
+        BulkOutTag = type('BulkOutTag', (docs.ESBaseDocument,), {
+            '__tablename__': 'bulkouttag',
+            'id': fields.IdField(primary_key=True),
+        })
+        connection = memory_db()
+        BulkOutTag(id=1).save()
+        BulkOutTag(id=2).save()
+        transaction_manager.commit()
+
+        query = Session().query(BulkOutTag)
+        assert BulkOutTag._delete_many(query) == 2
+        transaction_manager.commit()
+        assert not mock_es.called
+        assert get_rows(connection)[-2:] == [
+            ('BulkOutTag', '1', 'delete'), ('BulkOutTag', '2', 'delete')]
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_rollback(
+            self, mock_es, enabled_outbox, memory_db, transaction_manager):
+        RollParent, RollChild = create_models('Roll')
+        connection = memory_db()
+        RollParent(id=1).save()
+        assert len(get_rows(connection)) == 1
+        transaction_manager.abort()
+        assert get_rows(connection) == []
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_worker_drain(
+            self, mock_es, enabled_outbox, memory_db, transaction_manager):
+        DrainParent, DrainChild = create_models('Drain')
+        connection = memory_db()
+
+        parent = DrainParent(id=1, name='foo').save()
+        child = DrainChild(id=2, parent=parent).save()
+        DrainChild(id=3, parent=parent).save()
+        child.delete()
+        transaction_manager.commit()
+
+        rows_count = len(get_rows(connection))
+        bulk = FakeBulk()
+        worker = outbox.OutboxWorker(connection, bulk=bulk, chunk_size=100)
+        assert worker.drain() == rows_count
+        assert get_rows(connection) == []
+        assert len(bulk.calls) == 1
+        actions = bulk.calls[0]
+        assert [(op, model) for op, model, _ in actions] == [
+            ('index', 'DrainChild'),
+            ('delete', 'DrainChild'),
+            ('index', 'DrainParent'),
+        ]
+        assert actions[0][2]['id'] == 3
+        assert actions[1][2] == 2
+        assert [c['id'] for c in actions[2][2]['children']] == [3]
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_worker_deletes_missing(
+            self, mock_es, enabled_outbox, memory_db, transaction_manager):
+        MissingParent, MissingChild = create_models('Missing')
+        connection = memory_db()
+        connection.execute(outbox.get_outbox_table().insert(), [
+            {'model': 'MissingParent', 'pk': '1', 'op': 'index'},
+            {'model': 'MissingParent', 'pk': '2', 'op': 'index'},
+        ])
+        MissingParent(id=1).save()
+        transaction_manager.commit()
+
+        bulk = FakeBulk()
+        worker = outbox.OutboxWorker(connection, bulk=bulk, chunk_size=2)
+        assert worker.drain() == 3
+        assert [[(op, doc if op == 'delete' else doc['id'])
+                 for op, model, doc in call] for call in bulk.calls] == [
+            [('index', 1), ('delete', 2)],
+            [('index', 1)],
+        ]
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_worker_retry(
+            self, mock_es, enabled_outbox, memory_db, transaction_manager):
+        RetryParent, RetryChild = create_models('Retry')
+        connection = memory_db()
+        RetryParent(id=1).save()
+        transaction_manager.commit()
+
+        bulk = FakeBulk(failures=2)
+        worker = outbox.OutboxWorker(
+            connection, bulk=bulk, max_retries=1, retry_delay=0)
+        with pytest.raises(Exception):
+            worker.drain()
+        assert len(get_rows(connection)) == 1
+        assert worker.drain() == 1
+        assert get_rows(connection) == []
+        assert len(bulk.calls) == 1
@@ -0,0 +1,85 @@
+import json
+
+from mock import patch
+
+from .. import documents as docs
+from .. import fields
+from .. import reindex
+from .fixtures import memory_db, transaction_manager, FakeBulk
+
+
+def create_model(name):
+    return type(name, (docs.ESBaseDocument,), {
+        '__tablename__': name.lower(),
+        'id': fields.IdField(primary_key=True),
+        'name': fields.StringField(),
+    })
+
+
+class TestReindex(object):
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_get_pk_ranges(self, mock_es, memory_db, transaction_manager):
+        from pyramid_sqlalchemy import Session
+        RangeStory = create_model('RangeStory')
+        memory_db()
+        for pk in (1, 2, 5, 7, 9):
+            RangeStory(id=pk).save()
+
+        session = Session()
+        assert reindex.get_pk_ranges(session, RangeStory, 2) == [
+            (None, 2), (2, 7), (7, None)]
+        assert reindex.get_pk_ranges(session, RangeStory, 5) == [
+            (None, 9), (9, None)]
+        assert reindex.get_pk_ranges(session, RangeStory, 10) == [
+            (None, None)]
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_reindex_range(self, mock_es, memory_db, transaction_manager):
+        RangeDoc = create_model('RangeDoc')
+        memory_db()
+        for pk in range(1, 8):
+            RangeDoc(id=pk, name=str(pk)).save()
+
+        bulk = FakeBulk()
+        count = reindex.reindex_range(
+            RangeDoc, 1, 6, batch_size=2, bulk=bulk)
+        assert count == 5
+        assert [[doc['id'] for _, _, doc in call]
+                for call in bulk.calls] == [[2, 3], [4, 5], [6]]
+        op, model_name, document = bulk.calls[0][0]
+        assert op == 'index'
+        assert model_name == 'RangeDoc'
+        assert document['_type'] == 'RangeDoc'
+        assert document['name'] == '2'
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_reindexer_resume(self, mock_es, memory_db, transaction_manager,
+                              tmpdir):
+        ResumeDoc = create_model('ResumeDoc')
+        memory_db()
+        for pk in range(1, 6):
+            ResumeDoc(id=pk).save()
+        transaction_manager.commit()
+
+        checkpoint = str(tmpdir.join('checkpoint.json'))
+        bulk = FakeBulk()
+        reindexer = reindex.Reindexer(
+            model_names=['ResumeDoc'], chunk_size=2, checkpoint=checkpoint)
+        tasks = reindexer.get_tasks()
+        assert [task[1:4] for task in tasks] == [
+            (0, None, 2), (1, 2, 4), (2, 4, None)]
+        reindexer.checkpoint.mark_done('ResumeDoc', 1)
+
+        reindexer = reindex.Reindexer(
+            model_names=['ResumeDoc'], chunk_size=2, checkpoint=checkpoint)
+        with patch.object(reindex, 'es_bulk', bulk):
+            assert reindexer.run() == 3
+        indexed = [doc['id'] for call in bulk.calls for _, _, doc in call]
+        assert indexed == [1, 2, 5]
+        with open(checkpoint) as checkpoint_file:
+            data = json.load(checkpoint_file)
+        assert data == {'ResumeDoc': {
+            'ranges': [[None, 2], [2, 4], [4, None]],
+            'done': [1, 0, 2],
+        }}
@@ -0,0 +1,545 @@
+import pytest
+from mock import patch, Mock
+from sqlalchemy.schema import FetchedValue
+
+from .. import documents as docs
+from .. import fields
+from .. import signals
+from .fixtures import memory_db, transaction_manager, create_models
+
+
+class TestRelationshipLoading(object):
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_on_after_update_previously_related(self, mock_es, memory_db):
+        from pyramid_sqlalchemy import Session
+
+        class PrevParent(docs.ESBaseDocument):
+            __tablename__ = 'prevparent'
+            id = fields.IdField(primary_key=True)
+            children = fields.Relationship(
+                document='PrevChild', backref_name='parent',
+                backref_lazy='select')
+
+        class PrevChild(docs.ESBaseDocument):
+            __tablename__ = 'prevchild'
+            id = fields.IdField(primary_key=True)
+            parent_id = fields.ForeignKeyField(
+                ref_document='PrevParent', ref_column='prevparent.id',
+                ref_column_type=fields.IdField)
+        memory_db()
+
+        PrevParent(id=1).save()
+        PrevParent(id=2).save()
+        PrevChild(id=1, parent_id=1).save()
+        session = Session()
+        session.expunge_all()
+
+        child = PrevChild.get_item(id=1)
+        new_parent = PrevParent.get_item(id=2)
+        child.parent = new_parent
+
+        with patch.object(signals, 'index_object') as mock_index:
+            session.flush()
+        indexed = [call[0][0] for call in mock_index.call_args_list]
+        old_parent = PrevParent.get_item(id=1)
+        assert old_parent in indexed
+        assert child in indexed
+        mock_index.assert_any_call(old_parent, with_refs=False, request=None)
+
+    def test_load_raise_relationships(self, memory_db):
+        from pyramid_sqlalchemy import Session
+
+        class RaiseParent(docs.BaseDocument):
+            __tablename__ = 'raiseparent'
+            _nested_relationships = ['children']
+            id = fields.IdField(primary_key=True)
+            children = fields.Relationship(
+                document='RaiseChild', backref_name='parent',
+                lazy='raise', backref_lazy='raise')
+
+        class RaiseChild(docs.BaseDocument):
+            __tablename__ = 'raisechild'
+            id = fields.IdField(primary_key=True)
+            parent_id = fields.ForeignKeyField(
+                ref_document='RaiseParent', ref_column='raiseparent.id',
+                ref_column_type=fields.IdField)
+        memory_db()
+
+        RaiseParent(id=1).save()
+        RaiseChild(id=2, parent_id=1).save()
+        session = Session()
+        session.expunge_all()
+
+        parent = session.query(RaiseParent).get(1)
+        signals.load_raise_relationships(parent)
+        data = parent.to_dict()
+        assert data['children'][0]['id'] == 2
+        assert data['children'][0]['parent'] == 1
+
+    def test_load_raise_relationships_no_session(self):
+        obj = Mock()
+        with patch.object(signals, 'object_session', return_value=None):
+            signals.load_raise_relationships(obj)
+        assert not obj.get_related_documents.called
+
+
+class TestIndexOnCommit(object):
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_documents_indexed_on_commit(self, mock_es, memory_db,
+                                         transaction_manager):
+        transaction = transaction_manager
+        BatchParent, BatchChild = create_models('Batch')
+        memory_db()
+
+        parent = BatchParent(id=1, name='foo').save()
+        BatchChild(id=1, parent=parent).save()
+        BatchChild(id=2, parent=parent).save()
+        parent.name = 'bar'
+        parent.save()
+        assert not mock_es.called
+
+        transaction.commit()
+        mock_es.assert_any_call('BatchParent')
+        mock_es.assert_any_call('BatchChild')
+        assert mock_es().index.call_count == 2
+        assert not mock_es().delete.called
+        indexed = {}
+        for call in mock_es().index.call_args_list:
+            for document in call[0][0]:
+                indexed[(document['_type'], document['_pk'])] = document
+        assert sorted(indexed) == [
+            ('BatchChild', '1'), ('BatchChild', '2'), ('BatchParent', '1')]
+        assert indexed[('BatchParent', '1')]['name'] == 'bar'
+        assert len(indexed[('BatchParent', '1')]['children']) == 2
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_deleted_documents(self, mock_es, memory_db,
+                               transaction_manager):
+        transaction = transaction_manager
+        from pyramid_sqlalchemy import Session
+        DeletedParent, DeletedChild = create_models('Deleted')
+        memory_db()
+
+        parent = DeletedParent(id=1).save()
+        child = DeletedChild(id=1, parent=parent).save()
+        transaction.commit()
+        mock_es.reset_mock()
+
+        child = Session().merge(child)
+        child.delete()
+        transaction.commit()
+        mock_es.assert_any_call('DeletedChild')
+        mock_es().delete.assert_called_once_with([1], request=None)
+        documents = mock_es().index.call_args[0][0]
+        assert [doc['_type'] for doc in documents] == ['DeletedParent']
+        assert documents[0]['children'] == []
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_batch_discarded_on_rollback(self, mock_es, memory_db,
+                                         transaction_manager):
+        transaction = transaction_manager
+        from pyramid_sqlalchemy import Session
+        RollbackParent, RollbackChild = create_models('Rollback')
+        memory_db()
+
+        RollbackParent(id=1).save()
+        assert signals.INDEX_BATCH_KEY in Session().info
+        transaction.abort()
+        assert signals.INDEX_BATCH_KEY not in Session().info
+        transaction.commit()
+        assert not mock_es.called
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_batch_restored_on_savepoint_rollback(
+            self, mock_es, memory_db, transaction_manager):
+        transaction = transaction_manager
+        from pyramid_sqlalchemy import Session
+        SavepointParent, SavepointChild = create_models('Savepoint')
+        memory_db()
+
+        session = Session()
+        SavepointParent(id=1, name='a').save()
+        session.begin_nested()
+        SavepointParent(id=2).save()
+        session.query(SavepointParent).get(1).update({'name': 'b'})
+        session.rollback()
+        session.begin_nested()
+        SavepointParent(id=3).save()
+        session.commit()
+        # Changes of released savepoint are not sent yet
+        assert not mock_es().index.called
+        transaction.commit()
+
+        documents = mock_es().index.call_args[0][0]
+        assert sorted((doc['id'], doc['name']) for doc in documents) == [
+            (1, 'a'), (3, None)]
+        assert mock_es().index.call_count == 1
+        assert signals.INDEX_SAVEPOINTS_KEY not in Session().info
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_index_on_commit_disabled(self, mock_es, memory_db):
+        ImmediateParent, ImmediateChild = create_models('Immediate')
+        memory_db()
+        signals.set_index_on_commit(False)
+        try:
+            ImmediateParent(id=1).save()
+            mock_es.assert_called_with('ImmediateParent')
+            assert mock_es().index.called
+            ImmediateChild(id=1, parent_id=1).save()
+        finally:
+            signals.set_index_on_commit(True)
+        documents = [doc for call in mock_es().index.call_args_list
+                     for doc in call[0][0]]
+        child = [doc for doc in documents
+                 if doc['_type'] == 'ImmediateChild'][0]
+        assert child['parent'] == 1
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_inserted_object_not_reloaded(self, mock_es, memory_db,
+                                          transaction_manager):
+        import datetime
+        from sqlalchemy import event
+        InsertParent, InsertChild = create_models('Insert')
+        InsertParent.duration = fields.IntervalField()
+        connection = memory_db()
+
+        statements = []
+        event.listen(
+            connection, 'before_cursor_execute',
+            lambda conn, cursor, statement, *args: statements.append(
+                statement))
+        parent = InsertParent(id=1, duration=60)
+        parent.children
+        parent.save()
+        # Insert followed by reloads of processed and empty attributes
+        assert len(statements) == 3
+        assert statements[0].startswith('INSERT INTO insertparent')
+        assert 'insertparent.duration' in statements[1]
+        assert 'FROM insertchild' in statements[2]
+
+        InsertChild(id=2, parent_id=1).save()
+        transaction_manager.commit()
+        documents = {}
+        for call in mock_es().index.call_args_list:
+            for document in call[0][0]:
+                documents[document['_type']] = document
+        assert documents['InsertParent']['duration'] == (
+            datetime.timedelta(seconds=60))
+        assert documents['InsertParent']['children'] == [
+            {'_type': 'InsertChild', '_pk': '2', 'id': 2, 'parent': 1,
+             'parent_id': 1}]
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_bulk_create(self, mock_es, memory_db, transaction_manager):
+        BulkParent, BulkChild = create_models('Bulk')
+        memory_db()
+        BulkParent(id=1, name='foo').save()
+        transaction_manager.commit()
+        mock_es.reset_mock()
+
+        ids = BulkChild.bulk_create(
+            [{'id': 1, 'parent_id': 1}, {'parent_id': 1}, {}])
+        assert ids == [1, 2, 3]
+        assert not mock_es.called
+
+        transaction_manager.commit()
+        indexed = {}
+        for call in mock_es().index.call_args_list:
+            for document in call[0][0]:
+                indexed[(document['_type'], document['_pk'])] = document
+        assert sorted(indexed) == [
+            ('BulkChild', '1'), ('BulkChild', '2'), ('BulkChild', '3'),
+            ('BulkParent', '1')]
+        assert [child['id'] for child in
+                indexed[('BulkParent', '1')]['children']] == [1, 2]
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_delete_many_ids(self, mock_es, memory_db, transaction_manager):
+        from pyramid_sqlalchemy import Session
+        SetParent, SetChild = create_models('Set')
+        memory_db()
+        for pk in (1, 2, 3):
+            SetParent(id=pk, name='a' if pk < 3 else 'b').save()
+        transaction_manager.commit()
+        Session().expunge_all()
+        mock_es.reset_mock()
+
+        assert not signals.has_indexed_relationships(
+            type('SetPlain', (docs.BaseDocument,), {
+                '__tablename__': 'setplain',
+                'id': fields.IdField(primary_key=True)}))
+        assert signals.has_indexed_relationships(SetParent)
+        # Children are not loaded when parents are deleted
+        with patch.object(docs, 'has_indexed_relationships',
+                          return_value=False):
+            count = SetParent._delete_many(
+                SetParent.get_collection(name='a'))
+        assert count == 2
+        assert not Session().identity_map
+        transaction_manager.commit()
+        mock_es().delete.assert_called_once_with([1, 2], request=None)
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_bulk_update_partial(self, mock_es, memory_db,
+                                 transaction_manager):
+        from pyramid_sqlalchemy import Session
+        UpdParent, UpdChild = create_models('Upd')
+        UpdParent._index_ignored_fields = ('name',)
+        UpdParent.status = fields.StringField()
+        memory_db()
+        for pk in (1, 2, 3):
+            UpdParent(id=pk, name='a', status='new').save()
+        transaction_manager.commit()
+        mock_es.reset_mock()
+
+        query = Session().query(UpdParent).filter(UpdParent.id.in_([1, 2]))
+        assert UpdParent._update_many(query, {'name': 'b'}) == 2
+        transaction_manager.commit()
+        assert not mock_es.called
+
+        query = Session().query(UpdParent).filter(
+            UpdParent.status == 'new', UpdParent.id.in_([1, 2]))
+        with patch.object(signals, 'BULK_UPDATE_CHUNK_SIZE', 1):
+            assert UpdParent._update_many(query, {'status': 'old'}) == 2
+        transaction_manager.commit()
+        assert not mock_es().index.called
+        actions = mock_es().process_chunks.call_args[1]['documents']
+        assert [(action['_op_type'], action['_id'], action['doc'])
+                for action in actions] == [
+            ('update', '1', {'_pk': '1', 'status': 'old'}),
+            ('update', '2', {'_pk': '2', 'status': 'old'}),
+        ]
+
+    @patch('nefertari.elasticsearch._bulk_body')
+    @patch('nefertari.elasticsearch.ES')
+    def test_bulk_update_partial_missing(self, mock_es, mock_bulk, memory_db,
+                                         transaction_manager):
+        from elasticsearch.helpers import BulkIndexError
+        from pyramid_sqlalchemy import Session
+        MissParent, MissChild = create_models('Miss')
+        memory_db()
+        for pk in (1, 2):
+            MissParent(id=pk, name='a').save()
+        MissChild(id=3, parent_id=2).save()
+        transaction_manager.commit()
+        mock_es.reset_mock()
+        mock_es().process_chunks.side_effect = (
+            lambda documents, operation: operation(
+                documents_actions=documents))
+        mock_bulk.side_effect = BulkIndexError('1 document(s) failed', [
+            {'update': {'_id': '2', 'status': 404}}])
+
+        query = Session().query(MissParent)
+        assert MissParent._update_many(query, {'name': 'b'}) == 2
+        transaction_manager.commit()
+        mock_es().index.assert_called_once_with([{
+            '_pk': '2', '_type': 'MissParent', 'id': 2, 'name': 'b',
+            'children': [{'_pk': '3', '_type': 'MissChild', 'id': 3,
+                          'parent': 2, 'parent_id': 2}],
+        }], request=None)
+
+        mock_bulk.side_effect = BulkIndexError('1 document(s) failed', [
+            {'update': {'_id': '1', 'status': 409}}])
+        query = Session().query(MissParent)
+        MissParent._update_many(query, {'name': 'c'})
+        with pytest.raises(BulkIndexError):
+            transaction_manager.commit()
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_bulk_update_partial_onupdate(self, mock_es, memory_db,
+                                          transaction_manager):
+        from pyramid_sqlalchemy import Session
+        StampParent, StampChild = create_models('BulkStamp')
+        StampParent.version = fields.IntegerField(
+            default=1, onupdate=lambda: 2)
+        memory_db()
+        StampParent(id=1, name='a').save()
+        transaction_manager.commit()
+        mock_es.reset_mock()
+
+        query = Session().query(StampParent)
+        StampParent._update_many(query, {'name': 'b'})
+        transaction_manager.commit()
+        actions = mock_es().process_chunks.call_args[1]['documents']
+        assert actions[0]['doc'] == {'_pk': '1', 'name': 'b', 'version': 2}
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_bulk_update_reindex(self, mock_es, memory_db,
+                                 transaction_manager):
+        ReParent, ReChild = create_models('Re')
+        memory_db()
+        ReParent(id=1).save()
+        ReParent(id=2).save()
+        ReChild(id=1, parent_id=1).save()
+        transaction_manager.commit()
+        mock_es.reset_mock()
+
+        assert not signals.is_partially_updatable(ReChild, {'parent_id'})
+        assert not signals.is_partially_updatable(ReChild, {'id'})
+        assert signals.is_partially_updatable(ReParent, {'name'})
+        query = ReChild.get_collection(id=1)
+        ReChild._update_many(query, {'parent_id': 2})
+        transaction_manager.commit()
+        assert not mock_es().process_chunks.called
+        indexed = {}
+        for call in mock_es().index.call_args_list:
+            for document in call[0][0]:
+                indexed[(document['_type'], document['_pk'])] = document
+        assert indexed[('ReChild', '1')]['parent_id'] == 2
+        assert [child['id'] for child in
+                indexed[('ReParent', '2')]['children']] == [1]
+
+    def test_batch_partial_update(self):
+        batch = signals.IndexBatch()
+        batch.update('Story', 1, {'_pk': '1', 'name': 'a'})
+        batch.update('Story', 1, {'_pk': '1', 'status': 'b'})
+        batch.documents[('Story', 2)] = {'_pk': '2', 'name': 'a'}
+        batch.update('Story', 2, {'_pk': '2', 'name': 'b'})
+        batch.delete('Story', [3])
+        batch.update('Story', 3, {'_pk': '3', 'name': 'b'})
+        assert batch.get_actions() == [
+            ('update', 'Story', {'_pk': '1', 'name': 'a', 'status': 'b'}),
+            ('index', 'Story', {'_pk': '2', 'name': 'b'}),
+            ('delete', 'Story', 3),
+        ]
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_update_partial(self, mock_es, memory_db, transaction_manager):
+        from pyramid_sqlalchemy import Session
+        PartParent, PartChild = create_models('Part')
+        PartParent._index_ignored_fields = ('status',)
+        PartParent.status = fields.StringField()
+        PartParent.duration = fields.IntervalField()
+        memory_db()
+        PartParent(id=1, name='a', status='new').save()
+        transaction_manager.commit()
+        mock_es.reset_mock()
+
+        parent = Session().query(PartParent).get(1)
+        parent.update({'status': 'old'})
+        transaction_manager.commit()
+        assert not mock_es.called
+
+        parent = Session().query(PartParent).get(1)
+        parent.update({'name': 'b'})
+        transaction_manager.commit()
+        assert not mock_es().index.called
+        actions = mock_es().process_chunks.call_args[1]['documents']
+        assert [(action['_op_type'], action['doc']) for action in actions] == [
+            ('update', {'_pk': '1', 'name': 'b'})]
+        mock_es.reset_mock()
+
+        # Processed fields are reindexed fully
+        parent = Session().query(PartParent).get(1)
+        parent.update({'duration': 60})
+        transaction_manager.commit()
+        assert not mock_es().process_chunks.called
+        document = mock_es().index.call_args[0][0][0]
+        assert document['duration'].total_seconds() == 60
+        assert document['name'] == 'b'
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_update_partial_onupdate(self, mock_es, memory_db,
+                                     transaction_manager):
+        from sqlalchemy import text
+        from pyramid_sqlalchemy import Session
+        StampParent, StampChild = create_models('Stamp')
+        StampParent._index_ignored_fields = ('status',)
+        StampParent.status = fields.StringField()
+        StampParent.version = fields.IntegerField(
+            default=1, onupdate=lambda: 2)
+        StampParent.revision = fields.IntegerField(
+            default=1, server_onupdate=FetchedValue())
+        connection = memory_db()
+        connection.execute(text(
+            'CREATE TRIGGER stamp_revision AFTER UPDATE ON stampparent '
+            'BEGIN UPDATE stampparent SET revision = revision + 1 '
+            'WHERE id = NEW.id AND NEW.revision = OLD.revision; END'))
+        StampParent(id=1, name='a').save()
+        transaction_manager.commit()
+        mock_es.reset_mock()
+
+        parent = Session().query(StampParent).get(1)
+        parent.update({'name': 'b'})
+        transaction_manager.commit()
+        actions = mock_es().process_chunks.call_args[1]['documents']
+        assert actions[0]['doc'] == {
+            '_pk': '1', 'name': 'b', 'version': 2, 'revision': 2}
+        mock_es.reset_mock()
+
+        # Generated values are sent even if other changes are ignored
+        parent = Session().query(StampParent).get(1)
+        parent.update({'status': 'new'})
+        transaction_manager.commit()
+        actions = mock_es().process_chunks.call_args[1]['documents']
+        assert actions[0]['doc'] == {
+            '_pk': '1', 'version': 2, 'revision': 3}
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_update_partial_nested(self, mock_es, memory_db,
+                                   transaction_manager):
+        from pyramid_sqlalchemy import Session
+        NestParent, NestChild = create_models('Nest')
+        NestChild.name = fields.StringField()
+        memory_db()
+        parent = NestParent(id=1).save()
+        NestChild(id=1, parent=parent, name='a').save()
+        transaction_manager.commit()
+        mock_es.reset_mock()
+
+        # Child is nested in parent document, which is reindexed too
+        child = Session().query(NestChild).get(1)
+        child.update({'name': 'b'})
+        transaction_manager.commit()
+        assert not mock_es().process_chunks.called
+        indexed = {}
+        for call in mock_es().index.call_args_list:
+            for document in call[0][0]:
+                indexed[document['_type']] = document
+        assert indexed['NestChild']['name'] == 'b'
+        assert indexed['NestParent']['children'][0]['name'] == 'b'
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_update_partial_immediate(self, mock_es, memory_db):
+        ImmPartParent, ImmPartChild = create_models('ImmPart')
+        memory_db()
+        signals.set_index_on_commit(False)
+        try:
+            parent = ImmPartParent(id=1, name='a').save()
+            mock_es.reset_mock()
+            parent.update({'name': 'b'})
+        finally:
+            signals.set_index_on_commit(True)
+        assert not mock_es().index.called
+        actions = mock_es().process_chunks.call_args[1]['documents']
+        assert actions[0]['doc'] == {'_pk': '1', 'name': 'b'}
+
+    @patch('nefertari.elasticsearch._bulk_body')
+    @patch('nefertari.elasticsearch.ES')
+    def test_update_partial_missing(self, mock_es, mock_bulk, memory_db,
+                                    transaction_manager):
+        from elasticsearch.helpers import BulkIndexError
+        ImmMissParent, ImmMissChild = create_models('ImmMiss')
+        memory_db()
+        mock_es().process_chunks.side_effect = (
+            lambda documents, operation: operation(
+                documents_actions=documents))
+        mock_bulk.side_effect = BulkIndexError('1 document(s) failed', [
+            {'update': {'_id': '1', 'status': 404}}])
+        parent = ImmMissParent(id=1, name='a').save()
+        transaction_manager.commit()
+        signals.set_index_on_commit(False)
+        try:
+            parent = ImmMissParent.get_item(id=1)
+            mock_es.reset_mock()
+            # Flushed changes are loaded with the session of the object
+            with patch.object(signals, 'sessionmaker') as mock_maker:
+                parent.update({'name': 'b'})
+        finally:
+            signals.set_index_on_commit(True)
+        assert not mock_maker.called
+        mock_es().index.assert_called_once_with([{
+            '_pk': '1', '_type': 'ImmMissParent', 'id': 1, 'name': 'b',
+            'children': []}], request=None)
@@ -255,3 +255,25 @@ class TestChoiceArray(object):
         dialect = Mock()
         dialect.name = 'some_other'
         assert ['q'] == field.process_result_value('["q"]', dialect)
+
+
+class TestJSONDict(object):
+
+    def test_load_dialect_impl_postgresql(self):
+        from sqlalchemy.dialects import postgresql
+        field = types.JSONDict()
+        impl = field.load_dialect_impl(dialect=postgresql.dialect())
+        assert field.is_postgresql
+        assert isinstance(impl, postgresql.JSONB)
+
+    def test_load_dialect_impl_not_postgresql(self):
+        from sqlalchemy.dialects import sqlite
+        field = types.JSONDict()
+        field.load_dialect_impl(dialect=sqlite.dialect())
+        assert not field.is_postgresql
+
+    def test_process_bind_param_not_postgres(self):
+        field = types.JSONDict()
+        dialect = Mock()
+        dialect.name = 'some_other'
+        assert '{"a": 1}' == field.process_bind_param({'a': 1}, dialect)
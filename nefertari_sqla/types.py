@@ -2,7 +2,8 @@ import json
 import datetime
 
 from sqlalchemy import types
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy_utils.types.json import JSONType
 
 
 class LengthLimitedStringMixin(object):
@@ -217,3 +218,18 @@ class ChoiceArray(types.TypeDecorator):
         if value is not None:
             value = json.loads(value)
         return value
+
+
+class JSONDict(JSONType):
+    """ Represents a dict of JSON-serializable values.
+
+    If 'postgresql' is used, `postgresql.JSONB` type is used for db
+    column type, so column may be queried and indexed with GIN index.
+    Otherwise `UnicodeText` is used.
+    """
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            self.is_postgresql = True
+            return dialect.type_descriptor(JSONB())
+        self.is_postgresql = False
+        return super(JSONDict, self).load_dialect_impl(dialect)
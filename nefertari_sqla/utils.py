@@ -1,5 +1,11 @@
+import base64
+import datetime
+import decimal
+import json
+
 from sqlalchemy.orm.properties import RelationshipProperty
-from sqlalchemy.orm import class_mapper
+
+from .documents import get_model_metadata
 
 
 relationship_fields = (
@@ -13,8 +19,7 @@ def is_relationship_field(field, model_cls):
     """
     if not model_cls.has_field(field):
         return False
-    mapper = class_mapper(model_cls)
-    relationships = {r.key: r for r in mapper.relationships}
+    relationships = get_model_metadata(model_cls).relationships
     field_obj = relationships.get(field)
     return isinstance(field_obj, relationship_fields)
 
@@ -26,11 +31,158 @@ def get_relationship_cls(field, model_cls):
     Make sure field exists and is a relationship
     field manually. Use `is_relationship_field` for this.
      """
-    mapper = class_mapper(model_cls)
-    relationships = {r.key: r for r in mapper.relationships}
+    relationships = get_model_metadata(model_cls).relationships
     field_obj = relationships[field]
     return field_obj.mapper.class_
 
 
-class FieldsQuerySet(list):
+class FieldsQuerySet(object):
+    """ Lazy sequence of dicts produced from query :rows: by :convert:.
+
+    :rows: are iterated and converted only when items are accessed.
+    Converted items are cached, so the sequence may be iterated, sliced
+    and measured like a list. When :cache: is False, items are not
+    cached and the sequence may only be iterated once, which keeps memory
+    usage flat when streaming big collections.
+    """
+    def __init__(self, rows, convert, cache=True):
+        self._rows = rows
+        self._iterator = None
+        self._convert = convert
+        self._cache = [] if cache else None
+
+    def _next_rows(self):
+        if self._iterator is None:
+            self._iterator = iter(self._rows)
+        return self._iterator
+
+    def _fetch(self, count=None):
+        """ Convert and cache next :count: rows or all rows if :count:
+        is None.
+        """
+        rows = self._next_rows()
+        if count is None:
+            self._cache.extend(self._convert(row) for row in rows)
+            return
+        for row in rows:
+            self._cache.append(self._convert(row))
+            count -= 1
+            if count <= 0:
+                return
+
+    def _fill(self, size=None):
+        """ Make sure at least :size: items are cached or all items if
+        :size: is None.
+        """
+        if self._cache is None:
+            raise TypeError('Streamed FieldsQuerySet can only be iterated')
+        if size is None:
+            self._fetch()
+        elif len(self._cache) < size:
+            self._fetch(size - len(self._cache))
+
+    def __iter__(self):
+        if self._cache is None:
+            return (self._convert(row) for row in self._next_rows())
+        return self._iter_cached()
+
+    def _iter_cached(self):
+        index = 0
+        while True:
+            if index >= len(self._cache):
+                self._fill(index + 1)
+                if index >= len(self._cache):
+                    return
+            yield self._cache[index]
+            index += 1
+
+    def __len__(self):
+        self._fill()
+        return len(self._cache)
+
+    def __bool__(self):
+        self._fill(1)
+        return bool(self._cache)
+    __nonzero__ = __bool__
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            stop = index.stop
+            unbounded = (stop is None or stop < 0 or
+                         (index.start or 0) < 0)
+            self._fill(None if unbounded else stop)
+        else:
+            self._fill(None if index < 0 else index + 1)
+        return self._cache[index]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if self._cache is None:
+            return '<FieldsQuerySet (streamed)>'
+        return 'FieldsQuerySet({!r})'.format(list(self))
+
+
+class CollectionQuerySet(list):
+    """ Already fetched page of collection objects. """
     pass
+
+
+_CURSOR_TYPES = {
+    'datetime': (
+        datetime.datetime,
+        lambda v: v.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+        lambda v: datetime.datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f')),
+    'date': (
+        datetime.date,
+        lambda v: v.strftime('%Y-%m-%d'),
+        lambda v: datetime.datetime.strptime(v, '%Y-%m-%d').date()),
+    'time': (
+        datetime.time,
+        lambda v: v.strftime('%H:%M:%S.%f'),
+        lambda v: datetime.datetime.strptime(v, '%H:%M:%S.%f').time()),
+    'decimal': (decimal.Decimal, str, decimal.Decimal),
+}
+
+
+def encode_cursor(values):
+    """ Encode sequence of :values: to an opaque URL-safe cursor string.
+
+    Values of types that are not supported by JSON are tagged with their
+    type name so they are decoded to values of the same type.
+    """
+    encoded = []
+    for value in values:
+        for type_name, (type_, dump, _) in _CURSOR_TYPES.items():
+            # datetime is a subclass of date, thus exact type is checked
+            if type(value) is type_:
+                value = {type_name: dump(value)}
+                break
+        encoded.append(value)
+    data = json.dumps(encoded, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Decode :cursor: generated by `encode_cursor` to a list of values.
+
+    :raises ValueError: If :cursor: is not a valid cursor.
+    """
+    try:
+        data = base64.urlsafe_b64decode(str(cursor).encode('ascii'))
+        encoded = json.loads(data.decode('utf-8'))
+        if not isinstance(encoded, list):
+            raise ValueError('Cursor must encode a list')
+        values = []
+        for value in encoded:
+            if isinstance(value, dict):
+                (type_name, value), = value.items()
+                value = _CURSOR_TYPES[type_name][2](value)
+            values.append(value)
+    except (TypeError, KeyError, ValueError, UnicodeError) as ex:
+        raise ValueError('Invalid cursor: {}'.format(ex))
+    return values
@@ -37,4 +37,9 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=install_requires,
+    entry_points={
+        'console_scripts': [
+            'nefertari_sqla.reindex = nefertari_sqla.reindex:main',
+        ],
+    },
 )